@@ -0,0 +1,323 @@
+"""
+Run many scrapers concurrently, writing the results as they finish so an interrupted
+run can be resumed.
+"""
+
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List
+from urllib.parse import urlparse
+import json
+import logging
+import threading
+import time
+
+from aiwebscraper.extract import WebScraper, get_data_with_scraper, get_from_xpaths
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_jobs(source) -> List[Dict]:
+    """Load the jobs to run from source.
+
+    If source is a directory, each *.json file in it is an exported scraper (with
+    url, element_xpath and xpaths) and the job extracts the table with its XPaths.
+    Otherwise, source is a manifest with a URL per line, optionally followed by the
+    XPath of the element to scrape, and the job extracts the table (and finds the
+    XPaths of its columns) with the model. Empty lines and lines starting with #
+    are ignored.
+
+    Each job has an id (the file name or the manifest line) used to resume the run.
+    """
+    source = Path(source)
+    jobs = []
+
+    if source.is_dir():
+        for path in sorted(source.glob("*.json")):
+            data = json.loads(path.read_text())
+            jobs.append(
+                {
+                    "id": path.name,
+                    "url": data["url"],
+                    "element_xpath": data["element_xpath"],
+                    "xpaths": data["xpaths"],
+                }
+            )
+    else:
+        for line in source.read_text().splitlines():
+            line = line.strip()
+
+            if not line or line.startswith("#"):
+                continue
+
+            url, *element_xpath = line.split(maxsplit=1)
+            jobs.append(
+                {
+                    "id": line,
+                    "url": url,
+                    "element_xpath": element_xpath[0] if element_xpath else None,
+                    "xpaths": None,
+                }
+            )
+
+    ids = [job["id"] for job in jobs]
+
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"{source} contains duplicated jobs")
+
+    return jobs
+
+
+def _domain(url):
+    return urlparse(url).netloc.lower()
+
+
+def _interleave_by_domain(jobs):
+    """Reorder jobs so consecutive ones are from different domains when possible,
+    so the workers aren't all waiting for the same domain's rate limit."""
+    queues = defaultdict(deque)
+
+    for job in jobs:
+        queues[_domain(job["url"])].append(job)
+
+    interleaved = []
+
+    while queues:
+        for domain in list(queues):
+            interleaved.append(queues[domain].popleft())
+
+            if not queues[domain]:
+                del queues[domain]
+
+    return interleaved
+
+
+class DomainRateLimiter:
+    """
+    Spaces the requests to each domain by at least min_interval seconds, across
+    threads. Requests to different domains don't wait for each other.
+    """
+
+    def __init__(self, min_interval: float = 1.0) -> None:
+        self._min_interval = min_interval
+        self._lock = threading.Lock()
+        # domain -> earliest time for the next request
+        self._next = {}
+
+    def wait(self, url):
+        """Block until a request to url's domain is allowed."""
+        domain = _domain(url)
+
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(domain, now))
+            self._next[domain] = start + self._min_interval
+
+        if start > now:
+            time.sleep(start - now)
+
+
+class JSONLWriter:
+    """Appends each result as a line to a JSON Lines file, flushing it right away."""
+
+    def __init__(self, path) -> None:
+        self._path = Path(path)
+        self._file = None
+
+    def done_ids(self):
+        """Ids of the successful jobs in the file. A line left incomplete by a crash
+        is removed."""
+        if not self._path.exists():
+            return set()
+
+        content = self._path.read_bytes()
+        end = content.rfind(b"\n") + 1
+
+        if end < len(content):
+            logger.warning(f"Removing an incomplete line at the end of {self._path}")
+
+            with open(self._path, "r+b") as file:
+                file.truncate(end)
+
+        records = (json.loads(line) for line in content[:end].splitlines() if line)
+        return {record["id"] for record in records if record["status"] == "ok"}
+
+    def write(self, record):
+        if self._file is None:
+            self._file = open(self._path, "a")
+
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ParquetWriter:
+    """
+    Writes the results to a directory of Parquet files (which pandas and pyarrow read
+    as a single dataset), a new file every flush_every results, since a Parquet file
+    can't be appended to. The table and scraper of each result are JSON strings, as
+    their columns differ between jobs.
+    """
+
+    def __init__(self, path, flush_every: int = 50) -> None:
+        self._path = Path(path)
+        self._flush_every = flush_every
+        self._records = []
+
+    def _parts(self):
+        return sorted(self._path.glob("part-*.parquet"))
+
+    def done_ids(self):
+        """Ids of the successful jobs in the directory."""
+        # imported here so pandas is only required for this output format
+        import pandas as pd
+
+        ids = set()
+
+        for part in self._parts():
+            df = pd.read_parquet(part, columns=["id", "status"])
+            ids.update(df.loc[df["status"] == "ok", "id"])
+
+        return ids
+
+    def write(self, record):
+        self._records.append(
+            {
+                **record,
+                "table": json.dumps(record["table"]),
+                "scraper": json.dumps(record["scraper"]),
+            }
+        )
+
+        if len(self._records) >= self._flush_every:
+            self.flush()
+
+    def flush(self):
+        import pandas as pd
+
+        if not self._records:
+            return
+
+        self._path.mkdir(parents=True, exist_ok=True)
+        parts = self._parts()
+        number = int(parts[-1].stem.split("-")[1]) + 1 if parts else 0
+        path = self._path / f"part-{number:05d}.parquet"
+
+        # write to a temporary file first so a crash doesn't leave a corrupted part
+        tmp = path.with_suffix(".tmp")
+        # a string column even if all the errors are None, so the parts have the
+        # same schema
+        df = pd.DataFrame(self._records).astype({"error": "string"})
+        df.to_parquet(tmp, index=False)
+        tmp.rename(path)
+
+        self._records = []
+
+    def close(self):
+        self.flush()
+
+
+def make_writer(path, output_format=None):
+    """Return the writer for path. output_format is "jsonl" or "parquet", if None,
+    it's "parquet" if path ends with .parquet and "jsonl" otherwise."""
+    if output_format is None:
+        output_format = "parquet" if str(path).endswith(".parquet") else "jsonl"
+
+    if output_format == "jsonl":
+        return JSONLWriter(path)
+    elif output_format == "parquet":
+        return ParquetWriter(path)
+    else:
+        raise ValueError(
+            f"output_format must be 'jsonl' or 'parquet', got {output_format!r}"
+        )
+
+
+def run_job(job, engine="auto", backend="selenium"):
+    """Run a job, returning the table and the scraper (url, element_xpath and
+    xpaths)."""
+    if job["xpaths"] is not None:
+        table = get_from_xpaths(
+            job["url"],
+            job["element_xpath"],
+            job["xpaths"],
+            engine=engine,
+            backend=backend,
+        )
+        scraper = {key: job[key] for key in ("url", "element_xpath", "xpaths")}
+        return table, scraper
+
+    with WebScraper(job["url"], job["element_xpath"], backend=backend) as scraper:
+        table = scraper.extract_table_data()
+        return table, get_data_with_scraper(scraper, table)
+
+
+def run_batch(
+    jobs,
+    writer,
+    workers: int = 4,
+    min_interval: float = 1.0,
+    resume: bool = True,
+    engine="auto",
+    backend="selenium",
+    callback=None,
+):
+    """Run the jobs (see load_jobs) using up to workers threads, starting requests
+    to the same domain at least min_interval seconds apart.
+
+    Each result is passed to writer as it finishes: a dict with the job's id and
+    url, status ("ok" or "error"), error, table and scraper. If resume is True, the
+    jobs that succeeded according to writer.done_ids() are skipped (failed ones are
+    run again). callback, if given, is called with each result.
+
+    Returns the number of jobs that succeeded, failed and were skipped.
+    """
+    done = writer.done_ids() if resume else set()
+    pending = _interleave_by_domain([job for job in jobs if job["id"] not in done])
+    limiter = DomainRateLimiter(min_interval)
+
+    def run(job):
+        limiter.wait(job["url"])
+        return run_job(job, engine=engine, backend=backend)
+
+    counts = {"ok": 0, "error": 0, "skipped": len(jobs) - len(pending)}
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    try:
+        futures = {executor.submit(run, job): job for job in pending}
+
+        for future in as_completed(futures):
+            job = futures[future]
+            result = {
+                "id": job["id"],
+                "url": job["url"],
+                "status": "ok",
+                "error": None,
+                "table": None,
+                "scraper": None,
+            }
+
+            try:
+                result["table"], result["scraper"] = future.result()
+            except Exception as e:
+                logger.exception(f"Job {job['id']} failed")
+                result["status"], result["error"] = "error", repr(e)
+
+            writer.write(result)
+            counts[result["status"]] += 1
+
+            if callback is not None:
+                callback(result)
+    finally:
+        # if interrupted, don't start the pending jobs (they run when resuming)
+        executor.shutdown(cancel_futures=True)
+        writer.close()
+
+    return counts
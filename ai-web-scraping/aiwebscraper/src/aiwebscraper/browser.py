@@ -1,13 +1,148 @@
+import atexit
 import getpass
 import random
+import threading
 import time
+import weakref
 
 from selenium.webdriver.chrome.options import Options
 from selenium import webdriver
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import NoSuchElementException, WebDriverException
+
+
+# evaluates several XPaths (relative to an element, or the document if it's null) and
+# returns the text of the nodes each one matches, trimmed like Selenium's
+# WebElement.text
+EVALUATE_XPATHS_SCRIPT = """
+const [context, xpaths] = arguments;
+return xpaths.map((xpath) => {
+    const snapshot = document.evaluate(
+        xpath, context || document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null
+    );
+    const values = [];
+
+    for (let i = 0; i < snapshot.snapshotLength; i++) {
+        const node = snapshot.snapshotItem(i);
+        const text =
+            node.nodeType === Node.ELEMENT_NODE ? node.innerText : node.textContent;
+        // the same normalization as extract._normalize_text: whitespace is collapsed
+        // within each line and empty lines are removed
+        values.push(
+            (text || "")
+                .split("\\n")
+                .map((line) => line.replace(/\\s+/g, " ").trim())
+                .filter((line) => line)
+                .join("\\n")
+        );
+    }
+
+    return values;
+});
+"""
+
+# a page is stable when the element hasn't changed and no resources finished loading
+# for QUIET_SECONDS (we stop waiting after STABLE_TIMEOUT seconds, e.g., for pages
+# that update live)
+QUIET_SECONDS = 0.5
+STABLE_TIMEOUT = 3
+
+# resolves with true once the element (or the document if it's null) is stable, or
+# with false after the timeout
+WAIT_UNTIL_STABLE_SCRIPT = """
+const [element, quietMs, timeoutMs, done] = arguments;
+const start = performance.now();
+let lastChange = start;
+let resources = performance.getEntriesByType("resource").length;
+const observer = new MutationObserver(() => {
+    lastChange = performance.now();
+});
+observer.observe(element || document, {
+    subtree: true, childList: true, characterData: true, attributes: true
+});
+
+const check = () => {
+    const now = performance.now();
+    const count = performance.getEntriesByType("resource").length;
+
+    if (count !== resources) {
+        resources = count;
+        lastChange = now;
+    }
+
+    const quiet = document.readyState === "complete" && now - lastChange >= quietMs;
+
+    if (quiet || now - start >= timeoutMs) {
+        observer.disconnect();
+        done(quiet);
+    } else {
+        setTimeout(check, 50);
+    }
+};
+check();
+"""
+
+# requests blocked by the "light" load profile (Network.setBlockedURLs patterns, *
+# matches any string): images, fonts, media and analytics
+# fmt: off
+_BLOCKED_EXTENSIONS = [
+    "png", "jpg", "jpeg", "gif", "webp", "avif", "svg", "ico",
+    "woff", "woff2", "ttf", "otf", "eot",
+    "mp4", "webm", "mp3", "ogg", "wav", "m3u8",
+]
+# fmt: on
+_BLOCKED_DOMAINS = [
+    "google-analytics.com",
+    "googletagmanager.com",
+    "doubleclick.net",
+    "googlesyndication.com",
+    "amazon-adsystem.com",
+    "scorecardresearch.com",
+    "facebook.net",
+    "hotjar.com",
+    "segment.io",
+    "newrelic.com",
+    "nr-data.net",
+]
+BLOCKED_URL_PATTERNS = (
+    [f"*.{extension}" for extension in _BLOCKED_EXTENSIONS]
+    + [f"*.{extension}?*" for extension in _BLOCKED_EXTENSIONS]
+    + [f"*://*{domain}/*" for domain in _BLOCKED_DOMAINS]
+)
+
+# added to every document by the "light" load profile
+DISABLE_ANIMATIONS_SCRIPT = """
+const disableAnimations = () => {
+    const style = document.createElement("style");
+    style.textContent = `*, *::before, *::after {
+        animation: none !important;
+        transition: none !important;
+        scroll-behavior: auto !important;
+    }`;
+    document.documentElement.appendChild(style);
+};
+
+if (document.documentElement) {
+    disableAnimations();
+} else {
+    document.addEventListener("DOMContentLoaded", disableAnimations);
+}
+"""
+
+LOAD_PROFILES = {"full", "light"}
+
+# all the pools, so we quit their drivers at exit
+_pools = weakref.WeakSet()
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+@atexit.register
+def _close_pools():
+    for pool in list(_pools):
+        pool.close()
 
 
 def find_text_by_xpath_if_exists(element, xpath):
@@ -17,23 +152,380 @@ def find_text_by_xpath_if_exists(element, xpath):
         return None
 
 
+def _make_driver(connect_to_existing=False, page_load_strategy="normal"):
+    chrome_options = Options()
+    chrome_options.page_load_strategy = page_load_strategy
+
+    if connect_to_existing:
+        chrome_options.add_experimental_option("debuggerAddress", "127.0.0.1:9222")
+
+    # required for running as root in a container
+    if getpass.getuser() == "root":
+        chrome_options.add_argument("--no-sandbox")
+        chrome_options.add_argument("--headless")
+
+    return webdriver.Chrome(options=chrome_options)
+
+
+class BrowserPool:
+    """
+    Keeps Chrome drivers running so Browser objects can reuse them instead of starting
+    Chrome for every page.
+
+    Parameters
+    ----------
+    size : int, default=2
+        Maximum number of drivers. Browser objects wait for one to be returned when
+        all of them are in use.
+
+    max_pages : int, default=50
+        Quit a driver (and start a new one when needed) after it loaded this many
+        pages, so long-running processes don't accumulate Chrome's memory usage.
+
+    page_load_strategy : str, default="normal"
+        Selenium's page load strategy for the drivers: "normal" waits for all the
+        resources, "eager" only for the DOM (Browser.wait_for_element waits for the
+        content anyway).
+    """
+
+    def __init__(self, size=2, max_pages=50, page_load_strategy="normal") -> None:
+        self._size = size
+        self._page_load_strategy = page_load_strategy
+        self._max_pages = max_pages
+        self._condition = threading.Condition()
+        # idle drivers, the most recently used one last
+        self._idle = []
+        # driver -> pages loaded, for all the drivers (idle or in use)
+        self._pages = {}
+        # drivers being started
+        self._starting = 0
+        self._closed = False
+        _pools.add(self)
+
+    def acquire(self):
+        """Return an idle driver (or start one), waiting if all of them are in
+        use. Drivers that stopped responding are replaced."""
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("The browser pool is closed")
+
+                if self._idle:
+                    driver = self._idle.pop()
+                    break
+
+                if len(self._pages) + self._starting < self._size:
+                    driver = None
+                    break
+
+                self._condition.wait()
+
+            self._starting += 1
+
+        if driver is not None and self._is_healthy(driver):
+            with self._condition:
+                self._starting -= 1
+
+            return driver
+
+        if driver is not None:
+            self._discard(driver)
+
+        try:
+            new_driver = _make_driver(page_load_strategy=self._page_load_strategy)
+        finally:
+            with self._condition:
+                self._starting -= 1
+                self._condition.notify()
+
+        with self._condition:
+            if not self._closed:
+                self._pages[new_driver] = 0
+                return new_driver
+
+        self._quit(new_driver)
+        raise RuntimeError("The browser pool is closed")
+
+    def release(self, driver):
+        """Return a driver to the pool. It's quit if it reached max_pages or if it
+        can't be reset to a blank page."""
+        with self._condition:
+            if driver not in self._pages:
+                # the pool was closed and the driver quit
+                return
+
+            self._pages[driver] += 1
+            recycle = self._pages[driver] >= self._max_pages
+
+        if not recycle and self._reset(driver):
+            with self._condition:
+                if not self._closed:
+                    self._idle.append(driver)
+                    self._condition.notify()
+                    return
+
+        self._discard(driver)
+
+    def close(self):
+        """Quit all the drivers, including the ones in use."""
+        with self._condition:
+            self._closed = True
+            drivers = list(self._pages)
+            self._pages.clear()
+            self._idle.clear()
+            self._condition.notify_all()
+
+        for driver in drivers:
+            self._quit(driver)
+
+    def _discard(self, driver):
+        with self._condition:
+            self._pages.pop(driver, None)
+            self._condition.notify()
+
+        self._quit(driver)
+
+    @staticmethod
+    def _quit(driver):
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+
+    @staticmethod
+    def _is_healthy(driver):
+        try:
+            return driver.execute_script("return 1") == 1
+        except WebDriverException:
+            return False
+
+    @staticmethod
+    def _reset(driver):
+        """Close the tabs opened by the page and load a blank page in the remaining
+        one, so it's reused by the next Browser. Returns False if the driver
+        failed."""
+        try:
+            handles = driver.window_handles
+
+            for handle in handles[1:]:
+                driver.switch_to.window(handle)
+                driver.close()
+
+            driver.switch_to.window(handles[0])
+            driver.get("about:blank")
+        except WebDriverException:
+            return False
+
+        return True
+
+
+def get_browser_pool():
+    """Return the pool used by WebScraper and get_from_xpaths (created on first use,
+    see set_browser_pool)."""
+    global _default_pool
+
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = BrowserPool()
+
+        return _default_pool
+
+
+def set_browser_pool(pool: BrowserPool):
+    """Replace the pool used by WebScraper and get_from_xpaths (e.g., to change its
+    size). The previous one is closed."""
+    global _default_pool
+
+    with _default_pool_lock:
+        previous, _default_pool = _default_pool, pool
+
+    if previous is not None and previous is not pool:
+        previous.close()
+
+
 class Browser:
-    def __init__(self, url, connect_to_existing=False) -> None:
-        chrome_options = Options()
+    """
+    Loads a page in Chrome. Call quit() (or use it as a context manager) when done.
+
+    Parameters
+    ----------
+    url : str
+        The page to load.
+
+    connect_to_existing : bool, default=False
+        Connect to a Chrome instance running with --remote-debugging-port=9222
+        instead of starting one (can't be used with pool).
 
-        if connect_to_existing:
-            chrome_options.add_experimental_option("debuggerAddress", "127.0.0.1:9222")
+    pool : BrowserPool, default=None
+        Take the driver from this pool (and return it on quit) instead of starting
+        Chrome.
 
-        # required for running as root in a container
-        if getpass.getuser() == "root":
-            chrome_options.add_argument("--no-sandbox")
-            chrome_options.add_argument("--headless")
+    jitter : tuple, default=None
+        (low, high) seconds to wait randomly before looking for elements and after
+        scrolling, to look less like a bot. None doesn't wait.
 
-        self.driver = webdriver.Chrome(options=chrome_options)
+    load_profile : str, default="full"
+        "full" loads the page normally, "light" blocks images, fonts, media and
+        analytics (BLOCKED_URL_PATTERNS) and disables CSS animations and
+        transitions, which is enough to read the page's HTML and text.
+
+    page_load_strategy : str, default=None
+        Selenium's page load strategy ("normal" if None), see BrowserPool. Set it in
+        the pool when using one.
+    """
+
+    def __init__(
+        self,
+        url,
+        connect_to_existing=False,
+        pool=None,
+        jitter=None,
+        load_profile="full",
+        page_load_strategy=None,
+    ) -> None:
+        if connect_to_existing and pool is not None:
+            raise ValueError("connect_to_existing can't be used with a pool")
+
+        if page_load_strategy is not None and pool is not None:
+            raise ValueError("Set page_load_strategy in the pool when using one")
+
+        if load_profile not in LOAD_PROFILES:
+            raise ValueError(
+                f"load_profile must be 'full' or 'light', got {load_profile!r}"
+            )
+
+        self._pool = pool
+        self.jitter = jitter
+        self.load_profile = load_profile
+        self.driver = None
+        self._animations_script_id = None
+
+        if pool is None:
+            self.driver = _make_driver(
+                connect_to_existing, page_load_strategy=page_load_strategy or "normal"
+            )
+        else:
+            self.driver = pool.acquire()
 
         self.wait_long = WebDriverWait(self.driver, 10)
         self.wait_short = WebDriverWait(self.driver, 2)
-        self.driver.get(url)
+
+        try:
+            if load_profile == "light":
+                self._block_resources()
+
+            self.driver.get(url)
+        except BaseException:
+            self.quit()
+            raise
+
+    def _block_resources(self):
+        self.driver.execute_cdp_cmd("Network.enable", {})
+        self.driver.execute_cdp_cmd(
+            "Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS}
+        )
+        result = self.driver.execute_cdp_cmd(
+            "Page.addScriptToEvaluateOnNewDocument",
+            {"source": DISABLE_ANIMATIONS_SCRIPT},
+        )
+        self._animations_script_id = result["identifier"]
+
+    def _unblock_resources(self, driver):
+        """Undo _block_resources so the next Browser using the driver (from the pool)
+        loads pages normally."""
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": []})
+        driver.execute_cdp_cmd("Network.disable", {})
+
+        if self._animations_script_id is not None:
+            driver.execute_cdp_cmd(
+                "Page.removeScriptToEvaluateOnNewDocument",
+                {"identifier": self._animations_script_id},
+            )
+
+    def quit(self):
+        """Return the driver to the pool, or quit it if there's no pool."""
+        driver, self.driver = self.driver, None
+
+        if driver is None:
+            return
+
+        if self._pool is None:
+            driver.quit()
+            return
+
+        if self.load_profile == "light":
+            try:
+                self._unblock_resources(driver)
+            except WebDriverException:
+                # the pool replaces drivers that stopped responding
+                pass
+
+        self._pool.release(driver)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.quit()
+
+    def __del__(self):
+        # __init__ might have failed before setting the driver
+        if getattr(self, "driver", None) is not None:
+            self.quit()
+
+    def wait_for_element(self, xpath, ready="stable", timeout=10):
+        """Wait for an element and return it.
+
+        Parameters
+        ----------
+        xpath : str
+            The element's XPath.
+
+        ready : str or callable, default="stable"
+            "present" returns the element as soon as it's in the DOM, "stable" also
+            waits until it stops changing and no resources finished loading for
+            QUIET_SECONDS (up to STABLE_TIMEOUT seconds). A callable receives the
+            driver and returns a truthy value when the page is ready (like
+            Selenium's expected conditions), it's called until then.
+
+        timeout : float, default=10
+            Seconds to wait for the element (and the callable) before raising
+            TimeoutException.
+        """
+        if not callable(ready) and ready not in {"present", "stable"}:
+            raise ValueError(
+                f"ready must be 'present', 'stable' or a callable, got {ready!r}"
+            )
+
+        self.wait_jitter()
+        wait = WebDriverWait(self.driver, timeout)
+        element = wait.until(EC.presence_of_element_located((By.XPATH, xpath)))
+
+        if ready == "present":
+            return element
+
+        if ready == "stable":
+            self.wait_until_stable(element)
+        else:
+            wait.until(ready)
+
+        # the page might have replaced the element in the meantime
+        return self.driver.find_element(By.XPATH, xpath)
+
+    def wait_until_stable(
+        self, element=None, quiet=QUIET_SECONDS, timeout=STABLE_TIMEOUT
+    ):
+        """Wait until the element (or the document if None) doesn't change and no
+        resources finished loading for quiet seconds. Returns False if it's still
+        changing after timeout seconds."""
+        return self.driver.execute_async_script(
+            WAIT_UNTIL_STABLE_SCRIPT, element, quiet * 1000, timeout * 1000
+        )
+
+    def wait_jitter(self):
+        """Wait randomly if jitter is set."""
+        if self.jitter is not None:
+            self.wait_randomly(*self.jitter)
 
     def find_element_by_xpath(self, xpath, wait_long=True):
         wait = self.wait_long if wait_long else self.wait_short
@@ -42,11 +534,37 @@ class Browser:
     def find_all_elements_by_xpath(self, xpath):
         return self.driver.find_elements(By.XPATH, xpath)
 
+    def evaluate_xpaths(self, xpaths, element=None):
+        """Return the text of the elements matched by each XPath (relative to element,
+        or the document if None) with a single call to the driver, instead of one
+        call per XPath and element.
+
+        Parameters
+        ----------
+        xpaths : dict
+            Maps names to XPaths.
+
+        element : WebElement, default=None
+            The element the XPaths are evaluated from.
+
+        Returns
+        -------
+        dict
+            Maps each name to the list of texts (the elements' innerText, with a line
+            per block, see extract.get_from_html).
+        """
+        values = self.driver.execute_script(
+            EVALUATE_XPATHS_SCRIPT, element, list(xpaths.values())
+        )
+        return dict(zip(xpaths, values))
+
     def smooth_scroll(self, distance=500):
         self.driver.execute_script(
             f"window.scrollBy({{top: {distance}, behavior: 'smooth'}})"
         )
-        self.wait_randomly(1.5, 2.5)
+        self.wait_jitter()
+        # wait for the content loaded when scrolling
+        self.wait_until_stable()
 
     def wait_randomly(self, low=1, high=2):
         time.sleep(random.uniform(low, high))
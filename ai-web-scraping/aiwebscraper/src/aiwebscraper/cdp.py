@@ -0,0 +1,669 @@
+"""
+Browser backend that drives Chrome with the DevTools Protocol (CDP) using asyncio, so a
+single process (and a single Chrome instance) can load many pages at once.
+
+AsyncBrowser and AsyncPage are the asyncio interface:
+
+>>> async with await AsyncBrowser.launch() as browser:
+...     tables = await asyncio.gather(
+...         *(get_from_xpaths_async(browser, url, None, xpaths) for url in urls)
+...     )
+
+CDPBrowser has the same interface as aiwebscraper.browser.Browser (it runs the
+asyncio interface in a background thread), so WebScraper and get_from_xpaths can use
+it with backend="cdp".
+"""
+
+import asyncio
+import atexit
+import getpass
+import itertools
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from urllib.request import urlopen
+
+import websockets
+from selenium.webdriver.common.by import By
+
+from aiwebscraper.browser import (
+    BLOCKED_URL_PATTERNS,
+    DISABLE_ANIMATIONS_SCRIPT,
+    EVALUATE_XPATHS_SCRIPT,
+    LOAD_PROFILES,
+    QUIET_SECONDS,
+    STABLE_TIMEOUT,
+    WAIT_UNTIL_STABLE_SCRIPT,
+)
+
+
+CHROME_EXECUTABLES = [
+    "google-chrome",
+    "google-chrome-stable",
+    "chromium",
+    "chromium-browser",
+    "chrome",
+]
+
+# locate(locator) returns the node matched by the first XPath in locator, then by the
+# second one (relative to the first node), and so on. null if any of them doesn't
+# match
+LOCATE_FUNCTION = """
+const locate = (locator) => locator.reduce(
+    (context, xpath) => context === null ? null : document.evaluate(
+        xpath, context, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null
+    ).singleNodeValue,
+    document
+);
+const locateOrFail = (locator) => {
+    const node = locate(locator);
+
+    if (node === null) {
+        throw new Error("No element matches " + JSON.stringify(locator));
+    }
+
+    return node;
+};
+"""
+
+_loop = None
+_shared_browser = None
+_shared_lock = threading.Lock()
+
+
+class CDPError(Exception):
+    """Raised when Chrome returns an error or a script throws one."""
+
+
+def _to_locator(xpath, element_xpath=None):
+    """Return the list of XPaths a locator is made of."""
+    locator = [xpath] if isinstance(xpath, str) else list(xpath)
+
+    if element_xpath is not None:
+        locator = [element_xpath] + locator
+
+    return locator
+
+
+def _find_chrome():
+    for name in CHROME_EXECUTABLES:
+        path = shutil.which(name)
+
+        if path is not None:
+            return path
+
+    raise FileNotFoundError(
+        f"Couldn't find Chrome, tried: {', '.join(CHROME_EXECUTABLES)}. Pass the "
+        "path to the executable"
+    )
+
+
+def _get_json(url):
+    with urlopen(url, timeout=10) as response:
+        return json.load(response)
+
+
+class CDPConnection:
+    """
+    A websocket connection to Chrome. Commands can be sent concurrently: a task reads
+    the messages and resolves the command (or the event waiter) each one belongs to.
+    """
+
+    def __init__(self, websocket) -> None:
+        self._websocket = websocket
+        self._ids = itertools.count(1)
+        # command id -> future
+        self._pending = {}
+        # (session id, event) -> futures
+        self._waiters = {}
+        self._reader = asyncio.ensure_future(self._read())
+
+    @classmethod
+    async def connect(cls, url):
+        # pages can be larger than the default 1 MiB limit
+        return cls(await websockets.connect(url, max_size=None))
+
+    async def send(self, method, params=None, session_id=None):
+        """Send a command and return its result."""
+        command_id = next(self._ids)
+        message = {"id": command_id, "method": method, "params": params or {}}
+
+        if session_id is not None:
+            message["sessionId"] = session_id
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[command_id] = future
+
+        try:
+            await self._websocket.send(json.dumps(message))
+            return await future
+        finally:
+            self._pending.pop(command_id, None)
+
+    def wait_for_event(self, method, session_id=None):
+        """Return a future resolved with the parameters of the next event (call it
+        before sending the command that triggers the event)."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault((session_id, method), []).append(future)
+        return future
+
+    async def _read(self):
+        try:
+            async for raw in self._websocket:
+                message = json.loads(raw)
+
+                if "id" in message:
+                    future = self._pending.get(message["id"])
+
+                    if future is None or future.done():
+                        continue
+
+                    if "error" in message:
+                        future.set_exception(CDPError(message["error"].get("message")))
+                    else:
+                        future.set_result(message.get("result", {}))
+                else:
+                    key = (message.get("sessionId"), message.get("method"))
+
+                    for future in self._waiters.pop(key, []):
+                        if not future.done():
+                            future.set_result(message.get("params", {}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            error = CDPError("The connection to Chrome was closed")
+
+            for future in itertools.chain(
+                self._pending.values(), *self._waiters.values()
+            ):
+                if not future.done():
+                    future.set_exception(error)
+
+            self._waiters.clear()
+
+    async def close(self):
+        await self._websocket.close()
+        await self._reader
+
+
+class AsyncBrowser:
+    """
+    Loads pages in tabs of a single Chrome instance. Create it with launch() or
+    connect().
+
+    Parameters
+    ----------
+    connection : CDPConnection
+        Connection to the browser's websocket.
+
+    max_tabs : int, default=16
+        Maximum number of tabs open at once, open_page waits when they're all in use.
+    """
+
+    def __init__(self, connection, max_tabs=16, process=None, user_data_dir=None):
+        self._connection = connection
+        self._tabs = asyncio.Semaphore(max_tabs)
+        self._process = process
+        self._user_data_dir = user_data_dir
+
+    @classmethod
+    async def connect(cls, url="http://127.0.0.1:9222", max_tabs=16):
+        """Connect to a Chrome instance started with --remote-debugging-port."""
+        version = await asyncio.to_thread(_get_json, f"{url}/json/version")
+        connection = await CDPConnection.connect(version["webSocketDebuggerUrl"])
+        return cls(connection, max_tabs=max_tabs)
+
+    @classmethod
+    async def launch(cls, executable=None, headless=True, max_tabs=16, timeout=30):
+        """Start Chrome (with a temporary profile) and connect to it. close() quits
+        it."""
+        user_data_dir = tempfile.mkdtemp(prefix="aiwebscraper-chrome-")
+        args = [
+            executable or _find_chrome(),
+            # Chrome picks a free port and writes it to DevToolsActivePort
+            "--remote-debugging-port=0",
+            f"--user-data-dir={user_data_dir}",
+            "--no-first-run",
+            "--no-default-browser-check",
+        ]
+
+        if headless:
+            args.append("--headless")
+
+        # required for running as root in a container
+        if getpass.getuser() == "root":
+            args.append("--no-sandbox")
+
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+
+        try:
+            url = await cls._wait_for_websocket_url(process, user_data_dir, timeout)
+            connection = await CDPConnection.connect(url)
+        except BaseException:
+            process.kill()
+            await process.wait()
+            shutil.rmtree(user_data_dir, ignore_errors=True)
+            raise
+
+        return cls(
+            connection,
+            max_tabs=max_tabs,
+            process=process,
+            user_data_dir=user_data_dir,
+        )
+
+    @staticmethod
+    async def _wait_for_websocket_url(process, user_data_dir, timeout):
+        path = Path(user_data_dir, "DevToolsActivePort")
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            if process.returncode is not None:
+                raise CDPError(f"Chrome exited with code {process.returncode}")
+
+            # the file has the port and the browser's websocket path
+            lines = path.read_text().splitlines() if path.exists() else []
+
+            if len(lines) >= 2:
+                return f"ws://127.0.0.1:{lines[0]}{lines[1]}"
+
+            await asyncio.sleep(0.1)
+
+        raise TimeoutError(f"Chrome didn't start in {timeout} seconds")
+
+    async def open_page(self, url, timeout=30, load_profile="full"):
+        """Open a tab and load url, waiting if max_tabs are open. Close it with
+        AsyncPage.close(). load_profile is like Browser's (pages are loaded with the
+        "eager" strategy: open_page returns when the DOM is ready)."""
+        if load_profile not in LOAD_PROFILES:
+            raise ValueError(
+                f"load_profile must be 'full' or 'light', got {load_profile!r}"
+            )
+
+        await self._tabs.acquire()
+
+        try:
+            target = await self._connection.send(
+                "Target.createTarget", {"url": "about:blank"}
+            )
+            session = await self._connection.send(
+                "Target.attachToTarget",
+                {"targetId": target["targetId"], "flatten": True},
+            )
+        except BaseException:
+            self._tabs.release()
+            raise
+
+        page = AsyncPage(self, target["targetId"], session["sessionId"])
+
+        try:
+            if load_profile == "light":
+                await page.block_resources()
+
+            await page.goto(url, timeout=timeout)
+        except BaseException:
+            await page.close()
+            raise
+
+        return page
+
+    @asynccontextmanager
+    async def new_page(self, url, timeout=30, load_profile="full"):
+        """Open a tab, load url and close the tab when the block ends."""
+        page = await self.open_page(url, timeout=timeout, load_profile=load_profile)
+
+        try:
+            yield page
+        finally:
+            await page.close()
+
+    async def close(self):
+        """Close the connection (and quit Chrome if it was started by launch)."""
+        await self._connection.close()
+
+        if self._process is not None:
+            if self._process.returncode is None:
+                self._process.terminate()
+
+            await self._process.wait()
+            shutil.rmtree(self._user_data_dir, ignore_errors=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class AsyncPage:
+    """
+    A tab opened by AsyncBrowser. Elements are located with an XPath, or a list of
+    XPaths where each one is relative to the node the previous one matches.
+    """
+
+    def __init__(self, browser, target_id, session_id) -> None:
+        self._browser = browser
+        self._connection = browser._connection
+        self._target_id = target_id
+        self._session_id = session_id
+        self._closed = False
+
+    async def send(self, method, params=None):
+        """Send a command to the tab."""
+        return await self._connection.send(method, params, self._session_id)
+
+    async def block_resources(self):
+        """Block images, fonts, media and analytics, and disable CSS animations (the
+        "light" load profile)."""
+        await self.send("Network.enable")
+        await self.send("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+        await self.send(
+            "Page.addScriptToEvaluateOnNewDocument",
+            {"source": DISABLE_ANIMATIONS_SCRIPT},
+        )
+
+    async def goto(self, url, timeout=30):
+        """Load url, returning once the DOM is ready (use wait_for_element to wait
+        for content loaded afterwards)."""
+        await self.send("Page.enable")
+        loaded = self._connection.wait_for_event(
+            "Page.domContentEventFired", self._session_id
+        )
+        result = await self.send("Page.navigate", {"url": url})
+
+        if result.get("errorText"):
+            raise CDPError(f"Failed to load {url}: {result['errorText']}")
+
+        await asyncio.wait_for(loaded, timeout)
+
+    async def evaluate(self, body, *args):
+        """Run body as the body of an async function and return its result (which
+        must be JSON-serializable). The arguments are in args, and locate(locator)
+        and locateOrFail(locator) return the node matched by a locator."""
+        expression = (
+            f"(async (...args) => {{\n{LOCATE_FUNCTION}\n{body}\n}})"
+            f"(...{json.dumps(args)})"
+        )
+        result = await self.send(
+            "Runtime.evaluate",
+            {"expression": expression, "awaitPromise": True, "returnByValue": True},
+        )
+
+        if "exceptionDetails" in result:
+            details = result["exceptionDetails"]
+            exception = details.get("exception", {})
+            raise CDPError(exception.get("description") or details.get("text"))
+
+        return result["result"].get("value")
+
+    async def wait_for_element(
+        self, xpath, element_xpath=None, ready="stable", timeout=10
+    ):
+        """Wait for an element, like Browser.wait_for_element. If ready is a
+        callable, it receives the page and returns an awaitable."""
+        if not callable(ready) and ready not in {"present", "stable"}:
+            raise ValueError(
+                f"ready must be 'present', 'stable' or a callable, got {ready!r}"
+            )
+
+        locator = _to_locator(xpath, element_xpath)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        while not await self.evaluate("return locate(args[0]) !== null;", locator):
+            if loop.time() >= deadline:
+                raise TimeoutError(f"No element matches {locator} after {timeout}s")
+
+            await asyncio.sleep(0.1)
+
+        if ready == "stable":
+            await self.wait_until_stable(locator)
+        elif callable(ready):
+            while not await ready(self):
+                if loop.time() >= deadline:
+                    raise TimeoutError(f"The page wasn't ready after {timeout}s")
+
+                await asyncio.sleep(0.1)
+
+    async def wait_until_stable(
+        self, locator=None, quiet=QUIET_SECONDS, timeout=STABLE_TIMEOUT
+    ):
+        """Wait until the element (or the document if None) doesn't change, like
+        Browser.wait_until_stable."""
+        return await self.evaluate(
+            "const element = args[0] === null ? null : locateOrFail(args[0]);\n"
+            "return await new Promise((resolve) => (function () {\n"
+            f"{WAIT_UNTIL_STABLE_SCRIPT}\n"
+            "}).apply(null, [element, args[1], args[2], resolve]));",
+            None if locator is None else _to_locator(locator),
+            quiet * 1000,
+            timeout * 1000,
+        )
+
+    async def get_property(self, xpath, name, element_xpath=None):
+        """Return an element's property (or attribute if there's no such
+        property), like Selenium's WebElement.get_attribute."""
+        return await self.evaluate(
+            "const node = locateOrFail(args[0]);\n"
+            "const value = node[args[1]];\n"
+            "return value === undefined ? node.getAttribute(args[1]) : value;",
+            _to_locator(xpath, element_xpath),
+            name,
+        )
+
+    async def get_html(self, xpath, element_xpath=None):
+        """Return the element's innerHTML."""
+        return await self.get_property(xpath, "innerHTML", element_xpath)
+
+    async def count(self, xpath, element_xpath=None):
+        """Return the number of nodes matching xpath (relative to the element
+        matching element_xpath, or the document)."""
+        return await self.evaluate(
+            "const context = args[1] === null ? document : locateOrFail(args[1]);\n"
+            "return document.evaluate(\n"
+            "    args[0], context, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null\n"
+            ").snapshotLength;",
+            xpath,
+            None if element_xpath is None else _to_locator(element_xpath),
+        )
+
+    async def evaluate_xpaths(self, xpaths, element_xpath=None):
+        """Return the text of the elements matched by each XPath, like
+        Browser.evaluate_xpaths."""
+        values = await self.evaluate(
+            "const context = args[0] === null ? null : locateOrFail(args[0]);\n"
+            "return (function () {\n"
+            f"{EVALUATE_XPATHS_SCRIPT}\n"
+            "}).apply(null, [context, args[1]]);",
+            None if element_xpath is None else _to_locator(element_xpath),
+            list(xpaths.values()),
+        )
+        return dict(zip(xpaths, values))
+
+    async def close(self):
+        """Close the tab."""
+        if self._closed:
+            return
+
+        self._closed = True
+
+        try:
+            await self._connection.send(
+                "Target.closeTarget", {"targetId": self._target_id}
+            )
+        except CDPError:
+            # the browser was closed
+            pass
+        finally:
+            self._browser._tabs.release()
+
+
+async def get_from_xpaths_async(
+    browser: AsyncBrowser,
+    url,
+    element_xpath,
+    xpaths,
+    ready="stable",
+    load_profile="full",
+):
+    """Extract a table with the exported XPaths in a tab of browser (like
+    aiwebscraper.extract.get_from_xpaths)."""
+    async with browser.new_page(url, load_profile=load_profile) as page:
+        await page.wait_for_element(element_xpath or "//body", ready=ready)
+        return await page.evaluate_xpaths(xpaths, element_xpath)
+
+
+def _get_loop():
+    """Return the event loop (running in a daemon thread) used by CDPBrowser."""
+    global _loop
+
+    with _shared_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="aiwebscraper-cdp", daemon=True
+            ).start()
+
+        return _loop
+
+
+def _run(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_loop()).result()
+
+
+def get_shared_browser():
+    """Return the AsyncBrowser used by CDPBrowser (Chrome is launched on first use
+    and quit at exit)."""
+    global _shared_browser
+
+    loop = _get_loop()
+
+    with _shared_lock:
+        if _shared_browser is None:
+            _shared_browser = asyncio.run_coroutine_threadsafe(
+                AsyncBrowser.launch(), loop
+            ).result()
+
+        return _shared_browser
+
+
+@atexit.register
+def _close_shared_browser():
+    global _shared_browser
+
+    if _shared_browser is not None:
+        browser, _shared_browser = _shared_browser, None
+        _run(browser.close())
+
+
+class CDPElement:
+    """An element of a CDPBrowser page, with the WebElement methods WebScraper
+    uses."""
+
+    def __init__(self, browser, locator) -> None:
+        self._browser = browser
+        self.locator = locator
+
+    def get_attribute(self, name):
+        return _run(self._browser.page.get_property(self.locator, name))
+
+    @property
+    def text(self):
+        table = _run(self._browser.page.evaluate_xpaths({"text": "."}, self.locator))
+        return table["text"][0] if table["text"] else ""
+
+    def find_elements(self, by, value):
+        if by != By.XPATH:
+            raise ValueError("CDPElement only supports By.XPATH")
+
+        count = _run(self._browser.page.count(value, self.locator))
+        return [
+            CDPElement(self._browser, self.locator + [f"({value})[{i}]"])
+            for i in range(1, count + 1)
+        ]
+
+
+class CDPBrowser:
+    """
+    Loads a page in a tab of a Chrome instance shared by all the CDPBrowser objects
+    (see get_shared_browser), with the same interface as Browser. Call quit() (or
+    use it as a context manager) to close the tab.
+
+    Parameters
+    ----------
+    url : str
+        The page to load.
+
+    jitter : tuple, default=None
+        (low, high) seconds to wait randomly before looking for elements.
+
+    browser : AsyncBrowser, default=None
+        Open the tab in this browser instead of the shared one (it must run in the
+        event loop returned by _get_loop).
+
+    load_profile : str, default="full"
+        See Browser.
+    """
+
+    def __init__(self, url, jitter=None, browser=None, load_profile="full") -> None:
+        self.jitter = jitter
+        self.page = None
+        self.page = _run(
+            (browser or get_shared_browser()).open_page(url, load_profile=load_profile)
+        )
+
+    def wait_for_element(self, xpath, ready="stable", timeout=10):
+        """Wait for an element and return it, see Browser.wait_for_element. If ready
+        is a callable, it receives this object."""
+        self.wait_jitter()
+
+        if callable(ready):
+            sync_ready = ready
+
+            async def ready(page):
+                return await asyncio.to_thread(sync_ready, self)
+
+        _run(self.page.wait_for_element(xpath, ready=ready, timeout=timeout))
+        return CDPElement(self, [xpath])
+
+    def evaluate_xpaths(self, xpaths, element=None):
+        """Return the text of the elements matched by each XPath, see
+        Browser.evaluate_xpaths."""
+        return _run(
+            self.page.evaluate_xpaths(
+                xpaths, None if element is None else element.locator
+            )
+        )
+
+    def wait_jitter(self):
+        if self.jitter is not None:
+            self.wait_randomly(*self.jitter)
+
+    def wait_randomly(self, low=1, high=2):
+        time.sleep(random.uniform(low, high))
+
+    def quit(self):
+        """Close the tab."""
+        page, self.page = self.page, None
+
+        if page is not None:
+            _run(page.close())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.quit()
+
+    def __del__(self):
+        if getattr(self, "page", None) is not None:
+            self.quit()
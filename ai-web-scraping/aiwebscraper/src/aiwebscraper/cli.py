@@ -4,6 +4,9 @@ import json
 import click
 import pandas as pd
 
+from aiwebscraper.batch import load_jobs, make_writer, run_batch
+from aiwebscraper.browser import BrowserPool, set_browser_pool
+from aiwebscraper.cache import report
 from aiwebscraper.extract import (
     WebScraper,
     ParsedTable,
@@ -19,13 +22,22 @@ def cli():
 
 @cli.command()
 @click.argument("json_file", type=click.Path(exists=True))
-def fromresult(json_file):
+@click.option(
+    "--engine",
+    type=click.Choice(["auto", "static", "browser"]),
+    default="auto",
+    help="Fetch the page over HTTP (static), with Chrome (browser), or try HTTP "
+    "first and use Chrome if the table is incomplete (auto)",
+)
+def fromresult(json_file, engine):
     """Process a JSON file."""
     try:
         with open(json_file, "r") as file:
             data = json.load(file)
 
-        table = get_from_xpaths(data["url"], data["element_xpath"], data["xpaths"])
+        table = get_from_xpaths(
+            data["url"], data["element_xpath"], data["xpaths"], engine=engine
+        )
         click.echo(table)
 
     except json.JSONDecodeError:
@@ -48,21 +60,36 @@ def fromresult(json_file):
     default=None,
     help="Output file to save the results",
 )
-def scrape(url, element_xpath, output):
+@click.option(
+    "--single-request",
+    is_flag=True,
+    default=False,
+    help="Request the XPaths of all columns at once",
+)
+@click.option(
+    "--max-tokens",
+    type=int,
+    default=None,
+    help="Extract large tables concurrently in chunks of about this many tokens",
+)
+def scrape(url, element_xpath, output, single_request, max_tokens):
     """Scrape data from a given URL."""
 
-    scraper = WebScraper(url, element_xpath)
-    parsed_table: ParsedTable = scraper.extract_table_data()
+    with WebScraper(url, element_xpath) as scraper:
+        parsed_table: ParsedTable = scraper.extract_table_data(max_tokens=max_tokens)
 
-    click.echo(f"Successfully scraped data from {url}")
+        click.echo(f"Successfully scraped data from {url}")
 
-    for name, values in parsed_table.items():
-        click.echo(f"Column: {name}")
-        click.echo(f"Values: {', '.join(values[:5])}...")
+        for name, values in parsed_table.items():
+            click.echo(f"Column: {name}")
+            click.echo(f"Values: {', '.join(values[:5])}...")
 
-    if output:
-        data = get_data_with_scraper(scraper, parsed_table)
+        if output:
+            data = get_data_with_scraper(
+                scraper, parsed_table, single_request=single_request
+            )
 
+    if output:
         # TODO: maybe try with the mini model here?
         table = get_from_xpaths(data["url"], data["element_xpath"], data["xpaths"])
 
@@ -73,3 +100,106 @@ def scrape(url, element_xpath, output):
             json.dump(data, file)
 
         click.echo(f"XPaths saved to {output}")
+
+
+@cli.command()
+@click.argument("path_to_db", type=click.Path(exists=True))
+@click.option(
+    "--price-per-million-tokens",
+    type=float,
+    default=0.15,
+    help="Price of the model's input tokens, to estimate the dollars saved",
+)
+def cachereport(path_to_db, price_per_million_tokens):
+    """Report the hit rate and estimated savings of each cached function."""
+    rows = report(path_to_db, price_per_million_tokens=price_per_million_tokens)
+
+    if not rows:
+        click.echo(f"No cached functions in {path_to_db}")
+        return
+
+    df = pd.DataFrame(rows).set_index("function")
+    click.echo(df.to_string())
+
+
+@cli.command()
+@click.argument("source", type=click.Path(exists=True))
+@click.option(
+    "--output",
+    "-o",
+    type=click.Path(),
+    required=True,
+    help="JSON Lines file (or directory of Parquet files) to append the results to",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["jsonl", "parquet"]),
+    default=None,
+    help="Output format (default: parquet if the output ends with .parquet, jsonl "
+    "otherwise)",
+)
+@click.option("--workers", type=int, default=4, help="Number of jobs to run at once")
+@click.option(
+    "--min-interval",
+    type=float,
+    default=1.0,
+    help="Minimum seconds between the requests to the same domain",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["auto", "static", "browser"]),
+    default="auto",
+    help="How to fetch the pages of exported scrapers, see fromresult",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(["selenium", "cdp"]),
+    default="selenium",
+    help="Browser to use when a page needs one",
+)
+@click.option(
+    "--no-resume",
+    is_flag=True,
+    default=False,
+    help="Run all the jobs, even the ones that already succeeded in the output",
+)
+def batch(
+    source, output, output_format, workers, min_interval, engine, backend, no_resume
+):
+    """Run the exported scrapers in a directory of JSON files, or scrape the URLs in
+    a manifest (one per line, optionally followed by the element's XPath).
+
+    The results are appended to the output as they finish. Running the command
+    again skips the jobs that already succeeded.
+    """
+    jobs = load_jobs(source)
+
+    if backend == "selenium":
+        # one driver per worker
+        set_browser_pool(BrowserPool(size=workers))
+
+    def echo(result):
+        if result["status"] == "ok":
+            click.echo(f"Finished {result['id']}")
+        else:
+            click.echo(f"Failed {result['id']}: {result['error']}", err=True)
+
+    counts = run_batch(
+        jobs,
+        make_writer(output, output_format),
+        workers=workers,
+        min_interval=min_interval,
+        resume=not no_resume,
+        engine=engine,
+        backend=backend,
+        callback=echo,
+    )
+
+    click.echo(
+        f"{counts['ok']} succeeded, {counts['error']} failed, "
+        f"{counts['skipped']} skipped (already in {output})"
+    )
+
+    if counts["error"]:
+        sys.exit(1)
@@ -1,19 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Dict
 import json
+import logging
+import threading
 
+import lxml.etree
+import lxml.html
+import requests
 from openai import OpenAI
 from pydantic import BaseModel
 from selenium.webdriver.common.by import By
 from tenacity import retry, stop_after_attempt
 from bs4 import BeautifulSoup
 
-from aiwebscraper.browser import Browser
+from aiwebscraper.browser import Browser, get_browser_pool
 
 from aiwebscraper.cache import FunctionCache
 from aiwebscraper import get_openai_key, get_openai_model
 
 
+logger = logging.getLogger(__name__)
+
+# sent when fetching pages without the browser, since some sites reject requests
+# from clients that don't look like one
+USER_AGENT = (
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/129.0.0.0 Safari/537.36"
+)
+
+# rough number of characters per token of HTML, to split pages into chunks
+CHARS_PER_TOKEN = 4
+
+# elements that start a new line in the text, like the browser's innerText
+# fmt: off
+BLOCK_TAGS = frozenset(
+    [
+        "address", "article", "aside", "blockquote", "caption", "dd", "details",
+        "dialog", "div", "dl", "dt", "fieldset", "figcaption", "figure", "footer",
+        "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main",
+        "nav", "ol", "p", "pre", "section", "summary", "table", "tbody", "tfoot",
+        "thead", "tr", "ul",
+    ]
+)
+# fmt: on
+# elements whose content isn't rendered
+HIDDEN_TAGS = frozenset(["head", "noscript", "script", "style", "template", "title"])
+# table cells are separated by a tab in innerText, which becomes a space
+CELL_TAGS = frozenset(["td", "th"])
+
+
 class ParsedColumn(BaseModel):
     name: str
     values: List[str]
@@ -29,6 +65,10 @@ class ColumnXPath(BaseModel):
     xpath: str
 
 
+class ColumnXPaths(BaseModel):
+    columns: List[ColumnXPath]
+
+
 def find_root_dir(max_levels=5):
     current_dir = Path.cwd()
 
@@ -71,8 +111,30 @@ def chat_completion_parsed_table(*, model, messages):
 chat_completion_parsed_table_cached = chat_completion_parsed_table
 
 
-def extract_table_data(html_content: str) -> ParsedTable:
-    """Extracts the table data from the HTML content."""
+def extract_table_data(
+    html_content: str, max_tokens: int = None, max_workers: int = 4
+) -> ParsedTable:
+    """Extracts the table data from the HTML content.
+
+    If max_tokens is given and the HTML is longer, it's split at row boundaries
+    into chunks of about max_tokens tokens (see split_html_rows), which are
+    extracted concurrently (using up to max_workers threads) and merged in order.
+    """
+    if max_tokens is not None:
+        chunks = split_html_rows(html_content, max_tokens)
+
+        if len(chunks) > 1:
+            logger.info(f"Extracting the table in {len(chunks)} chunks")
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                tables = list(executor.map(_extract_table_data, chunks))
+
+            return merge_tables(tables)
+
+    return _extract_table_data(html_content)
+
+
+def _extract_table_data(html_content: str) -> ParsedTable:
 
     SYS_PROMPT = """
 You're an expert web scraper. You're given the HTML contents of a table and you
@@ -102,6 +164,113 @@ of rows.
     return table
 
 
+def _is_header_row(row) -> bool:
+    return row.find("th") is not None and row.find("td") is None
+
+
+def split_html_rows(html_content: str, max_tokens: int) -> List[str]:
+    """Splits the HTML into chunks of about max_tokens tokens (CHARS_PER_TOKEN
+    characters per token) at row boundaries.
+
+    The rows are the <tr> elements of the table section (tbody, thead or table)
+    with the most of them or, if there are no <tr> elements, the children of the
+    element with the most children. Each chunk is the whole HTML with a subset of
+    the rows, so the captions and headers outside of them are kept, and the leading
+    rows with only th cells are repeated in every chunk. A row longer than
+    max_tokens is kept in a chunk of its own.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+
+    if len(html_content) <= max_chars:
+        return [html_content]
+
+    soup = BeautifulSoup(html_content, "html.parser")
+    parents = {id(tr.parent): tr.parent for tr in soup.find_all("tr")}
+
+    if parents:
+        container = max(
+            parents.values(),
+            key=lambda element: len(element.find_all("tr", recursive=False)),
+        )
+        rows = container.find_all("tr", recursive=False)
+    else:
+        container = max(
+            [soup, *soup.find_all(True)],
+            key=lambda element: len(element.find_all(True, recursive=False)),
+        )
+        rows = container.find_all(True, recursive=False)
+
+    header = []
+
+    while len(header) < len(rows) and _is_header_row(rows[len(header)]):
+        header.append(rows[len(header)])
+
+    rows = rows[len(header) :]
+
+    if not rows:
+        return [html_content]
+
+    # the rows are put back in the same place, after anything that precedes them
+    # in the container (e.g., a caption). Tags compare equal if they have the same
+    # markup, so we look for the first row by identity
+    first = header[0] if header else rows[0]
+    position = next(i for i, child in enumerate(container.contents) if child is first)
+
+    for row in header + rows:
+        row.extract()
+
+    def render(chunk):
+        for offset, row in enumerate(header + chunk):
+            container.insert(position + offset, row)
+
+        html = str(soup)
+
+        for row in header + chunk:
+            row.extract()
+
+        return html
+
+    base_size = len(render([]))
+    groups, current, size = [], [], base_size
+
+    for row in rows:
+        row_size = len(str(row))
+
+        if current and size + row_size > max_chars:
+            groups.append(current)
+            current, size = [], base_size
+
+        current.append(row)
+        size += row_size
+
+    if current:
+        groups.append(current)
+
+    return [render(group) for group in groups]
+
+
+def merge_tables(tables: List[Dict[str, List[str]]]) -> Dict[str, List[str]]:
+    """Concatenates the columns of the tables extracted from consecutive chunks. A
+    column missing from a chunk is filled with empty strings so the columns stay
+    aligned."""
+    merged = {}
+    length = 0
+
+    for table in tables:
+        rows = max((len(values) for values in table.values()), default=0)
+
+        for name in table:
+            merged.setdefault(name, [""] * length)
+
+        for name, values in merged.items():
+            chunk_values = list(table.get(name, []))
+            values.extend(chunk_values + [""] * (rows - len(chunk_values)))
+
+        length += rows
+
+    return merged
+
+
 def get_xpath_for_column(
     html_content: str,
     extracted_values: List[str],
@@ -154,6 +323,52 @@ def get_xpath_for_column(
     return parsed
 
 
+def get_xpaths_for_columns(
+    html_content: str,
+    data: Dict[str, List[str]],
+) -> List[ColumnXPath]:
+    """Gets the XPaths for all the columns in a single request, so the HTML content
+    is only sent once."""
+
+    SYS_PROMPT = """
+    You're an expert web scraper.
+
+    The user will provide the HTML content and the extracted values of each column in
+    JSON format. Your job is to come up with an XPath for each column that will return
+    all elements of that column.
+
+    The XPaths should be strings that can be evaluated by Selenium's
+    `driver.find_elements(By.XPATH, xpath)` method.
+
+    Return the full matching elements, not just the text. Return one XPath per column,
+    using the column names exactly as given.
+    """
+    client = OpenAI(api_key=get_openai_key())
+
+    completion = client.beta.chat.completions.parse(
+        model=get_openai_model(),
+        messages=[
+            {
+                "role": "system",
+                "content": SYS_PROMPT,
+            },
+            {
+                "role": "user",
+                "content": "The HTML content is: " + html_content,
+            },
+            {
+                "role": "user",
+                "content": "The extracted values of each column in JSON format are: "
+                + json.dumps(data),
+            },
+        ],
+        response_format=ColumnXPaths,
+    )
+
+    parsed = completion.choices[0].message.parsed
+    return parsed.columns
+
+
 def clean_html(html_content: str) -> str:
     # Parse the HTML
     soup = BeautifulSoup(html_content, "html.parser")
@@ -177,28 +392,84 @@ def clean_html(html_content: str) -> str:
     return cleaned_html
 
 
+def _open_browser(url, backend, pool=None, jitter=None, load_profile="light"):
+    if backend == "selenium":
+        return Browser(
+            url,
+            pool=pool or get_browser_pool(),
+            jitter=jitter,
+            load_profile=load_profile,
+        )
+    elif backend == "cdp":
+        # imported here so websockets is only required for this backend
+        from aiwebscraper.cdp import CDPBrowser
+
+        return CDPBrowser(url, jitter=jitter, load_profile=load_profile)
+    else:
+        raise ValueError(f"backend must be 'selenium' or 'cdp', got {backend!r}")
+
+
 class WebScraper:
     """
-    Scrapes a website and extracts data from it.
+    Scrapes a website and extracts data from it. The browser is taken from pool (the
+    one returned by get_browser_pool by default), call close() (or use it as a
+    context manager) to return it.
+
+    ready and jitter control how long to wait for the element, see
+    Browser.wait_for_element and Browser. load_profile="light" (the default) blocks
+    the resources that aren't needed to read the HTML, see Browser.
+
+    backend is "selenium" or "cdp" to load the page in a tab of a Chrome instance
+    shared by all the WebScraper objects, driven with the DevTools Protocol (see
+    aiwebscraper.cdp; pool is ignored).
     """
 
-    def __init__(self, url: str, element_xpath: str):
+    def __init__(
+        self,
+        url: str,
+        element_xpath: str,
+        pool=None,
+        ready="stable",
+        jitter=None,
+        backend="selenium",
+        load_profile="light",
+    ):
         self.url = url
         self.element_xpath = element_xpath
+        # the driver isn't thread-safe, so only one thread at a time can use it
+        self.browser_lock = threading.Lock()
 
-        self.browser = Browser(url)
-        self.browser.wait_randomly(2, 3)
+        self.browser = _open_browser(
+            url, backend, pool=pool, jitter=jitter, load_profile=load_profile
+        )
 
-        if element_xpath is None:
-            self.body_element = self.browser.find_element_by_xpath("//body")
-        else:
-            self.body_element = self.browser.find_element_by_xpath(element_xpath)
+        try:
+            self.body_element = self.browser.wait_for_element(
+                element_xpath or "//body", ready=ready
+            )
+
+            # maybe remove all script tags?
+            self.html_content = clean_html(self.body_element.get_attribute("innerHTML"))
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """Return the browser to the pool."""
+        self.browser.quit()
 
-        # maybe remove all script tags?
-        self.html_content = clean_html(self.body_element.get_attribute("innerHTML"))
+    def __enter__(self):
+        return self
 
-    def extract_table_data(self) -> ParsedTable:
-        return extract_table_data(self.html_content)
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def extract_table_data(self, max_tokens=None, max_workers=4) -> ParsedTable:
+        """Extract the table, in chunks of about max_tokens tokens if given (see
+        extract_table_data)."""
+        return extract_table_data(
+            self.html_content, max_tokens=max_tokens, max_workers=max_workers
+        )
 
     def extract_xpath_for_column(
         self, values: List[str], column_name: str
@@ -209,32 +480,227 @@ class WebScraper:
             values,
             column_name,
         )
-        elements = self.body_element.find_elements(By.XPATH, parsed.xpath)
+
+        with self.browser_lock:
+            elements = self.body_element.find_elements(By.XPATH, parsed.xpath)
+
         return parsed.xpath, elements
 
+    def extract_xpaths_for_columns(self, data: Dict[str, List[str]]) -> Dict:
+        """Get the XPaths of all the columns with a single request. Returns a
+        dictionary with the XPath and the elements it returns for each column (columns
+        missing in the response are left out)."""
+        columns = get_xpaths_for_columns(self.html_content, data)
+        results = {}
 
-def get_from_xpaths(url, element_xpath, xpaths: Dict[str, str]) -> ParsedTable:
-    browser = Browser(url)
-    browser.wait_randomly(2, 3)
+        with self.browser_lock:
+            for column in columns:
+                if column.name in data and column.name not in results:
+                    elements = self.body_element.find_elements(By.XPATH, column.xpath)
+                    results[column.name] = (column.xpath, elements)
 
-    if element_xpath is None:
-        body_element = browser.find_element_by_xpath("//body")
-    else:
-        body_element = browser.find_element_by_xpath(element_xpath)
+        return results
+
+
+def get_from_html(html: str, element_xpath, xpaths: Dict[str, str]) -> ParsedTable:
+    """Evaluates the XPaths on the HTML with lxml (without a browser). XPaths that
+    are invalid or don't return nodes return no values."""
+    tree = lxml.html.fromstring(html)
+    context = tree
+
+    if element_xpath is not None:
+        matches = tree.xpath(element_xpath)
+
+        if not matches:
+            return {name: [] for name in xpaths}
+
+        context = matches[0]
 
     table = {}
 
     for name, xpath in xpaths.items():
-        elements = body_element.find_elements(By.XPATH, xpath)
-        values = [element.text for element in elements]
-        table[name] = values
+        try:
+            nodes = context.xpath(xpath)
+        except lxml.etree.XPathError:
+            nodes = []
+
+        # XPaths like count(...) return a single value, Selenium rejects them
+        if not isinstance(nodes, list):
+            nodes = []
+
+        table[name] = [_node_text(node) for node in nodes]
+
+    return table
+
+
+def _node_text(node) -> str:
+    if isinstance(node, lxml.etree._Element):
+        parts = []
+        _collect_visible_text(node, parts)
+        text = "".join(parts)
+    else:
+        # text() and @attribute XPaths return strings
+        text = str(node)
+
+    return _normalize_text(text)
+
+
+def _is_hidden(element) -> bool:
+    style = element.get("style", "").replace(" ", "").lower()
+    return (
+        element.tag in HIDDEN_TAGS
+        or element.get("hidden") is not None
+        or "display:none" in style
+    )
+
+
+def _collect_visible_text(element, parts):
+    """Append the text the browser renders for element (approximating innerText)
+    to parts: newlines at <br> and around block elements, and a space between
+    table cells."""
+    if not isinstance(element.tag, str) or _is_hidden(element):
+        return
+
+    tag = element.tag.lower()
+
+    if tag == "br":
+        parts.append("\n")
+        return
+
+    separator = "\n" if tag in BLOCK_TAGS else " " if tag in CELL_TAGS else ""
+    parts.append(separator)
+
+    if element.text:
+        parts.append(element.text)
+
+    for child in element:
+        _collect_visible_text(child, parts)
+
+        # the tail is text that follows the child, inside element
+        if child.tail:
+            parts.append(child.tail)
+
+    parts.append(separator)
+
+
+def _normalize_text(text: str) -> str:
+    """Collapse the whitespace in each line and remove empty lines, like the
+    browser engine does with innerText (see browser.EVALUATE_XPATHS_SCRIPT)."""
+    lines = (" ".join(line.split()) for line in text.split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+def get_from_xpaths_static(
+    url, element_xpath, xpaths: Dict[str, str], timeout: float = 10
+) -> ParsedTable:
+    """Fetches the page over HTTP (so JavaScript doesn't run) and evaluates the
+    XPaths with lxml."""
+    response = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=timeout)
+    response.raise_for_status()
+    # pass the bytes so lxml uses the encoding declared in the page
+    return get_from_html(response.content, element_xpath, xpaths)
+
+
+def _is_complete(table: ParsedTable) -> bool:
+    lengths = {len(values) for values in table.values()}
+    return len(lengths) == 1 and 0 not in lengths
+
+
+def get_from_xpaths(
+    url,
+    element_xpath,
+    xpaths: Dict[str, str],
+    engine: str = "auto",
+    ready="stable",
+    jitter=None,
+    backend="selenium",
+    load_profile="light",
+) -> ParsedTable:
+    """Extracts the table with the exported XPaths.
+
+    Parameters
+    ----------
+    engine : str, default="auto"
+        "static" fetches the page over HTTP and evaluates the XPaths with lxml,
+        "browser" loads it in Chrome, and "auto" tries "static" first and uses the
+        browser if the request fails, the response can't be parsed (e.g., it's
+        empty), or a column is empty or the columns have different lengths (e.g.,
+        the table is rendered with JavaScript).
+
+    ready, jitter
+        How long to wait for the element when using the browser, see
+        Browser.wait_for_element and Browser.
+
+    backend : str, default="selenium"
+        The browser to use, see WebScraper.
+
+    load_profile : str, default="light"
+        Resources to load when using the browser, see Browser (the default blocks
+        images, fonts, media and analytics since we only read the text).
+    """
+    if engine not in {"auto", "static", "browser"}:
+        raise ValueError(
+            f"engine must be 'auto', 'static' or 'browser', got {engine!r}"
+        )
+
+    if engine != "browser":
+        try:
+            table = get_from_xpaths_static(url, element_xpath, xpaths)
+        except (
+            requests.RequestException,
+            lxml.etree.ParserError,
+            lxml.etree.XMLSyntaxError,
+        ):
+            if engine == "static":
+                raise
+
+            logger.info(
+                f"Failed to fetch or parse {url} without the browser", exc_info=True
+            )
+        else:
+            if engine == "static" or _is_complete(table):
+                return table
+
+            logger.info(f"Incomplete table without the browser, loading {url}")
+
+    with _open_browser(
+        url, backend, jitter=jitter, load_profile=load_profile
+    ) as browser:
+        body_element = browser.wait_for_element(element_xpath or "//body", ready=ready)
+
+        # a single round-trip to the driver for all the columns and rows
+        table = browser.evaluate_xpaths(xpaths, body_element)
 
     return table
 
 
-def get_data_with_scraper(scraper: WebScraper, data: Dict[str, List[str]]) -> Dict:
+def get_data_with_scraper(
+    scraper: WebScraper,
+    data: Dict[str, List[str]],
+    max_workers: int = 4,
+    single_request: bool = False,
+) -> Dict:
+    """Find the XPath of each column. The columns are requested concurrently (using
+    up to max_workers threads), and each one is retried up to three times if its
+    XPath doesn't return any elements.
+
+    If single_request is True, the XPaths of all columns are requested at once
+    first, so the HTML is sent once instead of once per column. Only the columns
+    whose XPath doesn't return any elements are requested separately.
+    """
     xpaths = {}
 
+    if single_request:
+        try:
+            results = scraper.extract_xpaths_for_columns(data)
+        except Exception:
+            logger.exception("Failed to get the XPaths of all columns at once")
+            results = {}
+
+        xpaths = {
+            name: xpath for name, (xpath, elements) in results.items() if elements
+        }
+
     @retry(stop=stop_after_attempt(3))
     def extract_xpath_for_column(values, name):
         xpath, results = scraper.extract_xpath_for_column(values, name)
@@ -244,17 +710,31 @@ def get_data_with_scraper(scraper: WebScraper, data: Dict[str, List[str]]) -> Di
 
         return xpath, results
 
-    for name, values in data.items():
-        xpath, _ = extract_xpath_for_column(values, name)
-        xpaths[name] = xpath
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            name: executor.submit(extract_xpath_for_column, values, name)
+            for name, values in data.items()
+            if name not in xpaths
+        }
+        xpaths.update({name: future.result()[0] for name, future in futures.items()})
 
     return {
         "url": scraper.url,
         "element_xpath": scraper.element_xpath,
-        "xpaths": xpaths,
+        "xpaths": {name: xpaths[name] for name in data},
     }
 
 
-def get_data(*, url, element_xpath, xpaths: Dict[str, str]) -> Dict:
-    scraper = WebScraper(url, element_xpath)
-    return get_data_with_scraper(scraper, xpaths)
+def get_data(
+    *,
+    url,
+    element_xpath,
+    xpaths: Dict[str, str],
+    max_workers=4,
+    single_request=False,
+    backend="selenium",
+) -> Dict:
+    with WebScraper(url, element_xpath, backend=backend) as scraper:
+        return get_data_with_scraper(
+            scraper, xpaths, max_workers=max_workers, single_request=single_request
+        )
@@ -0,0 +1,156 @@
+import json
+import threading
+import time
+
+import pytest
+
+from aiwebscraper import batch
+
+
+@pytest.fixture
+def scrapers(tmp_path):
+    directory = tmp_path / "scrapers"
+    directory.mkdir()
+
+    for name, url in [
+        ("a.json", "https://a.com/1"),
+        ("b.json", "https://a.com/2"),
+        ("c.json", "https://b.com/1"),
+    ]:
+        scraper = {"url": url, "element_xpath": "//table", "xpaths": {"x": "//td"}}
+        (directory / name).write_text(json.dumps(scraper))
+
+    return directory
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    def get_from_xpaths(url, element_xpath, xpaths, engine, backend):
+        calls.append(url)
+
+        if url.endswith("fail"):
+            raise ValueError("no table")
+
+        return {"x": [url]}
+
+    monkeypatch.setattr(batch, "get_from_xpaths", get_from_xpaths)
+    return calls
+
+
+def test_load_jobs_from_manifest(tmp_path):
+    manifest = tmp_path / "urls.txt"
+    manifest.write_text(
+        "# comment\nhttps://a.com\n\nhttps://b.com //div[@class='a b']\n"
+    )
+
+    assert batch.load_jobs(manifest) == [
+        {
+            "id": "https://a.com",
+            "url": "https://a.com",
+            "element_xpath": None,
+            "xpaths": None,
+        },
+        {
+            "id": "https://b.com //div[@class='a b']",
+            "url": "https://b.com",
+            "element_xpath": "//div[@class='a b']",
+            "xpaths": None,
+        },
+    ]
+
+
+def test_interleave_by_domain(scrapers):
+    jobs = batch._interleave_by_domain(batch.load_jobs(scrapers))
+
+    assert [job["url"] for job in jobs] == [
+        "https://a.com/1",
+        "https://b.com/1",
+        "https://a.com/2",
+    ]
+
+
+def test_rate_limiter_spaces_requests_to_the_same_domain():
+    limiter = batch.DomainRateLimiter(min_interval=0.2)
+    started = {}
+
+    def request(url):
+        limiter.wait(url)
+        started[url] = time.monotonic()
+
+    threads = [
+        threading.Thread(target=request, args=(url,))
+        for url in ["https://a.com/1", "https://a.com/2", "https://b.com/1"]
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert abs(started["https://a.com/2"] - started["https://a.com/1"]) >= 0.19
+    assert abs(started["https://b.com/1"] - started["https://a.com/1"]) < 0.1
+
+
+def test_run_batch_resumes(tmp_path, scrapers, calls):
+    output = tmp_path / "results.jsonl"
+    (scrapers / "d.json").write_text(
+        json.dumps({"url": "https://c.com/fail", "element_xpath": None, "xpaths": {}})
+    )
+
+    counts = batch.run_batch(
+        batch.load_jobs(scrapers), batch.make_writer(output), min_interval=0
+    )
+
+    assert counts == {"ok": 3, "error": 1, "skipped": 0}
+
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert {record["id"]: record["status"] for record in records} == {
+        "a.json": "ok",
+        "b.json": "ok",
+        "c.json": "ok",
+        "d.json": "error",
+    }
+    assert {"x": ["https://b.com/1"]} in [record["table"] for record in records]
+
+    # simulate a crash while writing a result
+    with open(output, "a") as file:
+        file.write('{"id": "e.js')
+
+    calls.clear()
+    counts = batch.run_batch(
+        batch.load_jobs(scrapers), batch.make_writer(output), min_interval=0
+    )
+
+    # only the failed job runs again
+    assert calls == ["https://c.com/fail"]
+    assert counts == {"ok": 0, "error": 1, "skipped": 3}
+    assert len(output.read_text().splitlines()) == 5
+
+
+def test_run_batch_parquet(tmp_path, scrapers, calls):
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+    output = tmp_path / "results.parquet"
+
+    writer = batch.ParquetWriter(output, flush_every=2)
+    counts = batch.run_batch(batch.load_jobs(scrapers), writer, min_interval=0)
+
+    assert counts == {"ok": 3, "error": 0, "skipped": 0}
+    assert len(list(output.glob("part-*.parquet"))) == 2
+
+    df = pd.read_parquet(output)
+    assert sorted(df["id"]) == ["a.json", "b.json", "c.json"]
+    assert json.loads(df.set_index("id").loc["c.json", "table"]) == {
+        "x": ["https://b.com/1"]
+    }
+
+    calls.clear()
+    counts = batch.run_batch(
+        batch.load_jobs(scrapers), batch.make_writer(output), min_interval=0
+    )
+
+    assert calls == []
+    assert counts == {"ok": 0, "error": 0, "skipped": 3}
@@ -0,0 +1,206 @@
+import threading
+
+import pytest
+from selenium.common.exceptions import WebDriverException
+
+from aiwebscraper import browser
+from aiwebscraper.browser import Browser, BrowserPool
+
+
+class FakeDriver:
+    def __init__(self):
+        self.urls = []
+        self.window_handles = ["main"]
+        self.healthy = True
+        self.quit_called = False
+        self.switch_to = self
+        self.async_scripts = []
+        self.cdp_commands = []
+
+    def get(self, url):
+        self.urls.append(url)
+
+    def window(self, handle):
+        pass
+
+    def close(self):
+        self.window_handles.pop()
+
+    def execute_script(self, script, *args):
+        if not self.healthy:
+            raise WebDriverException("chrome not reachable")
+
+        if script == browser.EVALUATE_XPATHS_SCRIPT:
+            _, xpaths = args
+            return [[f"{xpath} text"] for xpath in xpaths]
+
+        return 1
+
+    def quit(self):
+        self.quit_called = True
+
+    def execute_cdp_cmd(self, command, params):
+        self.cdp_commands.append((command, params))
+        return {"identifier": "1"}
+
+    def find_element(self, by, value):
+        return f"element {value}"
+
+    def execute_async_script(self, script, *args):
+        self.async_scripts.append((script, args))
+        return True
+
+
+@pytest.fixture
+def drivers(monkeypatch):
+    drivers = []
+
+    def make_driver(connect_to_existing=False, page_load_strategy="normal"):
+        driver = FakeDriver()
+        drivers.append(driver)
+        return driver
+
+    monkeypatch.setattr(browser, "_make_driver", make_driver)
+    return drivers
+
+
+def test_pool_reuses_drivers(drivers):
+    pool = BrowserPool(size=2)
+
+    with Browser("https://example.com/1", pool=pool) as first:
+        first.driver.window_handles.append("popup")
+
+    with Browser("https://example.com/2", pool=pool):
+        pass
+
+    assert len(drivers) == 1
+    # the tab is reset before reusing the driver
+    assert drivers[0].urls == [
+        "https://example.com/1",
+        "about:blank",
+        "https://example.com/2",
+        "about:blank",
+    ]
+    assert drivers[0].window_handles == ["main"]
+
+
+def test_pool_recycles_drivers(drivers):
+    pool = BrowserPool(size=1, max_pages=2)
+
+    for i in range(3):
+        with Browser(f"https://example.com/{i}", pool=pool):
+            pass
+
+    assert len(drivers) == 2
+    assert drivers[0].quit_called
+    assert not drivers[1].quit_called
+
+
+def test_pool_replaces_unhealthy_drivers(drivers):
+    pool = BrowserPool(size=1)
+
+    with Browser("https://example.com/1", pool=pool) as first:
+        first.driver.healthy = False
+
+    with Browser("https://example.com/2", pool=pool) as second:
+        assert second.driver is drivers[1]
+
+    assert drivers[0].quit_called
+
+
+def test_pool_waits_for_a_driver(drivers):
+    pool = BrowserPool(size=1)
+    first = Browser("https://example.com/1", pool=pool)
+    acquired = threading.Event()
+
+    def use_pool():
+        with Browser("https://example.com/2", pool=pool):
+            acquired.set()
+
+    thread = threading.Thread(target=use_pool)
+    thread.start()
+
+    assert not acquired.wait(timeout=0.1)
+
+    first.quit()
+    thread.join(timeout=5)
+
+    assert acquired.is_set()
+    assert len(drivers) == 1
+
+
+def test_close_quits_drivers_in_use(drivers):
+    pool = BrowserPool(size=2)
+    browser_in_use = Browser("https://example.com", pool=pool)
+
+    pool.close()
+
+    assert drivers[0].quit_called
+
+    with pytest.raises(RuntimeError):
+        Browser("https://example.com", pool=pool)
+
+    browser_in_use.quit()
+
+
+def test_evaluate_xpaths(drivers):
+    with Browser("https://example.com", pool=BrowserPool()) as page:
+        table = page.evaluate_xpaths({"2": "//td[2]", "1": "//td[1]"})
+
+    # in the same order, even if the names look like numbers
+    assert list(table.items()) == [("2", ["//td[2] text"]), ("1", ["//td[1] text"])]
+
+
+def test_wait_for_element(drivers, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(browser.time, "sleep", sleeps.append)
+
+    with Browser("https://example.com", pool=BrowserPool()) as page:
+        element = page.wait_for_element("//table")
+        page.wait_for_element("//table", ready="present")
+        page.wait_for_element("//table", ready=lambda driver: driver.urls)
+
+    assert element == "element //table"
+    # only "stable" waits for the page to stop changing
+    ((script, args),) = drivers[0].async_scripts
+    assert script == browser.WAIT_UNTIL_STABLE_SCRIPT
+    assert args[0] == "element //table"
+    # no random waits unless jitter is set
+    assert sleeps == []
+
+
+def test_wait_for_element_with_jitter(drivers, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(browser.time, "sleep", sleeps.append)
+
+    with Browser("https://example.com", pool=BrowserPool(), jitter=(1, 2)) as page:
+        page.wait_for_element("//table", ready="present")
+
+    assert len(sleeps) == 1
+    assert 1 <= sleeps[0] <= 2
+
+
+def test_light_load_profile(drivers):
+    pool = BrowserPool(size=1)
+
+    with Browser("https://example.com", pool=pool, load_profile="light"):
+        pass
+
+    commands = [command for command, _ in drivers[0].cdp_commands]
+    assert commands == [
+        "Network.enable",
+        "Network.setBlockedURLs",
+        "Page.addScriptToEvaluateOnNewDocument",
+        # undone before returning the driver to the pool
+        "Network.setBlockedURLs",
+        "Network.disable",
+        "Page.removeScriptToEvaluateOnNewDocument",
+    ]
+    assert "*.png" in drivers[0].cdp_commands[1][1]["urls"]
+    assert drivers[0].cdp_commands[3][1]["urls"] == []
+
+    with Browser("https://example.com", pool=pool):
+        pass
+
+    # the full profile doesn't block anything
+    assert len(drivers[0].cdp_commands) == 6
@@ -0,0 +1,660 @@
+import asyncio
+import inspect
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from aiwebscraper import cache
+from aiwebscraper.cache import FunctionCache, CachedException
+
+
+calls = []
+
+
+def add(*, a, b):
+    calls.append((a, b))
+    return {"sum": a + b}
+
+
+def fail(*, a):
+    calls.append(a)
+    raise ValueError(f"bad value: {a}")
+
+
+@pytest.fixture(autouse=True)
+def reset_calls():
+    calls.clear()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace time.time in the cache module with a clock we can move forward."""
+
+    class Clock:
+        now = 1_000_000.0
+
+        def time(self):
+            return self.now
+
+        def advance(self, seconds):
+            self.now += seconds
+
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "time", clock.time)
+    return clock
+
+
+def count_rows(path, table):
+    connection = sqlite3.connect(path)
+    (count,) = connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+    connection.close()
+    return count
+
+
+def test_caches_response(tmp_path):
+    add_cached = FunctionCache(add, tmp_path / "cache.db")
+
+    assert add_cached(a=1, b=2) == {"sum": 3}
+    assert add_cached(a=1, b=2) == {"sum": 3}
+    assert add_cached(a=2, b=2) == {"sum": 4}
+    assert calls == [(1, 2), (2, 2)]
+
+
+def test_kwargs_order_does_not_matter(tmp_path):
+    add_cached = FunctionCache(add, tmp_path / "cache.db")
+
+    add_cached(a=1, b=2)
+    add_cached(b=2, a=1)
+
+    assert calls == [(1, 2)]
+
+
+def test_cache_persists_across_instances(tmp_path):
+    FunctionCache(add, tmp_path / "cache.db")(a=1, b=2)
+
+    assert FunctionCache(add, tmp_path / "cache.db")(a=1, b=2) == {"sum": 3}
+    assert calls == [(1, 2)]
+
+
+def test_caches_exceptions(tmp_path):
+    fail_cached = FunctionCache(fail, tmp_path / "cache.db")
+
+    with pytest.raises(ValueError):
+        fail_cached(a=1)
+
+    with pytest.raises(CachedException, match="ValueError: bad value: 1"):
+        fail_cached(a=1)
+
+    assert calls == [1]
+
+
+def test_retry_failures(tmp_path):
+    fail_cached = FunctionCache(fail, tmp_path / "cache.db", retry_failures=True)
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            fail_cached(a=1)
+
+    assert calls == [1, 1]
+
+
+def test_key_depends_on_source_code():
+    kwargs = FunctionCache.serialize_kwargs({"a": 1})
+
+    assert FunctionCache.make_key("mod.f", "hash", kwargs) != FunctionCache.make_key(
+        "mod.f", "another-hash", kwargs
+    )
+
+
+def test_migrates_calls_table(tmp_path):
+    path = tmp_path / "cache.db"
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE calls (qualified_name TEXT, kwargs TEXT, source_code TEXT, "
+        "response TEXT, exception TEXT)"
+    )
+    connection.execute(
+        "INSERT INTO calls VALUES (?, ?, ?, ?, ?)",
+        (
+            FunctionCache.qualified_name(add),
+            json.dumps({"b": 2, "a": 1}),
+            inspect.getsource(add),
+            json.dumps({"sum": "cached"}),
+            None,
+        ),
+    )
+    connection.commit()
+    connection.close()
+
+    assert FunctionCache(add, path)(a=1, b=2) == {"sum": "cached"}
+    assert calls == []
+
+    connection = sqlite3.connect(path)
+    tables = connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"
+    ).fetchall()
+    connection.close()
+
+    assert ("calls",) not in tables
+
+
+def echo(*, html, query):
+    calls.append(query)
+    return {"html": html, "query": query}
+
+
+def test_stores_long_strings_once(tmp_path):
+    path = tmp_path / "cache.db"
+    echo_cached = FunctionCache(echo, path, blob_threshold=10)
+    html = "<p>some page</p>" * 100
+
+    assert echo_cached(html=html, query="a") == {"html": html, "query": "a"}
+    assert echo_cached(html=html, query="b") == {"html": html, "query": "b"}
+    assert FunctionCache(echo, path)(html=html, query="a") == {
+        "html": html,
+        "query": "a",
+    }
+    assert calls == ["a", "b"]
+
+    assert count_rows(path, "blobs") == 1
+
+
+def test_keys_like_a_blob_reference(tmp_path):
+    path = tmp_path / "cache.db"
+    echo_cached = FunctionCache(echo, path, blob_threshold=10)
+    html = [{"$blob": "abc"}, {"$$blob": "<p>some page</p>" * 100}]
+
+    for _ in range(2):
+        assert echo_cached(html=html, query="a") == {"html": html, "query": "a"}
+
+    assert FunctionCache(echo, path)(html=html, query="a") == {
+        "html": html,
+        "query": "a",
+    }
+    assert calls == ["a"]
+
+
+def test_max_entries_evicts_least_recently_used(tmp_path, clock):
+    add_cached = FunctionCache(add, tmp_path / "cache.db", max_entries=2)
+
+    add_cached(a=1, b=1)
+    clock.advance(120)
+    add_cached(a=2, b=2)
+    clock.advance(120)
+    # hit, so (2, 2) becomes the least recently used
+    add_cached(a=1, b=1)
+    clock.advance(120)
+    add_cached(a=3, b=3)
+
+    add_cached(a=1, b=1)
+    add_cached(a=3, b=3)
+    add_cached(a=2, b=2)
+
+    assert calls == [(1, 1), (2, 2), (3, 3), (2, 2)]
+    assert count_rows(tmp_path / "cache.db", "function_calls") == 2
+
+
+def test_ttl(tmp_path, clock):
+    add_cached = FunctionCache(add, tmp_path / "cache.db", ttl=60)
+
+    add_cached(a=1, b=1)
+    clock.advance(30)
+    add_cached(a=1, b=1)
+    clock.advance(31)
+    add_cached(a=1, b=1)
+
+    assert calls == [(1, 1), (1, 1)]
+
+
+def test_max_bytes_evicts_calls_and_their_blobs(tmp_path, clock):
+    path = tmp_path / "cache.db"
+    echo_cached = FunctionCache(echo, path, blob_threshold=10, max_bytes=5_000)
+
+    for i in range(10):
+        # random-ish content so compression doesn't make it tiny
+        echo_cached(html=str(list(range(i * 1000, i * 1000 + 500))), query=str(i))
+        clock.advance(1)
+
+    assert 0 < count_rows(path, "function_calls") < 10
+    assert count_rows(path, "blobs") == count_rows(path, "function_calls")
+
+    # the most recent call is still cached
+    echo_cached(html=str(list(range(9000, 9500))), query="9")
+    assert calls == [str(i) for i in range(10)]
+
+
+def fail_once(*, html, query):
+    calls.append(query)
+
+    if calls.count(query) == 1:
+        raise ValueError("first call")
+
+    return {"html": html, "query": query}
+
+
+def test_cache_size_is_kept_up_to_date(tmp_path, clock):
+    path = tmp_path / "cache.db"
+    fail_once_cached = FunctionCache(
+        fail_once, path, blob_threshold=10, retry_failures=True, max_bytes=5_000
+    )
+
+    def cache_size():
+        connection = sqlite3.connect(path)
+        (size,) = connection.execute("SELECT bytes FROM cache_size").fetchone()
+        connection.close()
+        return size
+
+    for i in range(10):
+        # the same pages are stored by several calls, and the failures are replaced
+        html = str(list(range(i % 3 * 1000, i % 3 * 1000 + 300)))
+
+        with pytest.raises(ValueError):
+            fail_once_cached(html=html, query=str(i))
+
+        fail_once_cached(html=html, query=str(i))
+        clock.advance(1)
+
+        assert 0 < cache_size() <= 5_000
+
+    size, blobs = cache_size(), count_rows(path, "blobs")
+    fail_once_cached.compact()
+
+    assert (cache_size(), count_rows(path, "blobs")) == (size, blobs)
+
+
+def test_cache_size_counts_shared_blobs_once(tmp_path):
+    path = tmp_path / "cache.db"
+    echo_cached = FunctionCache(echo, path, blob_threshold=10)
+    html = str(list(range(1000)))
+
+    for i in range(10):
+        echo_cached(html=html, query=str(i))
+
+    connection = sqlite3.connect(path)
+    (size,) = connection.execute("SELECT bytes FROM cache_size").fetchone()
+    (blobs,) = connection.execute("SELECT SUM(LENGTH(data)) FROM blobs").fetchone()
+    (rows,) = connection.execute(
+        "SELECT SUM(LENGTH(kwargs) + LENGTH(response)) FROM function_calls"
+    ).fetchone()
+    connection.close()
+
+    assert size == blobs + rows
+    (row,) = cache.report(path)
+    assert row["cached_bytes"] == size
+
+
+def test_compact(tmp_path, clock):
+    path = tmp_path / "cache.db"
+    add_cached = FunctionCache(add, path)
+
+    add_cached(a=1, b=1)
+    clock.advance(120)
+    add_cached(a=2, b=2)
+
+    FunctionCache(add, path, max_entries=1).compact(vacuum=True)
+
+    assert count_rows(path, "function_calls") == 1
+
+
+async def add_async(*, a, b):
+    calls.append((a, b))
+    await asyncio.sleep(0.01)
+    return {"sum": a + b}
+
+
+def test_async_function(tmp_path):
+    add_cached = FunctionCache(add_async, tmp_path / "cache.db")
+
+    async def main():
+        first = await asyncio.gather(*[add_cached(a=1, b=2) for _ in range(5)])
+        second = await add_cached(a=1, b=2)
+        return first, second
+
+    first, second = asyncio.run(main())
+
+    assert first == [{"sum": 3}] * 5
+    assert second == {"sum": 3}
+    assert calls == [(1, 2)]
+
+
+async def fail_async(*, a):
+    calls.append(a)
+    raise ValueError(f"bad value: {a}")
+
+
+def test_async_function_exception(tmp_path):
+    fail_cached = FunctionCache(fail_async, tmp_path / "cache.db")
+
+    async def main():
+        return await asyncio.gather(
+            *[fail_cached(a=1) for _ in range(3)], return_exceptions=True
+        )
+
+    assert [type(e) for e in asyncio.run(main())] == [ValueError] * 3
+
+    with pytest.raises(CachedException):
+        asyncio.run(fail_cached(a=1))
+
+    assert calls == [1]
+
+
+def test_uses_wal(tmp_path):
+    FunctionCache(add, tmp_path / "cache.db")
+
+    connection = sqlite3.connect(tmp_path / "cache.db")
+    (journal_mode,) = connection.execute("PRAGMA journal_mode").fetchone()
+    connection.close()
+
+    assert journal_mode == "wal"
+
+
+def test_threads(tmp_path):
+    add_cached = FunctionCache(add, tmp_path / "cache.db")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(lambda i: add_cached(a=i % 20, b=0), range(200))
+        )
+
+    assert results == [{"sum": i % 20} for i in range(200)]
+    assert count_rows(tmp_path / "cache.db", "function_calls") == 20
+
+
+def words(*, html):
+    return {"html": html, "words": set(html.split())}
+
+
+def test_failed_write_is_rolled_back(tmp_path):
+    path = tmp_path / "cache.db"
+    words_cached = FunctionCache(words, path, blob_threshold=10, timeout=1)
+
+    # the set can't be serialized, but the page was already stored in the blobs table
+    with pytest.raises(TypeError):
+        words_cached(html="<p>some page</p>" * 100)
+
+    # another connection can write
+    assert FunctionCache(add, path, timeout=1)(a=1, b=2) == {"sum": 3}
+    assert count_rows(path, "blobs") == 0
+
+
+def test_threads_store_the_same_page(tmp_path):
+    path = tmp_path / "cache.db"
+    barrier = threading.Barrier(8)
+
+    def echo_together(*, html, query):
+        # the threads all store the page at the same time
+        barrier.wait()
+        return echo(html=html, query=query)
+
+    echo_cached = FunctionCache(echo_together, path, blob_threshold=10)
+    # large enough that the other threads run while one compresses it
+    html = "<p>some page</p>" * 100_000
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(lambda i: echo_cached(html=html, query=str(i)), range(8))
+        )
+
+    assert results == [{"html": html, "query": str(i)} for i in range(8)]
+    assert count_rows(path, "function_calls") == 8
+    assert count_rows(path, "blobs") == 1
+
+
+def test_batch(tmp_path):
+    path = tmp_path / "cache.db"
+    add_cached = FunctionCache(add, path)
+
+    with add_cached.batch():
+        add_cached(a=1, b=1)
+        add_cached(a=2, b=2)
+
+        # not committed yet
+        assert count_rows(path, "function_calls") == 0
+
+    assert count_rows(path, "function_calls") == 2
+
+
+def test_write_behind(tmp_path):
+    path = tmp_path / "cache.db"
+    add_cached = FunctionCache(
+        add, path, write_behind=True, flush_interval=60, flush_size=3
+    )
+
+    add_cached(a=1, b=1)
+    add_cached(a=2, b=2)
+
+    # queued calls are served from memory
+    assert add_cached(a=1, b=1) == {"sum": 2}
+    assert count_rows(path, "function_calls") == 0
+
+    # reaching flush_size writes the queue
+    add_cached(a=3, b=3)
+    assert count_rows(path, "function_calls") == 3
+
+    add_cached(a=4, b=4)
+    add_cached.flush()
+    assert count_rows(path, "function_calls") == 4
+    assert calls == [(1, 1), (2, 2), (3, 3), (4, 4)]
+
+
+def test_write_behind_flushes_after_interval(tmp_path):
+    path = tmp_path / "cache.db"
+    add_cached = FunctionCache(add, path, write_behind=True, flush_interval=0.05)
+
+    add_cached(a=1, b=1)
+    time.sleep(0.5)
+
+    assert count_rows(path, "function_calls") == 1
+
+
+released = threading.Event()
+
+
+def wait_and_add(*, a, b):
+    calls.append((a, b))
+    released.wait(timeout=5)
+    return {"sum": a + b}
+
+
+def test_concurrent_calls_share_one_call(tmp_path):
+    add_cached = FunctionCache(wait_and_add, tmp_path / "cache.db")
+    released.clear()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(add_cached, a=1, b=2) for _ in range(4)]
+        time.sleep(0.2)
+        released.set()
+        results = [future.result() for future in futures]
+
+    assert results == [{"sum": 3}] * 4
+    assert calls == [(1, 2)]
+
+
+def test_memory_tier(tmp_path):
+    path = tmp_path / "cache.db"
+    add_cached = FunctionCache(add, path, memory_size=2)
+
+    add_cached(a=1, b=1)
+    add_cached(a=1, b=1)
+    add_cached(a=2, b=2)
+    add_cached(a=3, b=3)
+    # dropped from memory, served from the database
+    add_cached(a=1, b=1)
+
+    assert add_cached.memory_info() == cache.MemoryInfo(
+        hits=1, misses=4, size=2, maxsize=2
+    )
+    assert calls == [(1, 1), (2, 2), (3, 3)]
+
+
+def test_memory_tier_disabled(tmp_path):
+    add_cached = FunctionCache(add, tmp_path / "cache.db", memory_size=0)
+
+    add_cached(a=1, b=1)
+    add_cached(a=1, b=1)
+
+    assert add_cached.memory_info() == cache.MemoryInfo(0, 0, 0, 0)
+    assert calls == [(1, 1)]
+
+
+def test_get_many(tmp_path):
+    path = tmp_path / "cache.db"
+    add_cached = FunctionCache(add, path)
+    add_cached(a=1, b=1)
+    add_cached(a=2, b=2)
+    calls.clear()
+
+    add_cached = FunctionCache(add, path)
+    responses, misses = add_cached.get_many(
+        [dict(a=1, b=1), dict(a=3, b=3), dict(a=2, b=2)]
+    )
+
+    assert responses == [{"sum": 2}, None, {"sum": 4}]
+    assert misses == [dict(a=3, b=3)]
+    assert calls == []
+
+
+def test_warm(tmp_path):
+    path = tmp_path / "cache.db"
+    add_cached = FunctionCache(add, path)
+    add_cached(a=1, b=1)
+    add_cached(a=2, b=2)
+
+    add_cached = FunctionCache(add, path)
+    misses = add_cached.warm([dict(a=1, b=1), dict(a=2, b=2), dict(a=3, b=3)])
+
+    assert misses == [dict(a=3, b=3)]
+
+    add_cached(a=1, b=1)
+    add_cached(a=2, b=2)
+
+    assert add_cached.memory_info().hits == 2
+
+
+def test_max_attempts(tmp_path):
+    path = tmp_path / "cache.db"
+    fail_cached = FunctionCache(fail, path, retry_failures=True, max_attempts=2)
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            fail_cached(a=1)
+
+    with pytest.raises(CachedException) as excinfo:
+        FunctionCache(fail, path, retry_failures=True, max_attempts=2)(a=1)
+
+    assert excinfo.value.exception_type == "builtins.ValueError"
+    assert excinfo.value.attempts == 2
+    assert calls == [1, 1]
+    # failures replace the previous row
+    assert count_rows(path, "function_calls") == 1
+
+
+def test_retry_backoff(tmp_path, clock):
+    fail_cached = FunctionCache(
+        fail, tmp_path / "cache.db", retry_failures=True, retry_backoff=10
+    )
+
+    with pytest.raises(ValueError):
+        fail_cached(a=1)
+
+    with pytest.raises(CachedException):
+        fail_cached(a=1)
+
+    clock.advance(11)
+
+    with pytest.raises(ValueError):
+        fail_cached(a=1)
+
+    # the backoff doubles
+    clock.advance(11)
+
+    with pytest.raises(CachedException) as excinfo:
+        fail_cached(a=1)
+
+    assert excinfo.value.retry_after == clock.now - 11 + 20
+    assert calls == [1, 1]
+
+
+def test_stats(tmp_path):
+    add_cached = FunctionCache(add, tmp_path / "cache.db")
+
+    add_cached(a=1, b=2)
+    add_cached(a=1, b=2)
+    add_cached(a=2, b=2)
+
+    stats = add_cached.stats()
+    assert (stats.hits, stats.misses, stats.calls) == (1, 2, 2)
+    assert stats.hit_rate == pytest.approx(1 / 3)
+    kwargs = FunctionCache.serialize_kwargs({"a": 1, "b": 2})
+    assert stats.saved_input_chars == len(kwargs)
+    assert stats.lookup_seconds > 0
+    assert stats.function_seconds > 0
+    assert stats.bytes_stored > 0
+
+
+def test_stats_count_shared_blobs_as_saved(tmp_path):
+    echo_cached = FunctionCache(echo, tmp_path / "cache.db", blob_threshold=10)
+    html = "<p>hello</p>" * 100
+
+    echo_cached(html=html, query="a")
+    first = echo_cached.stats()
+    echo_cached(html=html, query="b")
+    second = echo_cached.stats()
+
+    # the first call stores the compressed page, the second one only references it
+    assert first.bytes_saved > 0
+    assert second.bytes_stored - first.bytes_stored < 200
+    # it's in the kwargs and the response
+    assert second.bytes_saved - first.bytes_saved == 2 * len(html)
+
+
+def test_on_event(tmp_path):
+    events = []
+    fail_cached = FunctionCache(fail, tmp_path / "cache.db", on_event=events.append)
+
+    for _ in range(2):
+        with pytest.raises((ValueError, CachedException)):
+            fail_cached(a=1)
+
+    assert [event["event"] for event in events] == ["miss", "call", "write", "hit"]
+    assert {event["function"] for event in events} == {"test_cache.fail"}
+    assert len({event["key"] for event in events}) == 1
+    assert events[-1]["hits"] == 1
+
+
+def test_report(tmp_path):
+    path = tmp_path / "cache.db"
+    add_cached = FunctionCache(add, path)
+    add_cached(a=1, b=2)
+    add_cached(a=1, b=2)
+    del add_cached
+
+    # the statistics of every FunctionCache using the database add up
+    add_cached = FunctionCache(add, path)
+    add_cached(a=1, b=2)
+    add_cached.save_stats()
+
+    (row,) = cache.report(path, price_per_million_tokens=1_000_000)
+    assert row["function"] == "test_cache.add"
+    assert row["cached_calls"] == 1
+    assert (row["hits"], row["misses"], row["calls"]) == (2, 1, 1)
+    assert row["seconds_saved"] == pytest.approx(2 * row["function_seconds"])
+    assert row["dollars_saved"] == row["saved_input_chars"] / cache.CHARS_PER_TOKEN
+
+
+def test_report_without_stats(tmp_path):
+    path = tmp_path / "cache.db"
+    FunctionCache(add, path)(a=1, b=2)
+
+    connection = sqlite3.connect(path)
+    connection.execute("DROP TABLE function_stats")
+    connection.commit()
+    connection.close()
+
+    (row,) = cache.report(path)
+    assert row["cached_calls"] == 1
+    assert row["hit_rate"] is None
@@ -0,0 +1,123 @@
+import asyncio
+import json
+
+import pytest
+
+websockets = pytest.importorskip("websockets")
+
+from aiwebscraper import cdp  # noqa: E402
+
+
+class FakeChrome:
+    """Answers the commands AsyncBrowser and AsyncPage send, evaluating scripts with
+    evaluate (which receives the expression)."""
+
+    def __init__(self, evaluate):
+        self.evaluate = evaluate
+        self.commands = []
+
+    async def handle(self, websocket):
+        async for raw in websocket:
+            message = json.loads(raw)
+            method = message["method"]
+            self.commands.append(method)
+            result = {}
+
+            if method == "Target.createTarget":
+                result = {"targetId": f"target-{message['id']}"}
+            elif method == "Target.attachToTarget":
+                result = {"sessionId": f"session-{message['params']['targetId']}"}
+            elif method == "Page.navigate":
+                await websocket.send(
+                    json.dumps(
+                        {
+                            "method": "Page.domContentEventFired",
+                            "params": {},
+                            "sessionId": message["sessionId"],
+                        }
+                    )
+                )
+            elif method == "Runtime.evaluate":
+                value = self.evaluate(message["params"]["expression"])
+
+                if isinstance(value, Exception):
+                    result = {
+                        "result": {},
+                        "exceptionDetails": {"exception": {"description": str(value)}},
+                    }
+                else:
+                    result = {"result": {"value": value}}
+
+            await websocket.send(json.dumps({"id": message["id"], "result": result}))
+
+
+async def run_with_browser(chrome, function):
+    async with websockets.serve(chrome.handle, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        connection = await cdp.CDPConnection.connect(f"ws://127.0.0.1:{port}")
+
+        async with cdp.AsyncBrowser(connection, max_tabs=2) as browser:
+            return await function(browser)
+
+
+def test_get_from_xpaths_async():
+    def evaluate(expression):
+        # the values of each XPath, otherwise the element exists and it's stable
+        if cdp.EVALUATE_XPATHS_SCRIPT in expression:
+            return [["a", "b"], ["1", "2"]]
+
+        return True
+
+    chrome = FakeChrome(evaluate)
+
+    async def scrape(browser):
+        return await asyncio.gather(
+            *(
+                cdp.get_from_xpaths_async(
+                    browser,
+                    f"https://example.com/{i}",
+                    "//table",
+                    {"name": ".//td[1]", "value": ".//td[2]"},
+                )
+                for i in range(3)
+            )
+        )
+
+    tables = asyncio.run(run_with_browser(chrome, scrape))
+
+    assert tables == [{"name": ["a", "b"], "value": ["1", "2"]}] * 3
+    assert chrome.commands.count("Target.createTarget") == 3
+    assert chrome.commands.count("Target.closeTarget") == 3
+
+
+def test_script_errors():
+    chrome = FakeChrome(lambda expression: ValueError("No element matches"))
+
+    async def get_html(browser):
+        async with browser.new_page("https://example.com") as page:
+            return await page.get_html("//table")
+
+    with pytest.raises(cdp.CDPError, match="No element matches"):
+        asyncio.run(run_with_browser(chrome, get_html))
+
+    assert chrome.commands[-1] == "Target.closeTarget"
+
+
+def test_light_load_profile():
+    chrome = FakeChrome(lambda expression: [[]])
+
+    async def scrape(browser):
+        return await cdp.get_from_xpaths_async(
+            browser,
+            "https://example.com",
+            None,
+            {"name": "//td"},
+            ready="present",
+            load_profile="light",
+        )
+
+    asyncio.run(run_with_browser(chrome, scrape))
+
+    assert chrome.commands.index("Network.setBlockedURLs") < chrome.commands.index(
+        "Page.navigate"
+    )
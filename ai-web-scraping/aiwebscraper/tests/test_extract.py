@@ -1,4 +1,16 @@
-from aiwebscraper.extract import WebScraper
+import threading
+import time
+
+import lxml.html
+
+from aiwebscraper import extract
+from aiwebscraper.extract import (
+    WebScraper,
+    get_data_with_scraper,
+    get_from_html,
+    merge_tables,
+    split_html_rows,
+)
 
 
 def test_wikipedia_hdi(snapshot):
@@ -29,3 +41,246 @@ def test_yahoo_finance_gainers():
     xpath, elements = scraper.extract_xpath_for_column(
         table_data.columns[1].values, table_data.columns[1].name
     )
+
+
+class FakeScraper:
+    """Returns "//column" as the XPath of each column, with no elements the first
+    time for the columns in failing_columns."""
+
+    url = "https://example.com"
+    element_xpath = None
+
+    def __init__(self, failing_columns=()):
+        self.requests = []
+        self.failing_columns = set(failing_columns)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def extract_xpath_for_column(self, values, column_name):
+        with self.lock:
+            self.requests.append(column_name)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        time.sleep(0.05)
+
+        with self.lock:
+            self.in_flight -= 1
+
+            if column_name in self.failing_columns:
+                self.failing_columns.remove(column_name)
+                return f"//{column_name}", []
+
+        return f"//{column_name}", ["element"]
+
+    def extract_xpaths_for_columns(self, data):
+        with self.lock:
+            self.requests.append(tuple(data))
+
+        return {
+            name: (f"//{name}", [] if name in self.failing_columns else ["element"])
+            for name in data
+        }
+
+
+def test_get_data_with_scraper_requests_columns_concurrently():
+    scraper = FakeScraper(failing_columns=["b"])
+    data = {name: ["value"] for name in ["a", "b", "c", "d"]}
+
+    result = get_data_with_scraper(scraper, data, max_workers=2)
+
+    assert list(result["xpaths"].items()) == [
+        ("a", "//a"),
+        ("b", "//b"),
+        ("c", "//c"),
+        ("d", "//d"),
+    ]
+    assert scraper.max_in_flight == 2
+    # only the failing column is retried
+    assert sorted(scraper.requests) == ["a", "b", "b", "c", "d"]
+
+
+def test_get_data_with_scraper_single_request():
+    scraper = FakeScraper(failing_columns=["b"])
+    data = {name: ["value"] for name in ["a", "b", "c"]}
+
+    result = get_data_with_scraper(scraper, data, single_request=True)
+
+    assert list(result["xpaths"]) == ["a", "b", "c"]
+    # the column that failed in the single request is requested separately
+    assert scraper.requests == [("a", "b", "c"), "b", "b"]
+
+
+def test_get_from_html():
+    html = """
+    <html><body>
+    <table id="data">
+      <tr><td>Norway</td><td> 0.966 <span style="display: none">key</span></td></tr>
+      <tr><td><a href="/ch">Switzerland</a><style>.x {}</style></td><td>0.967</td></tr>
+    </table>
+    </body></html>
+    """
+
+    table = get_from_html(
+        html,
+        '//*[@id="data"]',
+        {
+            "country": ".//tr/td[1]",
+            "hdi": ".//tr/td[2]",
+            "link": ".//a/@href",
+            "missing": ".//th",
+        },
+    )
+
+    assert table == {
+        "country": ["Norway", "Switzerland"],
+        "hdi": ["0.966", "0.967"],
+        "link": ["/ch"],
+        "missing": [],
+    }
+
+
+def test_get_from_html_separates_lines():
+    html = """
+    <table>
+      <tr><td><div>New</div><div>York</div></td><td>1,234<br>(2020)</td></tr>
+      <tr>
+        <td>Los   <b>Angeles</b><span hidden>x</span></td>
+        <td><p>a</p>\n<p>b</p></td>
+      </tr>
+    </table>
+    """
+
+    table = get_from_html(
+        html, "//table", {"city": ".//tr/td[1]", "population": ".//tr/td[2]"}
+    )
+
+    # the same values as the browser's innerText
+    assert table == {
+        "city": ["New\nYork", "Los Angeles"],
+        "population": ["1,234\n(2020)", "a\nb"],
+    }
+
+
+def test_get_from_xpaths_falls_back_to_browser_on_empty_page(monkeypatch):
+    class Response:
+        content = b""
+
+        def raise_for_status(self):
+            pass
+
+    class Browser:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+        def wait_for_element(self, xpath, ready):
+            return "body"
+
+        def evaluate_xpaths(self, xpaths, element):
+            return {name: ["from the browser"] for name in xpaths}
+
+    monkeypatch.setattr(extract.requests, "get", lambda *args, **kwargs: Response())
+    monkeypatch.setattr(extract, "_open_browser", lambda *args, **kwargs: Browser())
+
+    assert extract.get_from_xpaths("https://a.com", None, {"x": "//td"}) == {
+        "x": ["from the browser"]
+    }
+
+
+def make_table(rows):
+    body = "".join(
+        f"<tr><td>Country {i}</td><td>0.{i:03d}</td></tr>" for i in range(rows)
+    )
+    return (
+        "<table><caption>HDI</caption><tbody>"
+        f"<tr><th>Country</th><th>HDI</th></tr>{body}</tbody></table>"
+    )
+
+
+def test_split_html_rows():
+    html = make_table(100)
+
+    chunks = split_html_rows(html, max_tokens=200)
+
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 200 * 4 for chunk in chunks)
+
+    rows = []
+
+    for chunk in chunks:
+        # every chunk keeps the caption and header row
+        assert chunk.startswith(
+            "<table><caption>HDI</caption><tbody><tr><th>Country</th>"
+        )
+        rows.extend(lxml.html.fromstring(chunk).xpath("//td[1]/text()"))
+
+    assert rows == [f"Country {i}" for i in range(100)]
+
+
+def test_split_html_rows_wide_table():
+    cells = "".join(f"<td>cell {i}</td>" for i in range(40))
+    html = (
+        "<table><caption>Wide</caption>"
+        + "".join(f"<tr><td>row {i}</td>{cells}</tr>" for i in range(3))
+        + "</table>"
+    )
+
+    chunks = split_html_rows(html, max_tokens=200)
+
+    # the rows are split, not the cells of the first row
+    assert len(chunks) == 3
+
+    for i, chunk in enumerate(chunks):
+        tree = lxml.html.fromstring(chunk)
+        assert tree.xpath("//caption/text()") == ["Wide"]
+        assert tree.xpath("//tr/td[1]/text()") == [f"row {i}"]
+        assert len(tree.xpath("//td")) == 41
+
+
+def test_split_html_rows_fits():
+    html = make_table(3)
+
+    assert split_html_rows(html, max_tokens=1000) == [html]
+
+
+def test_merge_tables():
+    tables = [
+        {"a": ["1", "2"], "b": ["x", "y"]},
+        {"a": ["3"], "c": ["z"]},
+    ]
+
+    assert merge_tables(tables) == {
+        "a": ["1", "2", "3"],
+        "b": ["x", "y", ""],
+        "c": ["", "", "z"],
+    }
+
+
+def test_extract_table_data_in_chunks(monkeypatch):
+    requests = []
+
+    def chat_completion_parsed_table(*, model, messages):
+        html = messages[1]["content"].removeprefix("The HTML content is: ")
+        requests.append(html)
+        time.sleep(0.05)
+        tree = lxml.html.fromstring(html)
+        return {
+            "Country": tree.xpath("//td[1]/text()"),
+            "HDI": tree.xpath("//td[2]/text()"),
+        }
+
+    monkeypatch.setattr(
+        extract, "chat_completion_parsed_table_cached", chat_completion_parsed_table
+    )
+
+    table = extract.extract_table_data(make_table(100), max_tokens=500)
+
+    assert len(requests) > 1
+    assert table == {
+        "Country": [f"Country {i}" for i in range(100)],
+        "HDI": [f"0.{i:03d}" for i in range(100)],
+    }
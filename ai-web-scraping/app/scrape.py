@@ -29,9 +29,8 @@ def _scrape_data(*, url: str, xpath: str):
         raise ValueError("OpenAI API key is not set.")
 
     try:
-        scraper = WebScraper(url, xpath)
-        parsed_table = scraper.extract_table_data()
-        return parsed_table
+        with WebScraper(url, xpath) as scraper:
+            return scraper.extract_table_data()
     except Exception as e:
         return str(e)
 
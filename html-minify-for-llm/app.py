@@ -77,16 +77,21 @@ def display_results(url):
         "n_tokens": [],
     }
 
+    cleaners = [
+        (lib.fast_minifier, "clean"),
+        (lib.tag_remover, "unstructured"),
+        (lib.markdown_converter, "markdown"),
+        (lib.no_cleaner, "raw"),
+    ]
+
+    # the cleaned output doesn't depend on the model, only the token count does
+    outputs = {name: cleaner.clean(html_content) for cleaner, name in cleaners}
+
     for model in [lib.gpt4omini, lib.gpt4o, lib.gpt4o_2024_08_06]:
-        for cleaner, cleaner_name in [
-            (lib.minifier, "clean"),
-            (lib.tag_remover, "unstructured"),
-            (lib.markdown_converter, "markdown"),
-            (lib.no_cleaner, "raw"),
-        ]:
+        for cleaner, cleaner_name in cleaners:
             cleaner.set_model_info(model)
 
-            output = cleaner.clean(html_content)
+            output = outputs[cleaner_name]
             n_tokens = cleaner.count_tokens(output)
             cost = cleaner.compute_cost(n_tokens)
 
@@ -13,7 +13,6 @@ import requests
 from openai import OpenAI
 from pydantic import BaseModel
 from bs4 import BeautifulSoup
-import tiktoken
 import pandas as pd
 
 import lib
@@ -294,12 +293,23 @@ def interrogate(
 ) -> float:
     total_questions = len(qa)
     correct_answers = 0
-    encoder = tiktoken.encoding_for_model(model_info.name)
+    encoder = lib.get_encoding(model_info.name)
     total_cost = 0
 
+    # the same content is sent with every question
+    n_tokens = len(encoder.encode(html_content))
+    cost = n_tokens * model_info.price_per_million_tokens / 1_000_000
+
+    if not cost_only:
+        # load the cached answers for all questions with a single query
+        model_caller.warm(
+            [
+                dict(html_content=html_content, model=model_info.name, query=question)
+                for question in qa
+            ]
+        )
+
     for question, answer in qa.items():
-        n_tokens = len(encoder.encode(html_content))
-        cost = n_tokens * model_info.price_per_million_tokens / 1_000_000
         # print(f"Cost for {n_tokens:,} tokens: ${cost:.2f}")
         total_cost += cost
 
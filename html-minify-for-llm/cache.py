@@ -1,22 +1,143 @@
+import asyncio
+import atexit
+import hashlib
 import inspect
 import json
 import logging
+import re
 import sqlite3
+import threading
+import time
+import weakref
+import zlib
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
 
 
 logger = logging.getLogger(__name__)
 
+# strings stored in the blobs table are replaced by {BLOB_REFERENCE: hash}
+BLOB_REFERENCE = "$blob"
+BLOB_REFERENCE_RE = re.compile(re.escape(json.dumps(BLOB_REFERENCE)) + r':\s*"(\w+)"')
+# keys of the cached values that look like BLOB_REFERENCE ("$blob", "$$blob", ...)
+# are stored with an extra "$", so they can't be mistaken for a reference
+RESERVED_KEY_RE = re.compile(r"\$+blob")
+
+# only record a hit if the last one was more than this many seconds ago, so most hits
+# don't write to the database
+LAST_ACCESS_RESOLUTION = 60
+
+# keys per query when looking up several calls (SQLite limits the number of variables)
+MAX_KEYS_PER_QUERY = 500
+
+# rough number of characters per token, to estimate how much the cache hits saved
+CHARS_PER_TOKEN = 4
+
+# the counters and timers kept by each FunctionCache (and in the function_stats table)
+STATS_COLUMNS = [
+    "hits",
+    "misses",
+    "calls",
+    "lookup_seconds",
+    "function_seconds",
+    "saved_input_chars",
+    "bytes_stored",
+    "bytes_saved",
+]
+
+MemoryInfo = namedtuple("MemoryInfo", ["hits", "misses", "size", "maxsize"])
+CacheStats = namedtuple("CacheStats", ["hit_rate"] + STATS_COLUMNS)
+_BlobInfo = namedtuple("_BlobInfo", ["size", "compressed_size", "is_new"])
+_MemoryEntry = namedtuple(
+    "_MemoryEntry",
+    [
+        "response",
+        "exception",
+        "exception_type",
+        "attempts",
+        "retry_after",
+        "created_at",
+        "last_access",
+    ],
+)
+
+# all the caches, so we write their queued calls and statistics at exit
+_caches = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_caches():
+    for cache in list(_caches):
+        cache.flush()
+        cache.save_stats()
+
+
+def _escape_key(key):
+    if isinstance(key, str) and RESERVED_KEY_RE.fullmatch(key):
+        return "$" + key
+
+    return key
+
+
+def _unescape_key(key):
+    if key != BLOB_REFERENCE and RESERVED_KEY_RE.fullmatch(key):
+        return key[1:]
+
+    return key
+
+
+def _blob_references(*rows):
+    """Count the blob hashes referenced in the serialized kwargs or responses."""
+    return Counter(hash_ for row in rows for hash_ in BLOB_REFERENCE_RE.findall(row))
+
+
+def _row_size(kwargs, response, exception):
+    """Size of a row of function_calls, without the blobs it references."""
+    return len(kwargs) + len(response) + len(exception or "")
+
 
 class CachedException(Exception):
-    pass
+    """Raised when the cached call raised an exception. The message is the original
+    one, prefixed with the exception's class name.
+
+    Attributes
+    ----------
+    exception_type : str
+        The exception's type (e.g., "builtins.ValueError"). None for calls cached by
+        older versions.
+
+    attempts : int
+        Number of consecutive times the call failed.
+
+    retry_after : float
+        Timestamp after which the call can be retried (with retry_failures=True).
+    """
+
+    def __init__(self, message, exception_type=None, attempts=None, retry_after=None):
+        super().__init__(message)
+        self.exception_type = exception_type
+        self.attempts = attempts
+        self.retry_after = retry_after
 
 
 class FunctionCache:
     """
     Adds SQLite caching to a function so we don't have to call the function every time.
-    The cache key are all the function's name, the source code, and the keyword arguments
-    passed to the function. The function must return a JSON-serializable object.
+    The cache key is a SHA-256 digest of the function's name, a hash of its source
+    code, and the keyword arguments passed to the function (serialized as JSON with
+    sorted keys). The function must return a JSON-serializable object.
+
+    If the function is a coroutine function (async def), calling the FunctionCache
+    returns a coroutine: the SQLite work runs in a separate thread so it doesn't block
+    the event loop, and concurrent calls with the same arguments share a single call to
+    the function.
+
+    The database uses WAL mode and each thread gets its own connection, so the cache
+    can be shared by several threads and processes. Concurrent calls (from several
+    threads) with the same arguments share a single call to the function.
 
     Parameters
     ----------
@@ -26,29 +147,155 @@ class FunctionCache:
     path_to_db : str
         Path to the SQLite database file. If the file does not exist, it will be
         created.
+
+    retry_failures : bool, default=False
+        If True, calls that raised an exception are retried (subject to max_attempts
+        and retry_backoff). Otherwise, they raise CachedException.
+
+    max_attempts : int, default=None
+        Stop retrying a call after it fails this many consecutive times (it raises
+        CachedException instead). None retries forever.
+
+    retry_backoff : float, default=0
+        Seconds to wait before retrying a failed call. It doubles after every
+        consecutive failure, up to max_retry_backoff. Calls made before that raise
+        CachedException.
+
+    max_retry_backoff : float, default=3600
+        Maximum number of seconds to wait before retrying a failed call.
+
+    blob_threshold : int, default=1024
+        Strings (in the kwargs or the response) longer than this are stored
+        compressed in a separate table, and calls that pass the same string (e.g.,
+        the same HTML page) share a single copy.
+
+    max_bytes : int, default=None
+        Maximum size of the cached data (rows and compressed blobs). When exceeded,
+        the least recently used calls are evicted.
+
+    max_entries : int, default=None
+        Maximum number of cached calls. When exceeded, the least recently used calls
+        are evicted.
+
+    ttl : float, default=None
+        Number of seconds after which a cached call expires.
+
+    timeout : float, default=30
+        Number of seconds to wait for another connection (e.g., from another process)
+        to release a lock before raising "database is locked".
+
+    write_behind : bool, default=False
+        Queue the calls in memory and write them in batches instead of committing
+        after every call. The queue is written when it has flush_size calls,
+        flush_interval seconds after the first queued call, when calling flush(), and
+        at exit. Queued calls are lost if the process crashes.
+
+    flush_interval : float, default=1
+        Seconds to wait before writing the queued calls (only with write_behind).
+
+    flush_size : int, default=100
+        Number of queued calls that triggers a write (only with write_behind).
+
+    memory_size : int, default=128
+        Number of calls to keep in memory (least recently used ones are dropped
+        first), so repeated calls don't query the database. Responses served from
+        memory are the same objects, so they shouldn't be modified. Set to 0 to
+        disable.
+
+    on_event : callable, default=None
+        Called with a dictionary for every cache hit ("hit"), miss ("miss"), function
+        call ("call") and written call ("write"). It has the event, the function's
+        qualified name, the cache key and the values added to the statistics (see
+        stats), e.g., {"event": "hit", "function": "module.f", "key": "...",
+        "hits": 1, "lookup_seconds": 0.0001, "saved_input_chars": 1234}. It runs in
+        the thread that triggered the event, so it should be fast.
     """
 
     def __init__(
-        self, function, path_to_db, retry_failures=False, block_execution=False
+        self,
+        function,
+        path_to_db,
+        retry_failures=False,
+        blob_threshold=1024,
+        max_bytes=None,
+        max_entries=None,
+        ttl=None,
+        timeout=30,
+        write_behind=False,
+        flush_interval=1,
+        flush_size=100,
+        memory_size=128,
+        max_attempts=None,
+        retry_backoff=0,
+        max_retry_backoff=3600,
+        on_event=None,
+        block_execution=False,
     ) -> None:
         self._path_to_db = path_to_db
-        self._connection = None
+        self._timeout = timeout
+        # thread id -> connection
+        self._connections = {}
+        self._connections_lock = threading.Lock()
+        self._local = threading.local()
         self._function = function
         self._qualified_name = self.qualified_name(function)
-        self._source_code = inspect.getsource(function)
+        self._source_hash = hashlib.sha256(
+            inspect.getsource(function).encode("utf-8")
+        ).hexdigest()
         self._retry_failures = retry_failures
         self._block_execution = block_execution
+        self._max_attempts = max_attempts
+        self._retry_backoff = retry_backoff
+        self._max_retry_backoff = max_retry_backoff
+        self._blob_threshold = blob_threshold
+        self._max_bytes = max_bytes
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._is_coroutine_function = inspect.iscoroutinefunction(function)
+        self._executor = None
+        self._in_flight = {}
+        self._sync_in_flight = {}
+        self._sync_in_flight_lock = threading.Lock()
+        self._write_behind = write_behind
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        # key -> the calls not written yet (arguments to _write_row)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_timer = None
+        # key -> _MemoryEntry, in least to most recently used order
+        self._memory = OrderedDict()
+        self._memory_size = memory_size
+        self._memory_lock = threading.Lock()
+        self._memory_hits = 0
+        self._memory_misses = 0
+
+        self._on_event = on_event
+        self._stats = Counter()
+        # the statistics not added to the function_stats table yet
+        self._unsaved_stats = Counter()
+        self._stats_lock = threading.Lock()
+
         self.validate_function(function)
 
-        if not Path(self._path_to_db).exists():
-            self._create_db()
+        self._create_db()
+
+        _caches.add(self)
 
     def clear_cache(self):
         """Clear the cache by deleting the SQLite database file."""
-        if self._connection is not None:
-            self._connection.close()
+        with self._pending_lock:
+            self._pending.clear()
+
+        with self._memory_lock:
+            self._memory.clear()
+
+        self._close_connections()
+
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{self._path_to_db}{suffix}").unlink(missing_ok=True)
 
-        Path(self._path_to_db).unlink()
         self._create_db()
 
     def validate_function(self, function):
@@ -70,109 +317,1159 @@ class FunctionCache:
         """Return the fully qualified name of a function."""
         return function.__module__ + "." + function.__qualname__
 
+    @staticmethod
+    def serialize_kwargs(kwargs):
+        """Serialize the keyword arguments so the same kwargs always produce the same
+        string, regardless of the order they were passed in."""
+        return json.dumps(kwargs, sort_keys=True, separators=(",", ":"))
+
+    @staticmethod
+    def make_key(qualified_name, source_hash, serialized_kwargs):
+        """Return the cache key (hex digest) for a function call."""
+        digest = hashlib.sha256()
+
+        for part in (qualified_name, source_hash, serialized_kwargs):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+
+        return digest.hexdigest()
+
     @property
     def connection(self):
-        """Return the SQLite connection. If it doesn't exist, create it."""
-        if self._connection is None:
-            self._connection = sqlite3.connect(self._path_to_db)
+        """Return the SQLite connection for the current thread. If it doesn't exist,
+        create it."""
+        thread_id = threading.get_ident()
+        connection = self._connections.get(thread_id)
+
+        if connection is None:
+            # every thread uses its own connection, but we close them all from the
+            # thread that calls clear_cache or deletes the object
+            connection = sqlite3.connect(
+                self._path_to_db, timeout=self._timeout, check_same_thread=False
+            )
+            # WAL allows reads while another connection writes, and with WAL,
+            # synchronous=NORMAL only syncs on checkpoints, not on every commit
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+
+            with self._connections_lock:
+                self._connections[thread_id] = connection
+
+        return connection
+
+    def _close_connections(self):
+        with self._connections_lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+
+        for connection in connections:
+            connection.close()
 
-        return self._connection
+    @contextmanager
+    def batch(self):
+        """Commit the calls cached in this thread inside the with block in a single
+        transaction, instead of committing after every call.
+
+        Examples
+        --------
+        >>> with cached_function.batch():
+        ...     for question in questions:
+        ...         cached_function(question=question)
+        """
+        depth = getattr(self._local, "batch_depth", 0)
+        self._local.batch_depth = depth + 1
+
+        try:
+            yield
+        finally:
+            self._local.batch_depth = depth
+
+            if depth == 0:
+                self.connection.commit()
+
+    def _commit(self):
+        """Commit, unless we're in a batch."""
+        if not getattr(self._local, "batch_depth", 0):
+            self.connection.commit()
+
+    @property
+    def executor(self):
+        """Return the executor that runs the SQLite work of async calls."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="FunctionCache"
+            )
+
+        return self._executor
 
     def __del__(self):
-        """Close the connection when the object is deleted."""
-        if self._connection is not None:
-            self._connection.close()
+        """Close the connections when the object is deleted."""
+        # __init__ might have failed before setting all attributes
+        if getattr(self, "_pending", None):
+            self.flush()
+
+        if getattr(self, "_unsaved_stats", None):
+            self.save_stats()
+
+        if hasattr(self, "_connections"):
+            self._close_connections()
+
+        if getattr(self, "_executor", None) is not None:
+            self._executor.shutdown(wait=False)
 
     def _create_db(self):
-        """Create the SQLite database and the table to store the function calls."""
+        """Create the SQLite database and the table to store the function calls (if
+        they don't exist), and migrate calls stored by previous versions."""
         Path(self._path_to_db).parent.mkdir(parents=True, exist_ok=True)
         cursor = self.connection.cursor()
 
+        # several processes might open the same database at the same time, take the
+        # write lock so only one of them creates or migrates the tables
+        cursor.execute("BEGIN IMMEDIATE")
+
+        # the primary key creates a unique index on the key
         cursor.execute(
             """
-            CREATE TABLE IF NOT EXISTS calls (
+            CREATE TABLE IF NOT EXISTS function_calls (
+                key TEXT PRIMARY KEY,
                 qualified_name TEXT,
+                source_hash TEXT,
                 kwargs TEXT,
-                source_code TEXT,
                 response TEXT,
-                exception TEXT
+                exception TEXT,
+                created_at REAL,
+                last_access REAL,
+                size INTEGER,
+                exception_type TEXT,
+                attempts INTEGER,
+                retry_after REAL
+            )
+        """
+        )
+
+        # zlib-compressed strings, keyed by the SHA-256 of the uncompressed string,
+        # with the number of references to them in function_calls
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                data BLOB,
+                refs INTEGER
             )
         """
         )
 
+        # a single row with the size of the cached data, updated on every write so
+        # evicting by max_bytes doesn't need to scan the tables
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache_size (
+                id INTEGER PRIMARY KEY,
+                bytes INTEGER
+            )
+        """
+        )
+
+        # statistics accumulated by all the processes using the database
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS function_stats (
+                qualified_name TEXT PRIMARY KEY,
+                hits INTEGER,
+                misses INTEGER,
+                calls INTEGER,
+                lookup_seconds REAL,
+                function_seconds REAL,
+                saved_input_chars INTEGER,
+                bytes_stored INTEGER,
+                bytes_saved INTEGER
+            )
+        """
+        )
+
+        self._add_missing_columns(cursor)
+        self._migrate_calls_table(cursor)
+
+        # new database, or created by a version that didn't count the references
+        cursor.execute("SELECT 1 FROM cache_size")
+
+        if cursor.fetchone() is None:
+            self._recount(cursor)
+
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS function_calls_last_access
+            ON function_calls (last_access)
+        """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS function_calls_created_at
+            ON function_calls (created_at)
+        """
+        )
+
         self.connection.commit()
 
-    def _insert(self, *, kwargs: dict, response: dict, exception: str):
-        """Insert a new function call into the database."""
-        cursor = self.connection.cursor()
+    def _add_missing_columns(self, cursor):
+        """Add the columns added in later versions to tables created by previous
+        ones."""
+        cursor.execute("PRAGMA table_info(function_calls)")
+        columns = {row[1] for row in cursor.fetchall()}
+
+        # used for eviction
+        if "size" not in columns:
+            for column, type_ in [
+                ("created_at", "REAL"),
+                ("last_access", "REAL"),
+                ("size", "INTEGER"),
+            ]:
+                cursor.execute(
+                    f"ALTER TABLE function_calls ADD COLUMN {column} {type_}"
+                )
+
+            now = time.time()
+            cursor.execute(
+                """
+                UPDATE function_calls
+                SET created_at = ?, last_access = ?,
+                size = LENGTH(kwargs) + LENGTH(response) + IFNULL(LENGTH(exception), 0)
+            """,
+                (now, now),
+            )
+
+        # used for failed calls
+        if "attempts" not in columns:
+            for column, type_ in [
+                ("exception_type", "TEXT"),
+                ("attempts", "INTEGER"),
+                ("retry_after", "REAL"),
+            ]:
+                cursor.execute(
+                    f"ALTER TABLE function_calls ADD COLUMN {column} {type_}"
+                )
+
+            cursor.execute(
+                "UPDATE function_calls SET attempts = 1 WHERE exception IS NOT NULL"
+            )
+
+        cursor.execute("PRAGMA table_info(blobs)")
 
+        # set by _recount
+        if "refs" not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute("ALTER TABLE blobs ADD COLUMN refs INTEGER")
+
+    def _migrate_calls_table(self, cursor):
+        """Move the rows from the calls table (which stored the full source code in
+        every row and had no index) to the function_calls table, then drop it."""
         cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'calls'"
+        )
+
+        if cursor.fetchone() is None:
+            return
+
+        logger.info("Migrating cached calls to the function_calls table")
+
+        # the old lookup returned the first matching row, so we keep that one
+        rows = cursor.execute(
             """
-            INSERT INTO calls (qualified_name, kwargs, source_code, response, exception)
-            VALUES (?, ?, ?, ?, ?)
+            SELECT qualified_name, kwargs, source_code, response, exception
+            FROM calls
+            ORDER BY rowid
+        """
+        ).fetchall()
+
+        for qualified_name, kwargs, source_code, response, exception in rows:
+            source_hash = hashlib.sha256(source_code.encode("utf-8")).hexdigest()
+            kwargs = json.loads(kwargs)
+            key = self.make_key(
+                qualified_name, source_hash, self.serialize_kwargs(kwargs)
+            )
+
+            self._write_row(
+                cursor,
+                key=key,
+                qualified_name=qualified_name,
+                source_hash=source_hash,
+                kwargs=kwargs,
+                response=json.loads(response),
+                exception=exception,
+                attempts=None if exception is None else 1,
+                replace=False,
+            )
+
+        cursor.execute("DROP TABLE calls")
+
+    def _write_row(
+        self,
+        cursor,
+        *,
+        key,
+        qualified_name,
+        source_hash,
+        kwargs,
+        response,
+        exception,
+        replace,
+        exception_type=None,
+        attempts=None,
+        retry_after=None,
+    ):
+        """Write a row to the function_calls table, moving long strings to the blobs
+        table. Returns the number of bytes written, and the number of bytes saved by
+        compressing and sharing the blobs. If replace is False and the row exists,
+        nothing is written."""
+        # take the write lock before reading, or another connection could insert the
+        # same blob between _pack's lookup and its insert
+        if not cursor.connection.in_transaction:
+            cursor.execute("BEGIN IMMEDIATE")
+
+        cursor.execute(
+            "SELECT kwargs, response, exception FROM function_calls WHERE key = ?",
+            (key,),
+        )
+        previous = cursor.fetchone()
+
+        if previous is not None and not replace:
+            return 0, 0
+
+        blobs = []
+        kwargs = self.serialize_kwargs(self._pack(cursor, kwargs, blobs))
+        response = json.dumps(self._pack(cursor, response, blobs))
+        row_size = _row_size(kwargs, response, exception)
+        # the size of the row includes the blobs it references, even if they're
+        # shared with other rows, to estimate how much evicting it frees (cache_size
+        # counts each blob once)
+        size = row_size + sum(blob.compressed_size for blob in blobs)
+        bytes_stored = row_size + sum(
+            blob.compressed_size for blob in blobs if blob.is_new
+        )
+        bytes_saved = row_size + sum(blob.size for blob in blobs) - bytes_stored
+        now = time.time()
+
+        cursor.execute(
+            f"""
+            INSERT OR {"REPLACE" if replace else "IGNORE"} INTO function_calls
+            (key, qualified_name, source_hash, kwargs, response, exception,
+            created_at, last_access, size, exception_type, attempts, retry_after)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """,
             (
-                self._qualified_name,
-                json.dumps(kwargs),
-                self._source_code,
-                json.dumps(response),
+                key,
+                qualified_name,
+                source_hash,
+                kwargs,
+                response,
                 exception,
+                now,
+                now,
+                size,
+                exception_type,
+                attempts,
+                retry_after,
+            ),
+        )
+
+        delta = bytes_stored
+
+        # the blobs are released after adding the new references, so the ones the
+        # two rows share aren't deleted
+        if previous is not None:
+            delta -= _row_size(*previous) + self._release_blobs(
+                cursor, _blob_references(*previous[:2])
+            )
+
+        self._add_size(cursor, delta)
+        return bytes_stored, bytes_saved
+
+    def _pack(self, cursor, value, blobs):
+        """Return a copy of value where strings longer than blob_threshold are
+        replaced by a reference to a row in the blobs table, and keys matching
+        RESERVED_KEY_RE are escaped. A _BlobInfo for each blob is appended to
+        blobs."""
+        if isinstance(value, str):
+            if len(value) <= self._blob_threshold:
+                return value
+
+            data = value.encode("utf-8")
+            digest = hashlib.sha256(data).hexdigest()
+            cursor.execute("SELECT LENGTH(data) FROM blobs WHERE hash = ?", (digest,))
+            result = cursor.fetchone()
+
+            # compressing large pages is expensive, only do it if it's a new blob
+            if result is None:
+                compressed = zlib.compress(data)
+                cursor.execute(
+                    "INSERT INTO blobs (hash, data, refs) VALUES (?, ?, 1)",
+                    (digest, compressed),
+                )
+                blobs.append(_BlobInfo(len(data), len(compressed), True))
+            else:
+                cursor.execute(
+                    "UPDATE blobs SET refs = refs + 1 WHERE hash = ?", (digest,)
+                )
+                blobs.append(_BlobInfo(len(data), result[0], False))
+
+            return {BLOB_REFERENCE: digest}
+        elif isinstance(value, dict):
+            return {
+                _escape_key(key): self._pack(cursor, item, blobs)
+                for key, item in value.items()
+            }
+        elif isinstance(value, (list, tuple)):
+            return [self._pack(cursor, item, blobs) for item in value]
+        else:
+            return value
+
+    def _unpack(self, cursor, value):
+        """Inverse of _pack: replace references to the blobs table by the strings."""
+        if isinstance(value, dict):
+            if len(value) == 1 and BLOB_REFERENCE in value:
+                cursor.execute(
+                    "SELECT data FROM blobs WHERE hash = ?", (value[BLOB_REFERENCE],)
+                )
+                (data,) = cursor.fetchone()
+                return zlib.decompress(data).decode("utf-8")
+
+            return {
+                _unescape_key(key): self._unpack(cursor, item)
+                for key, item in value.items()
+            }
+        elif isinstance(value, list):
+            return [self._unpack(cursor, item) for item in value]
+        else:
+            return value
+
+    def _insert(
+        self, *, key: str, kwargs: dict, response: dict, exception: Exception
+    ):
+        """Insert a new function call into the database, replacing the previous one
+        (e.g., a failure that we retried). If the function raised an exception, the
+        row records its type, the number of consecutive failures and when the call
+        can be retried."""
+        now = time.time()
+        call = dict(
+            kwargs=kwargs,
+            response=response,
+            exception=None,
+            exception_type=None,
+            attempts=None,
+            retry_after=None,
+        )
+
+        if exception is not None:
+            attempts = self._previous_attempts(key) + 1
+            backoff = min(
+                self._retry_backoff * 2 ** (attempts - 1), self._max_retry_backoff
+            )
+            exception_class = exception.__class__
+            call.update(
+                exception=f"{exception_class.__name__}: {str(exception)}",
+                exception_type=(
+                    f"{exception_class.__module__}.{exception_class.__qualname__}"
+                ),
+                attempts=attempts,
+                retry_after=now + backoff,
+            )
+
+        self._memory_put(
+            key,
+            _MemoryEntry(
+                response=call["response"],
+                exception=call["exception"],
+                exception_type=call["exception_type"],
+                attempts=call["attempts"],
+                retry_after=call["retry_after"],
+                created_at=now,
+                last_access=now,
             ),
         )
 
+        if self._write_behind:
+            self._enqueue(key, call)
+            return
+
+        cursor = self.connection.cursor()
+
+        try:
+            bytes_stored, bytes_saved = self._write_row(
+                cursor,
+                key=key,
+                qualified_name=self._qualified_name,
+                source_hash=self._source_hash,
+                replace=True,
+                **call,
+            )
+            self._record(
+                "write", key, bytes_stored=bytes_stored, bytes_saved=bytes_saved
+            )
+
+            if self._has_limits():
+                self._evict(cursor)
+
+            self._save_stats(cursor)
+        except BaseException:
+            # otherwise the connection keeps the write lock until the thread exits
+            self.connection.rollback()
+            raise
+
+        self._commit()
+
+    def _previous_attempts(self, key):
+        """Return the number of consecutive times the call failed (0 if it's not
+        cached or the last call succeeded)."""
+        entry = self._memory.get(key)
+
+        if entry is not None:
+            return entry.attempts or 0
+
+        pending = self._pending.get(key)
+
+        if pending is not None:
+            return pending["attempts"] or 0
+
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT attempts FROM function_calls WHERE key = ?", (key,))
+        result = cursor.fetchone()
+        return (result[0] or 0) if result is not None else 0
+
+    def _enqueue(self, key, call):
+        with self._pending_lock:
+            self._pending[key] = call
+            n_pending = len(self._pending)
+
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self._flush_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+        if n_pending >= self._flush_size:
+            self.flush()
+
+    def flush(self):
+        """Write the calls queued (when using write_behind=True) to the database in
+        a single transaction."""
+        with self._flush_lock:
+            with self._pending_lock:
+                pending = dict(self._pending)
+
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+
+            if not pending:
+                return
+
+            cursor = self.connection.cursor()
+
+            try:
+                for key, call in pending.items():
+                    bytes_stored, bytes_saved = self._write_row(
+                        cursor,
+                        key=key,
+                        qualified_name=self._qualified_name,
+                        source_hash=self._source_hash,
+                        replace=True,
+                        **call,
+                    )
+                    self._record(
+                        "write",
+                        key,
+                        bytes_stored=bytes_stored,
+                        bytes_saved=bytes_saved,
+                    )
+
+                if self._has_limits():
+                    self._evict(cursor)
+
+                self._save_stats(cursor)
+            except BaseException:
+                # the calls stay queued, and the connection doesn't keep the write
+                # lock
+                self.connection.rollback()
+                raise
+
+            self.connection.commit()
+
+            # remove them after committing so lookups always find them in one of
+            # the two places, unless they were queued again in the meantime
+            with self._pending_lock:
+                for key, call in pending.items():
+                    if self._pending.get(key) is call:
+                        del self._pending[key]
+
+    def _has_limits(self):
+        return any(
+            limit is not None
+            for limit in (self._max_bytes, self._max_entries, self._ttl)
+        )
+
+    def compact(self, vacuum=False):
+        """Evict the calls that exceed the limits (max_bytes, max_entries and ttl),
+        then recount the references to the blobs and the size of the cache from
+        scratch, deleting the blobs that are no longer referenced. Eviction also
+        runs after every insert if any limit is set, but without the recount (which
+        scans all the rows).
+
+        Parameters
+        ----------
+        vacuum : bool, default=False
+            Run VACUUM afterwards so the file shrinks (SQLite reuses the freed space
+            otherwise, but doesn't return it to the OS).
+        """
+        cursor = self.connection.cursor()
+        self._evict(cursor)
+        self._recount(cursor)
         self.connection.commit()
 
-    def _lookup(self, *, kwargs: dict):
-        """Look up a function call in the database by matching the qualified name and
-        kwargs. Return None if not found.
+        if vacuum:
+            self.connection.execute("VACUUM")
+
+    def _evict(self, cursor):
+        """Delete the expired calls and the least recently used ones until the cache
+        is within max_entries and max_bytes."""
+        if self._ttl is not None:
+            cursor.execute(
+                "SELECT key FROM function_calls WHERE created_at < ?",
+                (time.time() - self._ttl,),
+            )
+            self._delete_calls(cursor, [row[0] for row in cursor.fetchall()])
+
+        if self._max_entries is not None:
+            cursor.execute(
+                """
+                SELECT key FROM function_calls
+                ORDER BY last_access DESC
+                LIMIT -1 OFFSET ?
+            """,
+                (self._max_entries,),
+            )
+            self._delete_calls(cursor, [row[0] for row in cursor.fetchall()])
+
+        if self._max_bytes is not None:
+            while True:
+                excess = self._size(cursor) - self._max_bytes
+
+                if excess <= 0:
+                    break
+
+                keys, freed = [], 0
+                cursor.execute(
+                    "SELECT key, size FROM function_calls ORDER BY last_access"
+                )
+
+                for key, size in cursor:
+                    keys.append(key)
+                    freed += size
+
+                    if freed >= excess:
+                        break
+
+                if not keys:
+                    break
+
+                self._delete_calls(cursor, keys)
+
+    def _size(self, cursor):
+        """Return the size of the cached data (rows and compressed blobs)."""
+        cursor.execute("SELECT bytes FROM cache_size")
+        return cursor.fetchone()[0]
+
+    def _add_size(self, cursor, delta):
+        cursor.execute("UPDATE cache_size SET bytes = bytes + ?", (delta,))
+
+    def _delete_calls(self, cursor, keys):
+        """Delete calls and the blobs that only they referenced."""
+        if not keys:
+            return
+
+        logger.info(f"Evicting {len(keys)} cached call(s)")
+        references = Counter()
+        size = 0
+
+        for key in keys:
+            cursor.execute(
+                "SELECT kwargs, response, exception FROM function_calls WHERE key = ?",
+                (key,),
+            )
+            kwargs, response, exception = cursor.fetchone()
+            references += _blob_references(kwargs, response)
+            size += _row_size(kwargs, response, exception)
+
+        cursor.executemany(
+            "DELETE FROM function_calls WHERE key = ?", [(key,) for key in keys]
+        )
+
+        with self._memory_lock:
+            for key in keys:
+                self._memory.pop(key, None)
+
+        self._add_size(cursor, -size - self._release_blobs(cursor, references))
+
+    def _release_blobs(self, cursor, references):
+        """Remove references (a Counter of blob hashes) to the blobs, deleting the
+        ones that are no longer referenced. Returns the number of bytes freed."""
+        cursor.executemany(
+            "UPDATE blobs SET refs = refs - ? WHERE hash = ?",
+            [(count, hash_) for hash_, count in references.items()],
+        )
+        freed = 0
+
+        for hash_ in references:
+            cursor.execute(
+                "SELECT LENGTH(data) FROM blobs WHERE hash = ? AND refs <= 0", (hash_,)
+            )
+            result = cursor.fetchone()
+
+            if result is not None:
+                cursor.execute("DELETE FROM blobs WHERE hash = ?", (hash_,))
+                freed += result[0]
+
+        return freed
+
+    def _recount(self, cursor):
+        """Recount the references to each blob and the size of the cache, deleting
+        the blobs that are no longer referenced."""
+        references = Counter()
+        rows = 0
+        cursor.execute("SELECT kwargs, response, exception FROM function_calls")
+
+        for kwargs, response, exception in cursor:
+            references += _blob_references(kwargs, response)
+            rows += _row_size(kwargs, response, exception)
+
+        cursor.execute("UPDATE blobs SET refs = 0")
+        cursor.executemany(
+            "UPDATE blobs SET refs = ? WHERE hash = ?",
+            [(count, hash_) for hash_, count in references.items()],
+        )
+        cursor.execute("DELETE FROM blobs WHERE refs = 0")
+        cursor.execute("SELECT IFNULL(SUM(LENGTH(data)), 0) FROM blobs")
+        (blobs,) = cursor.fetchone()
+        cursor.execute("DELETE FROM cache_size")
+        cursor.execute("INSERT INTO cache_size (bytes) VALUES (?)", (rows + blobs,))
+
+    def _lookup(self, *, key: str, kwargs_size: int = 0):
+        """Look up a function call in the database by its key. Return None if not
+        found.
 
         Parameters
         ----------
-        kwargs : dict
-            The keyword arguments passed to the function.
+        key : str
+            The cache key, as returned by make_key.
+
+        kwargs_size : int, default=0
+            Length of the serialized kwargs, added to the statistics if it's a hit.
 
         Returns
         -------
         dict
             The response from the function if found, otherwise None.
         """
+        start = time.perf_counter()
+        entry = self._find_entries([key]).get(key)
+        lookup_seconds = time.perf_counter() - start
+
+        # no cache hit
+        if entry is None:
+            logger.info(f"Cache miss, calling {self._qualified_name}")
+            self._record("miss", key, misses=1, lookup_seconds=lookup_seconds)
+            return None
+
+        if entry.exception is not None and self._should_retry(entry):
+            self._record("miss", key, misses=1, lookup_seconds=lookup_seconds)
+            return None
+
+        self._record(
+            "hit",
+            key,
+            hits=1,
+            lookup_seconds=lookup_seconds,
+            saved_input_chars=kwargs_size,
+        )
+
+        if entry.exception is None:
+            return entry.response
+
+        raise CachedException(
+            entry.exception,
+            exception_type=entry.exception_type,
+            attempts=entry.attempts,
+            retry_after=entry.retry_after,
+        )
+
+    def _find_entries(self, keys):
+        """Return a dictionary with the cached calls (as _MemoryEntry) for the keys
+        found in the memory tier, the write-behind queue or the database, in that
+        order. The ones missing in memory are looked up with a single query (per
+        MAX_KEYS_PER_QUERY keys) and added to it. Expired calls are left out."""
+        entries = {}
+        remaining = []
+
+        for key in keys:
+            entry = self._memory_get(key)
+
+            if entry is None:
+                pending = self._pending.get(key)
+
+                if pending is not None:
+                    now = time.time()
+                    entry = _MemoryEntry(
+                        response=pending["response"],
+                        exception=pending["exception"],
+                        exception_type=pending["exception_type"],
+                        attempts=pending["attempts"],
+                        retry_after=pending["retry_after"],
+                        created_at=now,
+                        last_access=now,
+                    )
+
+            if entry is None:
+                remaining.append(key)
+            else:
+                entries[key] = entry
+
+        if not remaining:
+            return entries
+
         cursor = self.connection.cursor()
+        now = time.time()
+        accessed = []
+
+        for start in range(0, len(remaining), MAX_KEYS_PER_QUERY):
+            chunk = remaining[start : start + MAX_KEYS_PER_QUERY]
+            cursor.execute(
+                f"""
+                SELECT key, response, exception, exception_type, attempts,
+                retry_after, created_at, last_access
+                FROM function_calls
+                WHERE key IN ({", ".join("?" * len(chunk))})
+            """,
+                chunk,
+            )
+
+            for (
+                key,
+                response,
+                exception,
+                exception_type,
+                attempts,
+                retry_after,
+                created_at,
+                last_access,
+            ) in cursor.fetchall():
+                if self._ttl is not None and created_at < now - self._ttl:
+                    logger.info(f"Cached call to {self._qualified_name} expired")
+                    continue
+
+                if last_access < now - LAST_ACCESS_RESOLUTION:
+                    accessed.append(key)
+                    last_access = now
+
+                entry = _MemoryEntry(
+                    response=self._unpack(cursor, json.loads(response)),
+                    exception=exception,
+                    exception_type=exception_type,
+                    attempts=attempts,
+                    retry_after=retry_after,
+                    created_at=created_at,
+                    last_access=last_access,
+                )
+                self._memory_put(key, entry)
+                entries[key] = entry
+
+        if accessed:
+            cursor.executemany(
+                "UPDATE function_calls SET last_access = ? WHERE key = ?",
+                [(now, key) for key in accessed],
+            )
+            self._commit()
+
+        return entries
+
+    def get_many(self, kwargs_list):
+        """Look up several calls at once, without calling the function. The calls
+        missing in memory are looked up with a single query.
+
+        Parameters
+        ----------
+        kwargs_list : list of dict
+            The keyword arguments of each call.
+
+        Returns
+        -------
+        responses : list
+            The cached response of each call, or None if the call isn't cached (or
+            it expired, or the function raised an exception).
+
+        misses : list of dict
+            The keyword arguments of the calls that returned None.
+        """
+        keys = [self._key_for(kwargs) for kwargs in kwargs_list]
+        entries = self._find_entries(keys)
+        responses, misses = [], []
+
+        for key, kwargs in zip(keys, kwargs_list):
+            entry = entries.get(key)
+
+            if entry is None or entry.exception is not None:
+                responses.append(None)
+                misses.append(kwargs)
+            else:
+                responses.append(entry.response)
+
+        return responses, misses
+
+    def warm(self, kwargs_list):
+        """Load the cached calls into memory so calling the function with them
+        doesn't query the database. Returns the keyword arguments of the calls that
+        aren't cached."""
+        if len(kwargs_list) > self._memory_size:
+            logger.warning(
+                f"Warming up {len(kwargs_list)} calls to {self._qualified_name} but "
+                f"memory_size is {self._memory_size}, some will be dropped from memory"
+            )
+
+        _, misses = self.get_many(kwargs_list)
+        return misses
+
+    def _memory_get(self, key):
+        """Return the call from the memory tier, or None if it's not there. Calls
+        that expired or that we haven't recorded a database hit for in a while are
+        also misses, so the database lookup updates them."""
+        if not self._memory_size:
+            return None
+
+        now = time.time()
+
+        with self._memory_lock:
+            entry = self._memory.get(key)
+
+            if (
+                entry is None
+                or (self._ttl is not None and entry.created_at < now - self._ttl)
+                or entry.last_access < now - LAST_ACCESS_RESOLUTION
+            ):
+                self._memory_misses += 1
+                return None
+
+            self._memory.move_to_end(key)
+            self._memory_hits += 1
+            return entry
 
+    def _memory_put(self, key, entry):
+        if not self._memory_size:
+            return
+
+        with self._memory_lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+
+            while len(self._memory) > self._memory_size:
+                self._memory.popitem(last=False)
+
+    def memory_info(self):
+        """Return the hits, misses and size of the memory tier (like
+        functools.lru_cache's cache_info)."""
+        with self._memory_lock:
+            return MemoryInfo(
+                self._memory_hits,
+                self._memory_misses,
+                len(self._memory),
+                self._memory_size,
+            )
+
+    def _record(self, event, key=None, **values):
+        """Add values to the statistics and pass the event to on_event."""
+        with self._stats_lock:
+            self._stats.update(values)
+            self._unsaved_stats.update(values)
+
+        if self._on_event is not None:
+            self._on_event(
+                dict(event=event, function=self._qualified_name, key=key, **values)
+            )
+
+    def stats(self):
+        """Return the statistics of this object (calls made by other FunctionCache
+        objects or processes aren't included, see report).
+
+        Returns
+        -------
+        CacheStats
+            hits and misses (calls to the FunctionCache that were and weren't served
+            from the cache, get_many and warm aren't included), hit_rate, calls
+            (times the function was called), lookup_seconds and function_seconds
+            (total time spent looking up calls and calling the function),
+            saved_input_chars (size of the serialized kwargs of the hits),
+            bytes_stored (bytes written to the database) and bytes_saved (bytes
+            saved by compressing and sharing long strings).
+        """
+        with self._stats_lock:
+            stats = Counter(self._stats)
+
+        return _make_stats(stats)
+
+    def save_stats(self):
+        """Add the statistics recorded since the last time they were saved to the
+        function_stats table. They're saved when writing calls and at exit, so this
+        is only needed to report them while the process is running."""
+        self._save_stats(self.connection.cursor())
+        self._commit()
+
+    def _save_stats(self, cursor):
+        with self._stats_lock:
+            stats = self._unsaved_stats
+            self._unsaved_stats = Counter()
+
+        if not stats:
+            return
+
+        columns = ", ".join(STATS_COLUMNS)
+        placeholders = ", ".join("?" for _ in STATS_COLUMNS)
+        updates = ", ".join(
+            f"{column} = {column} + excluded.{column}" for column in STATS_COLUMNS
+        )
         cursor.execute(
-            """
-            SELECT response, exception
-            FROM calls
-            WHERE qualified_name = ? AND kwargs = ? AND source_code = ?
+            f"""
+            INSERT INTO function_stats (qualified_name, {columns})
+            VALUES (?, {placeholders})
+            ON CONFLICT (qualified_name) DO UPDATE SET {updates}
         """,
-            (self._qualified_name, json.dumps(kwargs), self._source_code),
+            (self._qualified_name, *(stats[column] for column in STATS_COLUMNS)),
         )
 
-        result = cursor.fetchone()
+    def _should_retry(self, entry):
+        """Return True if we can retry a call that raised an exception (a cache
+        miss), otherwise the cached exception is raised."""
+        if not self._retry_failures:
+            return False
 
-        # no cache hit
-        if result is None:
-            logger.info(f"Cache miss, calling {self._qualified_name}")
-            return None
+        attempts = entry.attempts or 1
 
-        response, exception = result
+        if self._max_attempts is not None and attempts >= self._max_attempts:
+            logger.info(
+                f"Not retrying {self._qualified_name}, it failed {attempts} "
+                f"time(s) (max_attempts is {self._max_attempts})"
+            )
+            return False
 
-        if exception is not None:
-            # no cache hit
-            if self._retry_failures:
-                logger.info(
-                    "Cache miss (function raised an exception and "
-                    f"retry_failures is True), calling {self._qualified_name}"
-                )
-                return None
-            else:
-                raise CachedException(exception)
+        if entry.retry_after is not None and time.time() < entry.retry_after:
+            logger.info(
+                f"Not retrying {self._qualified_name} yet, it failed {attempts} "
+                "time(s) and we're backing off"
+            )
+            return False
 
-        return json.loads(response)
+        logger.info(
+            "Cache miss (function raised an exception and "
+            f"retry_failures is True), calling {self._qualified_name}"
+        )
+        return True
+
+    def _key_for(self, kwargs):
+        return self.make_key(
+            self._qualified_name, self._source_hash, self.serialize_kwargs(kwargs)
+        )
+
+    def _key_and_size_for(self, kwargs):
+        """Return the key and the length of the serialized kwargs (for the
+        statistics)."""
+        serialized_kwargs = self.serialize_kwargs(kwargs)
+        key = self.make_key(self._qualified_name, self._source_hash, serialized_kwargs)
+        return key, len(serialized_kwargs)
 
     def __call__(self, **kwargs):
         """Call the function, caching the result if it's not already in the database.
         kwargs must be JSON-serializable."""
-        response = self._lookup(kwargs=kwargs)
+        if self._is_coroutine_function:
+            return self._call_async(kwargs)
+
+        key, kwargs_size = self._key_and_size_for(kwargs)
+        response = self._lookup(key=key, kwargs_size=kwargs_size)
+
+        if response is None:
+            if self._block_execution:
+                raise ValueError(
+                    f"Attempted to call a cached function ({self._qualified_name}) "
+                    f"that was blocked from execution (kwargs: {kwargs})"
+                )
+
+            response = self._call_once(key, kwargs)
+
+        return response
+
+    def _call_once(self, key, kwargs):
+        """Call the function, unless another thread is already calling it with the
+        same key, in which case wait for it and return its response."""
+        with self._sync_in_flight_lock:
+            future = self._sync_in_flight.get(key)
+            is_caller = future is None
+
+            if is_caller:
+                future = Future()
+                self._sync_in_flight[key] = future
+
+        if not is_caller:
+            return future.result()
+
+        try:
+            response = self._call_and_insert(key, kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(response)
+            return response
+        finally:
+            with self._sync_in_flight_lock:
+                del self._sync_in_flight[key]
+
+    def _call_and_insert(self, key, kwargs):
+        start = time.perf_counter()
+
+        try:
+            response = self._function(**kwargs)
+        except Exception as e:
+            response = None
+            exception = e
+        else:
+            exception = None
+
+        self._record("call", key, calls=1, function_seconds=time.perf_counter() - start)
+
+        self._insert(
+            key=key,
+            kwargs=kwargs,
+            response=response,
+            exception=exception,
+        )
+
+        if exception is not None:
+            raise exception
+
+        return response
+
+    async def _call_async(self, kwargs):
+        """Await the cached coroutine function. If there's a call in flight with the
+        same key, wait for it instead of calling the function again."""
+        key, kwargs_size = self._key_and_size_for(kwargs)
+        task = self._in_flight.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(self._resolve_async(key, kwargs, kwargs_size))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        # shield so cancelling one caller doesn't cancel the call for the rest
+        return await asyncio.shield(task)
+
+    async def _resolve_async(self, key, kwargs, kwargs_size):
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(
+            self.executor, partial(self._lookup, key=key, kwargs_size=kwargs_size)
+        )
 
         if response is None:
             if self._block_execution:
@@ -181,23 +1478,130 @@ class FunctionCache:
                     f"that was blocked from execution (kwargs: {kwargs})"
                 )
 
+            start = time.perf_counter()
+
             try:
-                response = self._function(**kwargs)
+                response = await self._function(**kwargs)
             except Exception as e:
                 response = None
-                exception = f"{e.__class__.__name__}: {str(e)}"
-                exception_instance = e
+                exception = e
             else:
                 exception = None
-                exception_instance = None
 
-            self._insert(
-                kwargs=kwargs,
-                response=response,
-                exception=exception,
+            self._record(
+                "call", key, calls=1, function_seconds=time.perf_counter() - start
+            )
+
+            await loop.run_in_executor(
+                self.executor,
+                partial(
+                    self._insert,
+                    key=key,
+                    kwargs=kwargs,
+                    response=response,
+                    exception=exception,
+                ),
             )
 
-            if exception_instance is not None:
-                raise exception_instance
+            if exception is not None:
+                raise exception
 
         return response
+
+
+def _make_stats(stats):
+    lookups = stats["hits"] + stats["misses"]
+    return CacheStats(
+        hit_rate=stats["hits"] / lookups if lookups else None,
+        **{column: stats[column] for column in STATS_COLUMNS},
+    )
+
+
+def report(path_to_db, price_per_million_tokens=0.15):
+    """Return the statistics of each function cached in a database (added by all the
+    processes that used it), and estimate how much time and money the hits saved.
+
+    Parameters
+    ----------
+    path_to_db : str
+        Path to the SQLite database file.
+
+    price_per_million_tokens : float, default=0.15
+        Price of the input tokens of the model the functions call (the default is
+        gpt-4o-mini's). The dollars saved are estimated from the size of the kwargs
+        of the hits (CHARS_PER_TOKEN characters per token), so they're only
+        meaningful for functions that send their kwargs to a model.
+
+    Returns
+    -------
+    list of dict
+        One per function: function, cached_calls and cached_bytes (calls in the
+        database and their size, counting each blob they reference once), the
+        fields of CacheStats, seconds_saved (hits times the average time the
+        function took) and dollars_saved.
+    """
+    connection = sqlite3.connect(path_to_db)
+
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        tables = {row[0] for row in cursor.fetchall()}
+        cached, stats = {}, {}
+
+        if "function_calls" in tables:
+            blob_sizes = {}
+
+            if "blobs" in tables:
+                cursor.execute("SELECT hash, LENGTH(data) FROM blobs")
+                blob_sizes = dict(cursor.fetchall())
+
+            n_calls, sizes, hashes = Counter(), Counter(), defaultdict(set)
+            cursor.execute(
+                "SELECT qualified_name, kwargs, response, exception FROM function_calls"
+            )
+
+            for name, kwargs, response, exception in cursor:
+                n_calls[name] += 1
+                sizes[name] += _row_size(kwargs, response, exception)
+                hashes[name].update(_blob_references(kwargs, response))
+
+            for name in n_calls:
+                blobs = sum(blob_sizes.get(hash_, 0) for hash_ in hashes[name])
+                cached[name] = (n_calls[name], sizes[name] + blobs)
+
+        # databases created by older versions don't have statistics
+        if "function_stats" in tables:
+            cursor.execute(
+                f"SELECT qualified_name, {', '.join(STATS_COLUMNS)} FROM function_stats"
+            )
+            stats = {name: dict(zip(STATS_COLUMNS, values)) for name, *values in cursor}
+    finally:
+        connection.close()
+
+    rows = []
+
+    for name in sorted(cached.keys() | stats.keys()):
+        function_stats = _make_stats(Counter(stats.get(name, {})))
+        n_calls, size = cached.get(name, (0, 0))
+        seconds_per_call = (
+            function_stats.function_seconds / function_stats.calls
+            if function_stats.calls
+            else 0
+        )
+        rows.append(
+            dict(
+                function=name,
+                cached_calls=n_calls,
+                cached_bytes=size,
+                **function_stats._asdict(),
+                seconds_saved=function_stats.hits * seconds_per_call,
+                dollars_saved=(
+                    function_stats.saved_input_chars
+                    / CHARS_PER_TOKEN
+                    * price_per_million_tokens
+                    / 1_000_000
+                ),
+            )
+        )
+
+    return rows
@@ -0,0 +1,176 @@
+"""
+Check that fast_minifier (LXMLMinifier) produces exactly the same output as the
+BeautifulSoup minifier pipeline on a fixed corpus: hand-written documents, the
+cases that used to differ and documents generated from a fixed seed. HTML files
+passed as arguments are added to the corpus.
+
+    python check_fast_minifier.py [page.html ...]
+"""
+
+import random
+import sys
+from pathlib import Path
+
+import lib
+
+
+PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>Human Development Index &amp; rankings</title>
+<link rel="stylesheet" href="/style.css">
+<script>if (a < b && c > d) { document.write("<p>x</p>"); }</script>
+<style>.x > .y { color: red; }</style>
+</head>
+<body class="page  mw-body" data-testid="root">
+  <!-- navigation -->
+  <nav id="nav"><a href="/">Home</a> |
+    <a href="/about?x=1&y=2" class="link">About</a></nav>
+  <main id="content">
+    <h1 class="title">HDI &mdash; 2022</h1>
+    <table class="wikitable sortable" id="hdi">
+      <thead><tr><th>Rank</th><th>Country</th><th>HDI</th></tr></thead>
+      <tbody>
+        <tr><td>1</td><td><a href="/ch" title="Switzerland">Switzerland</a></td>
+            <td>0.967</td></tr>
+        <tr><td>2</td><td><a href="/no">Norway</a></td><td>0.966</td></tr>
+        <tr><td>3</td><td>Iceland<br>(tie)</td><td>0.959&nbsp;</td></tr>
+      </tbody>
+    </table>
+    <p>Prices in &euro; &amp; $ &#169; &#x2014; 1 &lt; 2</p>
+    <ul><li class="item">One</li><li class="item active">Two</li></ul>
+    <img src="a.png" alt="A"><input type="text" id="q" value="search">
+  </main>
+  <script src="app.js"></script>
+</body>
+</html>
+"""
+
+CORPUS = [
+    PAGE,
+    PAGE.replace("<body", "<div").replace("</body>", "</div>"),
+    "<div><p>Hello <b>world</b></p><p>  spaced   out  </p></div>",
+    "<table><tr><td>a</td><td>b</td></tr></table>",
+    '<section class="b a" id="s"><span class="a">x</span></section>',
+    "<a>bare link</a> and <a id='x'>kept</a>",
+    # used to differ
+    "R&D;<p>x</p>",
+    "&foo;",
+    "<!-- c -->x&y",
+    "R&D",
+    "<!--x",
+    "<body><!--x></body>",
+    "a <b",
+    "<p>a</p><x",
+    '<th CLASS class="x y"></th>',
+    "<form data-testid='<>' data-testid=\"\n\"></form>",
+    "<p>&lt;</p><\xa0&notit;",
+    '<HTML><p>a</p></HTML>x<body class="b"><p>y</p></body>',
+    '<div><body class="b">y</div>z</body>',
+]
+
+# fmt: off
+TAGS = [
+    "div", "p", "span", "a", "td", "tr", "table", "tbody", "li", "ul", "b", "br",
+    "img", "body", "html", "head", "title", "HTML", "BODY", "input", "wbr", "source",
+    "script", "style", "textarea", "option", "select", "pre", "svg", "template",
+    "noscript", "meta", "iframe", "embed", "colgroup", "th", "x-foo",
+]
+ATTRIBUTES = ["class", "id", "data-testid", "href", "style", "CLASS", "Id", "title"]
+TEXT = [
+    "x", " ", "\n", "  y  ", "R&D", "&amp;", "&foo;", "&copy", "&copyx", "&#38;",
+    "&#x26", "&lt;", "a&b", "&nbsp;", "<", ">", '"', "&", ";", "\t", "&AMP;", "&#0;",
+    "&#128;", "é", "\xa0", "\r\n", "]]>", "-->", "&gt", "&notin;", "&notit;",
+]
+MARKUP = [
+    "<!-- c -->", "<!---->", "<!--x", "<!DOCTYPE html>", "<?php x ?>",
+    "<![CDATA[x]]>", "</ p>", "<!x>", "<!-->", "</>", "<br/>", "</br>", "<p/>",
+    "< p>", "<a", "a <b", "<div>", "</div>", "</p>",
+]
+VALUES = [
+    "a", "a b", "  a  b ", "", "x&y", "R&D;", "&foo;", 'a"b', "a'b", "&amp;",
+    "q?a=1&b=2", "\n", "<>", "&copy",
+]
+# fmt: on
+
+
+def generate_attribute(rng: random.Random) -> str:
+    name = rng.choice(ATTRIBUTES)
+
+    if rng.random() < 0.2:
+        return f" {name}"
+
+    value = rng.choice(VALUES)
+    quote = "'" if '"' in value else rng.choice(['"', "'"])
+    return f" {name}={quote}{value.replace(quote, '')}{quote}"
+
+
+def generate_fragment(rng: random.Random, depth: int = 0) -> str:
+    parts = []
+
+    for _ in range(rng.randint(0, 5)):
+        kind = rng.random()
+
+        if kind < 0.35:
+            parts.append(rng.choice(TEXT))
+        elif kind < 0.42:
+            parts.append(rng.choice(MARKUP))
+        else:
+            tag = rng.choice(TAGS)
+            attributes = "".join(
+                generate_attribute(rng) for _ in range(rng.randint(0, 3))
+            )
+            content = generate_fragment(rng, depth + 1) if depth < 4 else "x"
+            end = f"</{tag}>" if rng.random() < 0.85 else ""
+            parts.append(f"<{tag}{attributes}>{content}{end}")
+
+    return "".join(parts)
+
+
+def generate_document(rng: random.Random) -> str:
+    fragment = generate_fragment(rng)
+    kind = rng.random()
+
+    if kind < 0.3:
+        return (
+            "<html><head><title>t</title></head>"
+            f"<body{generate_attribute(rng)}>{fragment}</body></html>"
+            + rng.choice(["", "x", "\n", "<p>a</p>"])
+        )
+    elif kind < 0.4:
+        return rng.choice(["<!DOCTYPE html>", "", " "]) + f"<body>{fragment}</body>"
+    else:
+        return fragment
+
+
+def main(paths: list[str], generated: int = 5000, seed: int = 0) -> int:
+    rng = random.Random(seed)
+    documents = CORPUS + [Path(path).read_text() for path in paths]
+    documents += [generate_document(rng) for _ in range(generated)]
+
+    lib.minifier.verbose = False
+    lib.fast_minifier.verbose = False
+    fast = lib.fast_minifier.cleaners[0]
+    fallbacks = fast.fallbacks
+    mismatches = 0
+
+    for document in documents:
+        expected = lib.minifier.clean(document)
+        output = lib.fast_minifier.clean(document)
+
+        if output != expected:
+            mismatches += 1
+            print(f"Mismatch for {document!r}")
+            print(f"  minifier:      {expected!r}")
+            print(f"  fast_minifier: {output!r}")
+
+    print(
+        f"{len(documents):,} documents, {mismatches:,} mismatches, "
+        f"{fast.fallbacks - fallbacks:,} cleaned with the BeautifulSoup fallback"
+    )
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,14 +1,23 @@
+import codecs
+import copy
+import html.entities
+import os
 import re
 import uuid
 from abc import ABC, abstractmethod
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterable, Iterator
 
 
 import tiktoken
 from markdownify import markdownify as md
 
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Comment
+from bs4.builder import HTMLTreeBuilder
+from lxml import etree
 
 
 ModelInfo = namedtuple("ModelInfo", ["name", "price_per_million_tokens"])
@@ -19,6 +28,32 @@ gpt4o_2024_08_06 = ModelInfo("gpt-4o-2024-08-06", 2.5)
 MODEL_INFO = gpt4omini
 
 
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Return the tiktoken encoding for a model, loading it only once per model."""
+    return tiktoken.encoding_for_model(model)
+
+
+def estimate_tokens(
+    encoding: tiktoken.Encoding, text: str, sample_size: int, n_windows: int = 8
+) -> int:
+    """Estimate the number of tokens in text by encoding n_windows evenly spaced
+    windows (sample_size characters in total) and extrapolating to the full length.
+    """
+    if len(text) <= sample_size:
+        return len(encoding.encode(text))
+
+    # at least a character per window, even if sample_size < n_windows
+    window = max(sample_size // n_windows, 1)
+    step = len(text) // n_windows
+    sampled_tokens = sum(
+        len(encoding.encode(text[i * step : i * step + window]))
+        for i in range(n_windows)
+    )
+
+    return round(sampled_tokens * len(text) / (window * n_windows))
+
+
 class HTMLCleaner(ABC):
 
     @abstractmethod
@@ -26,7 +61,23 @@ class HTMLCleaner(ABC):
         pass
 
 
-class BodyExtractor(HTMLCleaner):
+class TreeCleaner(HTMLCleaner):
+    """
+    A cleaner that works on a parsed tree. HTMLCleanerPipeline(tree_mode=True) passes
+    the same tree through consecutive tree cleaners and serializes it only once at the
+    end, instead of parsing and serializing the document on every step.
+    """
+
+    @abstractmethod
+    def clean_tree(self, soup: BeautifulSoup) -> BeautifulSoup:
+        pass
+
+    def clean(self, html_content: str) -> str:
+        soup = BeautifulSoup(html_content, "html.parser")
+        return str(self.clean_tree(soup))
+
+
+class BodyExtractor(TreeCleaner):
     def clean(self, html_content: str) -> str:
         soup = BeautifulSoup(html_content, "html.parser")
         body = soup.find("body")
@@ -36,12 +87,21 @@ class BodyExtractor(HTMLCleaner):
         else:
             return html_content
 
+    def clean_tree(self, soup: BeautifulSoup) -> BeautifulSoup:
+        body = soup.find("body")
 
-class AttributeRemover(HTMLCleaner):
-    def clean(self, html_content: str) -> str:
-        # Parse the HTML
-        soup = BeautifulSoup(html_content, "html.parser")
+        if body is None:
+            return soup
 
+        # wrap the body in a new document so the next cleaners also visit the
+        # <body> tag itself, as they would when re-parsing str(body)
+        new_soup = BeautifulSoup("", "html.parser")
+        new_soup.append(body.extract())
+        return new_soup
+
+
+class AttributeRemover(TreeCleaner):
+    def clean_tree(self, soup: BeautifulSoup) -> BeautifulSoup:
         # Remove script and style elements
         for script in soup(["script", "style"]):
             script.decompose()
@@ -55,13 +115,10 @@ class AttributeRemover(HTMLCleaner):
                 if attr not in attrs_to_keep:
                     del tag[attr]
 
-        # Get the cleaned HTML as a string
-        cleaned_html = str(soup)
-
-        return cleaned_html
+        return soup
 
 
-class ClassReplacer(HTMLCleaner):
+class ClassReplacer(TreeCleaner):
     def __init__(self, random: bool = True):
         self.random = random
         self.counter = 0
@@ -69,6 +126,10 @@ class ClassReplacer(HTMLCleaner):
     @staticmethod
     def extract_classes(html_content: str) -> list:
         soup = BeautifulSoup(html_content, "html.parser")
+        return ClassReplacer.extract_classes_from_tree(soup)
+
+    @staticmethod
+    def extract_classes_from_tree(soup: BeautifulSoup) -> list:
         classes = set()
 
         for tag in soup.find_all(class_=True):
@@ -91,22 +152,27 @@ class ClassReplacer(HTMLCleaner):
     @staticmethod
     def replace_classes(html_content: str, class_mapping: dict) -> str:
         soup = BeautifulSoup(html_content, "html.parser")
+        return str(ClassReplacer.replace_classes_in_tree(soup, class_mapping))
 
+    @staticmethod
+    def replace_classes_in_tree(
+        soup: BeautifulSoup, class_mapping: dict
+    ) -> BeautifulSoup:
         for tag in soup.find_all(class_=True):
             original_classes = tag.get("class", [])
             new_classes = [class_mapping.get(cls, cls) for cls in original_classes]
             tag["class"] = new_classes
 
-        return str(soup)
+        return soup
 
-    def clean(self, html_content: str) -> str:
+    def clean_tree(self, soup: BeautifulSoup) -> BeautifulSoup:
         self.counter = 0
-        classes = self.extract_classes(html_content)
+        classes = self.extract_classes_from_tree(soup)
         mapping = self.generate_class_mapping(classes)
-        return self.replace_classes(html_content, mapping)
+        return self.replace_classes_in_tree(soup, mapping)
 
 
-class IDReplacer(HTMLCleaner):
+class IDReplacer(TreeCleaner):
     def __init__(self, random: bool = True):
         self.random = random
         self.counter = 0
@@ -114,6 +180,10 @@ class IDReplacer(HTMLCleaner):
     @staticmethod
     def extract_ids(html_content: str) -> list:
         soup = BeautifulSoup(html_content, "html.parser")
+        return IDReplacer.extract_ids_from_tree(soup)
+
+    @staticmethod
+    def extract_ids_from_tree(soup: BeautifulSoup) -> list:
         ids = set()
 
         for tag in soup.find_all(id=True):
@@ -136,22 +206,25 @@ class IDReplacer(HTMLCleaner):
     @staticmethod
     def replace_ids(html_content: str, id_mapping: dict) -> str:
         soup = BeautifulSoup(html_content, "html.parser")
+        return str(IDReplacer.replace_ids_in_tree(soup, id_mapping))
 
+    @staticmethod
+    def replace_ids_in_tree(soup: BeautifulSoup, id_mapping: dict) -> BeautifulSoup:
         for tag in soup.find_all(id=True):
             original_id = tag.get("id")
             new_id = id_mapping.get(original_id, original_id)
             tag["id"] = new_id
 
-        return str(soup)
+        return soup
 
-    def clean(self, html_content: str) -> str:
+    def clean_tree(self, soup: BeautifulSoup) -> BeautifulSoup:
         self.counter = 0
-        ids = self.extract_ids(html_content)
+        ids = self.extract_ids_from_tree(soup)
         mapping = self.generate_id_mapping(ids)
-        return self.replace_ids(html_content, mapping)
+        return self.replace_ids_in_tree(soup, mapping)
 
 
-class HTMLMinifier(HTMLCleaner):
+class HTMLMinifier(TreeCleaner):
     @staticmethod
     def minify_html(html_content: str) -> str:
         # Remove comments
@@ -168,20 +241,593 @@ class HTMLMinifier(HTMLCleaner):
 
         return html_content
 
+    @staticmethod
+    def minify_stream(
+        chunks: Iterable[str | bytes], encoding: str = "utf-8"
+    ) -> Iterator[str]:
+        """Minify a document given as an iterable of chunks (e.g., the body of a
+        streamed HTTP response), yielding minified chunks. The output is the same
+        as minify_html on the whole document, without materializing it."""
+        minifier = StreamingHTMLMinifier(encoding=encoding)
+
+        for chunk in chunks:
+            minified = minifier.feed(chunk)
+
+            if minified:
+                yield minified
+
+        minified = minifier.close()
+
+        if minified:
+            yield minified
+
+    @staticmethod
+    def minify_tree(soup: BeautifulSoup) -> BeautifulSoup:
+        # Remove comments
+        for comment in soup.find_all(string=lambda text: isinstance(text, Comment)):
+            comment.extract()
+
+        # Removing comments might leave contiguous strings, merge them so whitespace
+        # is collapsed the same way as in minify_html
+        soup.smooth()
+
+        for string in soup.find_all(string=True):
+            # Remove whitespace between tags
+            if not string.strip():
+                string.extract()
+                continue
+
+            # Collapse multiple spaces into a single space
+            collapsed = re.sub(r"\s+", " ", string)
+
+            if collapsed != string:
+                string.replace_with(type(string)(collapsed))
+
+        # Collapse multiple spaces into a single space within tags
+        for tag in soup.find_all():
+            for attr, value in tag.attrs.items():
+                if isinstance(value, str):
+                    tag[attr] = re.sub(r"\s+", " ", value)
+
+        # Remove leading and trailing whitespace
+        contents = soup.contents
+
+        if contents and isinstance(contents[0], str):
+            first = contents[0]
+            first.replace_with(type(first)(first.lstrip()))
+
+        if contents and isinstance(contents[-1], str):
+            last = contents[-1]
+            last.replace_with(type(last)(last.rstrip()))
+
+        return soup
+
     def clean(self, html_content: str) -> str:
         return self.minify_html(html_content)
 
+    def clean_tree(self, soup: BeautifulSoup) -> BeautifulSoup:
+        return self.minify_tree(soup)
+
+
+class StreamingHTMLMinifier:
+    """
+    Incremental version of HTMLMinifier.minify_html. Call feed() with each chunk and
+    close() at the end, each returns the minified text that's ready so far.
+
+    Only a few characters are carried over between chunks (a possible partial
+    "<!--" or "-->", and whether the last chunk ended in whitespace), so memory
+    usage doesn't depend on the size of the document. The exception is a comment
+    that's never closed: minify_html keeps it, so it's buffered until the end.
+    """
+
+    def __init__(self, encoding: str = "utf-8") -> None:
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        # text that might be the beginning of "<!--" or "-->"
+        self._tail = ""
+        self._in_comment = False
+        # the open comment, in case it's never closed
+        self._comment = []
+        self._at_start = True
+        self._pending_whitespace = False
+        self._last_char = ""
+
+    def feed(self, chunk: str | bytes) -> str:
+        if isinstance(chunk, bytes):
+            chunk = self._decoder.decode(chunk)
+
+        return self._collapse_whitespace(self._remove_comments(chunk))
+
+    def close(self) -> str:
+        text = self._remove_comments(self._decoder.decode(b"", final=True), final=True)
+        # trailing whitespace is dropped, like html_content.strip()
+        return self._collapse_whitespace(text)
+
+    def _remove_comments(self, text: str, final: bool = False) -> str:
+        text = self._tail + text
+        out = []
+        pos = 0
+
+        while True:
+            if self._in_comment:
+                end = text.find("-->", pos)
+
+                if end == -1:
+                    keep = len(text) if final else max(pos, len(text) - 2)
+                    self._comment.append(text[pos:keep])
+                    pos = keep
+                    break
+
+                self._in_comment = False
+                self._comment = []
+                pos = end + 3
+            else:
+                start = text.find("<!--", pos)
 
-class ATagTrimmer(HTMLCleaner):
-    def clean(self, html_content: str) -> str:
-        soup = BeautifulSoup(html_content, "html.parser")
+                if start == -1:
+                    keep = len(text) if final else max(pos, len(text) - 3)
+                    out.append(text[pos:keep])
+                    pos = keep
+                    break
+
+                out.append(text[pos:start])
+                self._in_comment = True
+                self._comment = ["<!--"]
+                pos = start + 4
+
+        self._tail = text[pos:]
 
+        # an unterminated comment isn't removed by minify_html
+        if final and self._in_comment:
+            out.append("".join(self._comment))
+            self._in_comment = False
+            self._comment = []
+
+        return "".join(out)
+
+    def _collapse_whitespace(self, text: str) -> str:
+        body = text.strip()
+
+        if not body:
+            self._pending_whitespace = self._pending_whitespace or bool(text)
+            return ""
+
+        # whitespace at the edges of the chunk might be between tags, so it depends
+        # on what came before; the rest is handled like in minify_html
+        separator = ""
+
+        if (
+            (self._pending_whitespace or text[0].isspace())
+            and not self._at_start
+            and not (self._last_char == ">" and body[0] == "<")
+        ):
+            separator = " "
+
+        body = re.sub(r">\s+<", "><", body)
+        body = re.sub(r"\s+", " ", body)
+
+        self._pending_whitespace = text[-1].isspace()
+        self._last_char = body[-1]
+        self._at_start = False
+
+        return separator + body
+
+
+class ATagTrimmer(TreeCleaner):
+    def clean_tree(self, soup: BeautifulSoup) -> BeautifulSoup:
         for a_tag in soup.find_all("a"):
             if not a_tag.attrs:
                 a_tag.unwrap()
 
+        return soup
+
+
+class LXMLMinifier(HTMLCleaner):
+    """
+    Fast path for the "clean" pipeline (BodyExtractor, AttributeRemover,
+    ClassReplacer(random=False), IDReplacer(random=False), HTMLMinifier and
+    ATagTrimmer). It parses the document with lxml and does all the steps in a single
+    walk over the tree, writing the output the way BeautifulSoup serializes it.
+
+    lxml fixes broken markup differently than html.parser (e.g., unclosed <p> or
+    <li> tags), so documents where the output might differ are cleaned with the
+    BeautifulSoup cleaners instead. The number of documents that took that path is
+    stored in the fallbacks attribute.
+    """
+
+    attrs_to_keep = ("class", "data-testid", "id")
+
+    # html.parser closes these right away, lxml nests the content that follows
+    # some of them (e.g., <source> and <wbr>), so we flatten them when serializing
+    void_tags = frozenset(HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS)
+
+    # lxml reports these but they don't change the tree
+    ignored_errors = frozenset(["DTD_ID_REDEFINED", "HTML_UNKNOWN_TAG"])
+
+    # lxml closes unclosed tags implicitly (e.g., <li>a<li>b) while html.parser nests
+    # them, so we check that every tag is explicitly closed. Scripts, styles and
+    # comments are matched first so we skip their contents
+    _tag_re = re.compile(
+        r"<script\b.*?</script\s*>|<style\b.*?</style\s*>|<!--.*?-->"
+        r"|<(/?)([A-Za-z][^\s/>]*)[^>]*?(/?)>",
+        re.IGNORECASE | re.DOTALL,
+    )
+    # lxml doesn't parse markup inside these elements, html.parser does. Entities
+    # are decoded in <textarea> and <title> but not in the rest
+    _raw_text_re = re.compile(
+        r"<(textarea|title)\b[^>]*>(?![^<]*</\1\s*>)"
+        r"|<(iframe|xmp|noembed|noframes)\b[^>]*>(?![^<&]*</\2\s*>)"
+        r"|<plaintext\b",
+        re.IGNORECASE,
+    )
+    # processing instructions, CDATA sections, doctypes, bogus comments, comments
+    # that html.parser and lxml end in different places, unclosed comments (which
+    # html.parser keeps as text) and malformed end tags (e.g., </ p>)
+    _special_markup_re = re.compile(
+        r"<\?|<!(?!--)|<!---?>|--!>|<!--(?!.*?-->)|</(?![A-Za-z])", re.DOTALL
+    )
+    # html.parser keeps a tag that isn't closed at the end of the document as text
+    _unfinished_tag_re = re.compile(r"<[/A-Za-z][^>]*\Z")
+    _doctype_re = re.compile(r"\s*<!doctype[^>]*>", re.IGNORECASE)
+    # html.parser (like the name pattern below) only decodes named entities that
+    # match a name exactly, lxml also decodes the beginning of the name (e.g., &copyx)
+    _entity_re = re.compile(
+        r"&(?:([A-Za-z][-.A-Za-z0-9]*)|#(?:[xX][0-9a-fA-F]+|[0-9]+))(;?)"
+    )
+    _kept_attribute_value_re = re.compile(
+        r"\s(?:class|id|data-testid)\s*=\s*(?:\"[^\"]*|'[^']*|[^\s\"'>]*)\Z",
+        re.IGNORECASE,
+    )
+    # html.parser keeps the last duplicated attribute, lxml the first one
+    # (an attribute without a value counts too, and quoted values may contain < and >)
+    _duplicated_attribute_re = re.compile(
+        r"\s(class|id|data-testid)(?=[\s=/>])"
+        r"(?:\"[^\"]*\"|'[^']*'|[^\"'<>])*?\s\1(?=[\s=/>])",
+        re.IGNORECASE,
+    )
+    _document_tags_re = re.compile(
+        r"<(?:html|head|frameset|!doctype|/body|/html)[\s/>]", re.IGNORECASE
+    )
+
+    def __init__(self) -> None:
+        self.fallbacks = 0
+        self.fallback_cleaners = [
+            BodyExtractor(),
+            AttributeRemover(),
+            ClassReplacer(random=False),
+            IDReplacer(random=False),
+            HTMLMinifier(),
+            ATagTrimmer(),
+        ]
+
+    def clean(self, html_content: str) -> str:
+        bodies = self._count_body_tags(html_content)
+        root = self._parse(html_content, bodies)
+
+        if root is None:
+            self.fallbacks += 1
+            return self._clean_with_bs4(html_content)
+
+        return self._minify(root, has_body=bodies > 0)
+
+    def _clean_with_bs4(self, html_content: str) -> str:
+        soup = BeautifulSoup(html_content, "html.parser")
+
+        for cleaner in self.fallback_cleaners:
+            soup = cleaner.clean_tree(soup)
+
         return str(soup)
 
+    def _count_body_tags(self, html_content: str) -> int:
+        count = 0
+
+        for match in self._tag_re.finditer(html_content):
+            closing, tag, _ = match.groups()
+
+            if tag is not None and not closing and tag.lower() == "body":
+                count += 1
+
+        return count
+
+    def _parse(self, html_content: str, bodies: int):
+        """Parse the document with lxml. Return None if the tree might be different
+        from the one html.parser builds."""
+        if bodies > 1:
+            return None
+
+        if bodies:
+            # lxml moves the markup around the <body> tag into it, so we only parse
+            # what html.parser puts in the <body>
+            start, end = self._body_span(html_content)
+
+            if not self._is_safe(html_content[:end]):
+                return None
+
+            html_content = f"<html>{html_content[start:end]}</body></html>"
+        else:
+            # BodyExtractor keeps the whole document when there's no <body> tag,
+            # lxml would move things to <head>
+            if (
+                not html_content.strip()
+                or self._document_tags_re.search(html_content)
+                or not self._is_safe(html_content)
+            ):
+                return None
+
+            html_content = f"<html><body>{html_content}</body></html>"
+
+        parser = etree.HTMLParser()
+
+        try:
+            root = etree.fromstring(html_content, parser)
+        except ValueError:
+            # lxml rejects some control characters
+            return None
+
+        if (
+            root is None
+            or root.find("body") is None
+            or any(
+                error.type_name not in self.ignored_errors
+                for error in parser.error_log
+            )
+        ):
+            return None
+
+        return root
+
+    def _body_span(self, html_content: str) -> tuple[int, int]:
+        """Return where the <body> tag starts and where the end tag that closes it
+        (e.g., </body>, </html> or the end tag of an element that contains it)
+        starts, following how html.parser nests the tags."""
+        open_tags = []
+        start = None
+
+        for match in self._tag_re.finditer(html_content):
+            closing, tag, self_closing = match.groups()
+
+            if tag is None:
+                continue
+
+            tag = tag.lower()
+
+            if not closing:
+                if tag == "body":
+                    start = match.start()
+
+                if tag not in self.void_tags and not self_closing:
+                    open_tags.append(tag)
+            elif tag in open_tags:
+                index = len(open_tags) - 1 - open_tags[::-1].index(tag)
+
+                if start is not None and "body" in open_tags[index:]:
+                    return start, match.start()
+
+                del open_tags[index:]
+
+        return start, len(html_content)
+
+    def _is_safe(self, html_content: str) -> bool:
+        """Check for markup that lxml and html.parser handle differently."""
+        doctype = self._doctype_re.match(html_content)
+        start = doctype.end() if doctype else 0
+
+        if (
+            self._special_markup_re.search(html_content, start)
+            or self._raw_text_re.search(html_content)
+            or self._duplicated_attribute_re.search(html_content)
+            or self._unfinished_tag_re.search(html_content)
+        ):
+            return False
+
+        return self._all_tags_closed(html_content) and not any(
+            self._is_ambiguous_entity(html_content, match)
+            for match in self._entity_re.finditer(html_content)
+        )
+
+    def _all_tags_closed(self, html_content: str) -> bool:
+        counts = {}
+
+        for match in self._tag_re.finditer(html_content):
+            closing, tag, self_closing = match.groups()
+
+            # a script, style or comment
+            if tag is None:
+                continue
+
+            tag = tag.lower()
+
+            if tag in self.void_tags:
+                # lxml reads </br> as <br>
+                if closing:
+                    return False
+
+                continue
+
+            # html.parser reads <b<p> as a tag named "b<p"
+            if "<" in tag:
+                return False
+
+            if tag in ("html", "head", "body") or (self_closing and not closing):
+                continue
+
+            counts[tag] = counts.get(tag, 0) + (-1 if closing else 1)
+
+        return not any(counts.values())
+
+    def _is_ambiguous_entity(self, html_content: str, match: re.Match) -> bool:
+        name, semicolon = match.groups()
+
+        # html.parser drops the & of some entities at the end of the document
+        if not semicolon and match.end() == len(html_content):
+            return True
+
+        if name is None:
+            ambiguous = not semicolon
+        elif semicolon:
+            # html.parser drops the semicolon of unknown entities
+            ambiguous = f"{name};" not in html.entities.html5
+        else:
+            ambiguous = any(
+                name[:i] in html.entities.html5 or f"{name[:i]};" in html.entities.html5
+                for i in range(2, len(name) + 1)
+            )
+
+        if not ambiguous:
+            return False
+
+        # entities inside tags only matter if they're in an attribute we keep
+        # (e.g., it's common to have unescaped & in the query string of an href)
+        position = match.start()
+        tag_start = html_content.rfind("<", 0, position)
+
+        # it's in the text if there's no tag before it, the last one is closed or
+        # the < doesn't start a tag
+        if (
+            tag_start == -1
+            or tag_start < html_content.rfind(">", 0, position)
+            or not html_content[tag_start + 1 : tag_start + 2].isalpha()
+        ):
+            return True
+
+        return (
+            self._kept_attribute_value_re.search(html_content, tag_start, position)
+            is not None
+        )
+
+    def _minify(self, root, has_body: bool) -> str:
+        body = root.find("body")
+        classes = set()
+        ids = set()
+
+        for element in body.iter(tag=etree.Element):
+            if element.tag in ("script", "style"):
+                continue
+
+            if "class" in element.attrib:
+                classes.update(element.attrib["class"].split())
+
+            if "id" in element.attrib:
+                ids.add(element.attrib["id"])
+
+        class_mapping = {name: str(i) for i, name in enumerate(sorted(classes), 1)}
+        id_mapping = {name: str(i) for i, name in enumerate(sorted(ids), 1)}
+
+        out = []
+        # the document's top level strings are stripped, with a <body> tag that's
+        # just the <body>, otherwise it's everything we wrapped in <body>
+        top_level = iter([body]) if has_body else self._contents(body)
+        # each frame has the closing tag, the remaining contents and the text
+        # collected since the last tag
+        stack = [("", top_level, [])]
+        started = False
+
+        while stack:
+            closing_tag, contents, text = stack[-1]
+            top_level = len(stack) == 1
+
+            for item in contents:
+                if isinstance(item, str):
+                    text.append(item)
+                    continue
+
+                self._flush_text(text, out, lstrip=top_level and not started)
+                started = started or top_level
+                attrs = self._format_attributes(item, class_mapping, id_mapping)
+
+                if item.tag in self.void_tags:
+                    out.append(f"<{item.tag}{attrs}/>")
+                elif item.tag == "a" and not attrs:
+                    stack.append(("", self._contents(item), []))
+                    break
+                else:
+                    out.append(f"<{item.tag}{attrs}>")
+                    stack.append((f"</{item.tag}>", self._contents(item), []))
+                    break
+            else:
+                self._flush_text(
+                    text, out, lstrip=top_level and not started, rstrip=top_level
+                )
+                out.append(closing_tag)
+                stack.pop()
+
+        return "".join(out)
+
+    def _contents(self, element):
+        """Yield the text and elements inside element, in the order html.parser
+        would see them after removing comments, scripts and styles."""
+        if element.text:
+            yield element.text
+
+        for child in element:
+            tag = child.tag
+
+            if not isinstance(tag, str) or tag in ("script", "style"):
+                pass
+            elif tag in self.void_tags:
+                yield child
+                yield from self._contents(child)
+            else:
+                yield child
+
+            if child.tail:
+                yield child.tail
+
+    @staticmethod
+    def _flush_text(
+        text: list, out: list, lstrip: bool = False, rstrip: bool = False
+    ) -> None:
+        """Add the text collected since the last tag to the output the way
+        HTMLMinifier.minify_tree would."""
+        content = "".join(text)
+        text.clear()
+
+        # whitespace between tags is removed
+        if not content.strip():
+            return
+
+        content = re.sub(r"\s+", " ", content)
+
+        if lstrip:
+            content = content.lstrip()
+
+        if rstrip:
+            content = content.rstrip()
+
+        out.append(
+            content.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        )
+
+    def _format_attributes(self, element, class_mapping: dict, id_mapping: dict) -> str:
+        attrs = []
+
+        for name in self.attrs_to_keep:
+            value = element.attrib.get(name)
+
+            if value is None:
+                continue
+
+            if name == "class":
+                value = " ".join(class_mapping[cls] for cls in value.split())
+            elif name == "id":
+                value = id_mapping[value]
+            else:
+                value = re.sub(r"\s+", " ", value)
+
+            value = (
+                value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            )
+
+            if '"' not in value:
+                value = f'"{value}"'
+            elif "'" not in value:
+                value = f"'{value}'"
+            else:
+                value = '"' + value.replace('"', "&quot;") + '"'
+
+            attrs.append(f" {name}={value}")
+
+        return "".join(attrs)
+
 
 class HTMLCleanerPipeline:
     def __init__(
@@ -190,42 +836,198 @@ class HTMLCleanerPipeline:
         cleaners: list[HTMLCleaner],
         model: str,
         price_per_million_tokens: float,
+        tree_mode: bool = False,
+        stage_tokens: bool = False,
+        token_sample_size: int | None = None,
+        verbose: bool = True,
     ):
+        """
+        Parameters
+        ----------
+        tree_mode : bool
+            Share a single parsed tree among consecutive TreeCleaners.
+
+        stage_tokens : bool
+            Count tokens after every cleaner when printing progress. Otherwise, tokens
+            are only counted for the input and the output of the pipeline.
+
+        token_sample_size : int, optional
+            If set, progress reports estimate the token count from a sample of this
+            many characters instead of encoding the whole document. count_tokens
+            always returns the exact count.
+
+        verbose : bool
+            Print the length, token count and cost as the document is cleaned.
+        """
         self.cleaners = cleaners
         self.model = model
         self.price_per_million_tokens = price_per_million_tokens
+        self.tree_mode = tree_mode
+        self.stage_tokens = stage_tokens
+        self.token_sample_size = token_sample_size
+        self.verbose = verbose
 
     def count_tokens(self, text: str) -> int:
-        encoding = tiktoken.encoding_for_model(self.model)
-        return len(encoding.encode(text))
+        return len(get_encoding(self.model).encode(text))
 
     def compute_cost(self, token_count: int) -> float:
         return (token_count / 1_000_000) * self.price_per_million_tokens
 
-    def clean(self, html_content: str) -> str:
-        initial_token_count = self.count_tokens(html_content)
-        initial_cost = self.compute_cost(initial_token_count)
+    def _print_progress(
+        self, html_content: str, label: str, count_tokens: bool = True
+    ) -> None:
+        if not self.verbose:
+            return
 
+        if not count_tokens:
+            print(f"{label}: {len(html_content):,}")
+            return
+
+        if self.token_sample_size is None:
+            token_count = self.count_tokens(html_content)
+            approx = ""
+        else:
+            token_count = estimate_tokens(
+                get_encoding(self.model), html_content, self.token_sample_size
+            )
+            approx = "~"
+
+        cost = self.compute_cost(token_count)
         print(
-            f"Initial HTML content length: {len(html_content):,} ({initial_token_count:,} tokens, ${initial_cost:,.2f})"
+            f"{label}: {len(html_content):,} "
+            f"({approx}{token_count:,} tokens, {approx}${cost:,.2f})"
         )
 
-        for cleaner in self.cleaners:
+    def clean(self, html_content: str) -> str:
+        self._print_progress(html_content, "Initial HTML content length")
+
+        if self.tree_mode:
+            return self._clean_tree_mode(html_content)
+
+        for i, cleaner in enumerate(self.cleaners, start=1):
             html_content = cleaner.clean(html_content)
-            token_count = self.count_tokens(html_content)
-            cost = self.compute_cost(token_count)
-            print(
-                f"HTML content length after {cleaner.__class__.__name__}: {len(html_content):,}"
-                f" ({token_count:,} tokens, ${cost:,.2f})"
+            self._print_progress(
+                html_content,
+                f"HTML content length after {cleaner.__class__.__name__}",
+                count_tokens=self.stage_tokens or i == len(self.cleaners),
             )
 
         return html_content
 
+    def _clean_tree_mode(self, html_content: str) -> str:
+        """Run the cleaners, sharing a single parsed tree among consecutive
+        TreeCleaners. The tree is only serialized when a string cleaner needs it and
+        at the end, so progress is reported once for the whole pipeline (or after
+        every cleaner if stage_tokens is True, which serializes the tree each time).
+        """
+        soup = None
+
+        for cleaner in self.cleaners:
+            if isinstance(cleaner, TreeCleaner):
+                if soup is None:
+                    soup = BeautifulSoup(html_content, "html.parser")
+
+                soup = cleaner.clean_tree(soup)
+
+                if self.stage_tokens:
+                    self._print_progress(
+                        str(soup),
+                        f"HTML content length after {cleaner.__class__.__name__}",
+                    )
+            else:
+                if soup is not None:
+                    html_content = str(soup)
+                    soup = None
+
+                html_content = cleaner.clean(html_content)
+
+                if self.stage_tokens:
+                    self._print_progress(
+                        html_content,
+                        f"HTML content length after {cleaner.__class__.__name__}",
+                    )
+
+        if soup is not None:
+            html_content = str(soup)
+
+        if not self.stage_tokens:
+            self._print_progress(html_content, "HTML content length after pipeline")
+
+        return html_content
+
+    def clean_many(
+        self,
+        html_contents: Iterable[str],
+        workers: int | None = None,
+        max_pending: int | None = None,
+    ) -> Iterator[str]:
+        """Clean many documents in a process pool. Results are yielded in the same
+        order as the input as soon as they're ready, and progress is not printed.
+
+        Parameters
+        ----------
+        html_contents : iterable of str
+            The documents to clean. It's consumed lazily, so it can be a generator.
+
+        workers : int, optional
+            Number of processes, defaults to the number of CPUs. If 1, documents are
+            cleaned in the current process.
+
+        max_pending : int, optional
+            Maximum number of documents submitted to the pool but not yielded yet,
+            defaults to twice the number of workers. Bounds memory usage when the
+            input is large.
+        """
+        pipeline = copy.copy(self)
+        pipeline.verbose = False
+
+        if workers == 1:
+            for html_content in html_contents:
+                yield pipeline.clean(html_content)
+
+            return
+
+        workers = workers or os.cpu_count()
+        max_pending = max_pending or 2 * workers
+        pending = deque()
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(pipeline,),
+        ) as executor:
+            try:
+                for html_content in html_contents:
+                    pending.append(executor.submit(_clean_in_worker, html_content))
+
+                    if len(pending) >= max_pending:
+                        yield pending.popleft().result()
+
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # the caller stopped iterating early, don't clean the rest
+                for future in pending:
+                    future.cancel()
+
     def set_model_info(self, model_info: ModelInfo):
         self.model = model_info.name
         self.price_per_million_tokens = model_info.price_per_million_tokens
 
 
+_worker_pipeline = None
+
+
+def _init_worker(pipeline: HTMLCleanerPipeline) -> None:
+    """Store the pipeline in the worker process so it's only pickled once."""
+    global _worker_pipeline
+    _worker_pipeline = pipeline
+
+
+def _clean_in_worker(html_content: str) -> str:
+    return _worker_pipeline.clean(html_content)
+
+
 class TagRemover(HTMLCleaner):
     def clean(self, html_content: str) -> str:
         soup = BeautifulSoup(html_content, "html.parser")
@@ -260,6 +1062,16 @@ minifier = HTMLCleanerPipeline(
     ],
     model=MODEL_INFO.name,
     price_per_million_tokens=MODEL_INFO.price_per_million_tokens,
+    tree_mode=True,
+)
+
+# same output as minifier, but much faster
+fast_minifier = HTMLCleanerPipeline(
+    cleaners=[
+        LXMLMinifier(),
+    ],
+    model=MODEL_INFO.name,
+    price_per_million_tokens=MODEL_INFO.price_per_million_tokens,
 )
 
 